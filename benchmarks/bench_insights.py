@@ -0,0 +1,120 @@
+"""
+Benchmark memory use and latency of insights as a user's history grows.
+
+Usage:
+    python -m benchmarks.bench_insights [sizes...]
+
+e.g. `python -m benchmarks.bench_insights 1000 10000 100000 1000000`
+
+Runs against DATABASE_URL (a throwaway sqlite file by default). On sqlite only the frequency distribution is
+measured, since places need PostgreSQL. Daily rollups are seeded along with mood events, since whole days of the
+frequency distribution are read from them. Peak Python memory is measured with tracemalloc and should stay flat,
+because aggregation happens in the db and only one row per group comes back.
+"""
+from collections import Counter
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('GOOGLE_API_KEY', 'bench')
+os.environ.setdefault('JWT_SECRET', 'bench')
+
+from moody import insights, rollups  # noqa: E402
+from moody.db import init_engine, session  # noqa: E402
+from moody.models import Base, MoodEvent, SentimentRollup, User  # noqa: E402
+
+SENTIMENTS = ['happy', 'sad', 'neutral']
+INSERT_CHUNK_SIZE = 10000
+START = datetime(2017, 1, 1)
+
+
+engine = init_engine()
+
+
+def create_tables():
+    if engine.dialect.name == 'sqlite':
+        Base.metadata.create_all(engine, tables=[User.__table__, MoodEvent.__table__, SentimentRollup.__table__])
+    else:
+        Base.metadata.create_all(engine)
+
+
+def grow_history(user, current_size, target_size, daily_counts):
+    """
+    Insert mood events for `user` until they have `target_size` of them, and rewrite their daily rollups
+
+    `daily_counts` accumulates (user id, day, sentiment) counts across calls. Rollups are rewritten from it rather
+    than incremented with `rollups.record_mood_events`, since sqlite doesn't support the upsert that needs.
+    """
+    table = MoodEvent.__table__
+    for offset in range(current_size, target_size, INSERT_CHUNK_SIZE):
+        rows = [
+            {
+                'user_id': user.id,
+                'sentiment': random.choice(SENTIMENTS),
+                'latitude': 37.7749,
+                'longitude': -122.4194,
+                'date_created': START + timedelta(minutes=index),
+                'enrichment_status': 'enriched',
+            }
+            for index in range(offset, min(offset + INSERT_CHUNK_SIZE, target_size))
+        ]
+        session.execute(table.insert(), rows)
+        daily_counts.update((user.id, rollups.utc_day(row['date_created']), row['sentiment']) for row in rows)
+
+    session.execute(SentimentRollup.__table__.delete().where(SentimentRollup.user_id == user.id))
+    session.execute(SentimentRollup.__table__.insert(), [
+        {'user_id': user_id, 'day': day, 'sentiment': sentiment, 'count': count}
+        for (user_id, day, sentiment), count in daily_counts.items()
+    ])
+    session.commit()
+
+
+def measure(fn):
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(sizes):
+    create_tables()
+    user = User(email='bench@example.com', password='password')
+    session.add(user)
+    session.commit()
+
+    results = []
+    current_size = 0
+    daily_counts = Counter()
+    for size in sizes:
+        grow_history(user, current_size, size, daily_counts)
+        current_size = size
+
+        elapsed, peak = measure(lambda: insights.get_frequency_distribution(
+            created_before=START + timedelta(minutes=size),
+            created_after=START,
+            user=user
+        ))
+        result = {'events': size, 'insight': 'frequency_distribution', 'seconds': elapsed, 'peak_bytes': peak}
+
+        if engine.dialect.name == 'postgresql':
+            elapsed, peak = measure(lambda: insights.get_place_counts(user=user, sentiment='happy'))
+            results.append(result)
+            result = {'events': size, 'insight': 'place_counts', 'seconds': elapsed, 'peak_bytes': peak}
+
+        results.append(result)
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [1000, 10000, 100000, 1000000])
@@ -0,0 +1,339 @@
+"""
+Load test the API with a realistic mix of requests at fixed concurrency levels.
+
+Usage:
+    python -m benchmarks.bench_load [--concurrency 1,8,32] [--duration 30] [--places-latency 0.05] [--output FILE]
+
+Boots an app from `moody.app.create_app` on a local port and points the Places client at a stub server that answers nearby searches
+after a configurable delay, so results don't depend on Google. Each concurrency level runs that many virtual
+users for `--duration` seconds. Every virtual user signs up, gets a token, then loops over the request mix.
+
+Runs against DATABASE_URL, which must be a throwaway PostgreSQL database (tables are created if missing).
+Prints JSON with throughput and p50/p95/p99 latency (ms) per route and level, plus the git commit, so runs can
+be compared across commits.
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+import requests
+
+# Coordinates cluster around a few hotspots, like real users moving between home, work and a couple of favorites
+HOTSPOTS = [(37.7749, -122.4194), (37.7897, -122.3972), (37.7599, -122.4148), (37.8080, -122.4177)]
+HOTSPOT_SPREAD = 0.005
+PLACE_TYPES = ['cafe', 'park', 'gym', 'restaurant', 'library', 'shopping_mall', 'bar', 'school']
+SENTIMENTS = ['happy', 'sad', 'neutral']
+
+# Relative weights of each action in the request mix
+DEFAULT_MIX = {
+    'post_mood_event': 50,
+    'get_mood_events': 25,
+    'histograms': 8,
+    'place_types': 7,
+    'token': 7,
+    'signup': 3,
+}
+
+# Action name -> VirtualUser method
+ACTIONS = {
+    'post_mood_event': 'post_mood_event',
+    'get_mood_events': 'get_mood_events',
+    'histograms': 'histograms',
+    'place_types': 'place_types',
+    'token': 'get_token',
+    'signup': 'signup',
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def places_stub(latency, jitter, results):
+    """Return an HTTP server answering Places nearby searches with `results` deterministic places"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            latitude, longitude = (float(value) for value in query['location'][0].split(','))
+            time.sleep(max(0.0, random.gauss(latency, jitter)))
+
+            body = json.dumps({'status': 'OK', 'results': nearby_places(latitude, longitude, results)}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+
+
+def nearby_places(latitude, longitude, count):
+    """Places on a ~100m grid around the coordinates, so nearby searches share places like the real API"""
+    places = []
+    for number in range(count):
+        place_latitude = round(latitude, 3) + 0.0005 * (number % 3)
+        place_longitude = round(longitude, 3) + 0.0005 * (number // 3)
+        key = f'{place_latitude:.4f},{place_longitude:.4f}'
+        digest = hashlib.sha1(key.encode()).hexdigest()
+
+        places.append({
+            'place_id': f'stub-{digest[:16]}',
+            'name': f'Place {digest[:6]}',
+            'types': [PLACE_TYPES[int(digest[:2], 16) % len(PLACE_TYPES)], 'point_of_interest'],
+            'geometry': {'location': {'lat': place_latitude, 'lng': place_longitude}},
+        })
+
+    return places
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+class Recorder:
+    """Collects (route, latency, ok) samples from all virtual users"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def summary(self, duration):
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            routes[route] = {
+                'count': len(latencies),
+                'errors': self.errors.get(route, 0),
+                'throughput': round(len(latencies) / duration, 2),
+                'p50': round(percentile(latencies, 0.50) * 1000, 2),
+                'p95': round(percentile(latencies, 0.95) * 1000, 2),
+                'p99': round(percentile(latencies, 0.99) * 1000, 2),
+            }
+
+        total = sum(route['count'] for route in routes.values())
+        return {
+            'requests': total,
+            'errors': sum(route['errors'] for route in routes.values()),
+            'throughput': round(total / duration, 2),
+            'routes': routes,
+        }
+
+
+class VirtualUser:
+    """One simulated client with its own HTTP session and account"""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.http = requests.Session()
+        self.hotspots = random.sample(HOTSPOTS, 2)
+        self.token = None
+
+    def call(self, method, path, route, expected, **kwargs):
+        if self.token:
+            kwargs.setdefault('headers', {})['Authorization'] = f'Bearer {self.token}'
+
+        started_at = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, **kwargs)
+            ok = response.status_code == expected
+        except Exception:
+            response, ok = None, False
+        self.recorder.record(route, time.perf_counter() - started_at, ok)
+
+        return response if ok else None
+
+    def signup(self):
+        self.email = f'load-{uuid.uuid4().hex}@example.com'
+        self.password = 'load-test-password'
+        self.token = None
+        self.call('POST', '/users', 'POST /users', 201, json={
+            'first_name': 'Load',
+            'last_name': 'Test',
+            'email': self.email,
+            'password': self.password,
+        })
+        self.get_token()
+
+    def get_token(self):
+        self.token = None
+        response = self.call('POST', '/tokens', 'POST /tokens', 201, json={
+            'email': self.email,
+            'password': self.password,
+        })
+        if response is not None:
+            self.token = response.json()['data']
+
+    def post_mood_event(self):
+        latitude, longitude = random.choice(self.hotspots)
+        self.call('POST', '/mood_events', 'POST /mood_events', 201, json={
+            'sentiment': random.choice(SENTIMENTS),
+            'latitude': latitude + random.uniform(-HOTSPOT_SPREAD, HOTSPOT_SPREAD),
+            'longitude': longitude + random.uniform(-HOTSPOT_SPREAD, HOTSPOT_SPREAD),
+        })
+
+    def get_mood_events(self):
+        params = {'limit': 50}
+        if random.random() < 0.3:
+            params['sentiment'] = random.choice(SENTIMENTS)
+        self.call('GET', '/mood_events', 'GET /mood_events', 200, params=params)
+
+    def histograms(self):
+        self.call('GET', '/insights/histograms', 'GET /insights/histograms', 200, params={'tz': 'America/Los_Angeles'})
+
+    def place_types(self):
+        self.call('GET', '/insights/place-types', 'GET /insights/place-types', 200)
+
+    def run(self, actions, weights, deadline):
+        self.signup()
+        while time.monotonic() < deadline:
+            if self.token is None:
+                self.get_token()
+                continue
+            action = random.choices(actions, weights)[0]
+            getattr(self, ACTIONS[action])()
+
+
+def run_level(base_url, concurrency, duration, mix):
+    recorder = Recorder()
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+    deadline = time.monotonic() + duration
+
+    threads = [
+        threading.Thread(target=VirtualUser(base_url, recorder).run, args=(actions, weights, deadline), daemon=True)
+        for _ in range(concurrency)
+    ]
+    started_at = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started_at
+
+    return dict(concurrency=concurrency, duration=round(elapsed, 2), **recorder.summary(elapsed))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(value):
+    mix = dict(DEFAULT_MIX)
+    for item in value.split(','):
+        action, weight = item.split('=')
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(f'Unknown action {action!r}, expected one of {sorted(ACTIONS)}')
+        mix[action] = float(weight)
+    return {action: weight for action, weight in mix.items() if weight > 0}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,8,32',
+                        type=lambda value: [int(level) for level in value.split(',')],
+                        help='comma-separated numbers of virtual users, one run per level')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per concurrency level')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds of warmup at the first level, not reported')
+    parser.add_argument('--mix', type=parse_mix, default=dict(DEFAULT_MIX),
+                        help=f'action weights overriding the defaults, e.g. "signup=0,histograms=20" '
+                             f'(actions: {", ".join(ACTIONS)})')
+    parser.add_argument('--places-latency', type=float, default=0.05, help='mean stub Places latency in seconds')
+    parser.add_argument('--places-jitter', type=float, default=0.01, help='stddev of stub Places latency in seconds')
+    parser.add_argument('--places-results', type=int, default=5, help='places per stub nearby search')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write JSON results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    random.seed(args.seed)
+
+    if not os.environ.get('DATABASE_URL', '').startswith('postgres'):
+        sys.exit('DATABASE_URL must point to a throwaway PostgreSQL database.')
+
+    stub = places_stub(args.places_latency, args.places_jitter, args.places_results)
+    serve(stub)
+
+    # Config is read at import time, so the environment must be set before moody is imported
+    os.environ['GOOGLE_PLACES_URL'] = f'http://127.0.0.1:{stub.server_port}/nearbysearch/json'
+    os.environ.setdefault('GOOGLE_API_KEY', 'bench')
+    os.environ.setdefault('JWT_SECRET', 'bench')
+
+    from werkzeug.serving import make_server
+
+    from moody import db
+    from moody.app import create_app
+    from moody.models import Base
+
+    app = create_app()
+    Base.metadata.create_all(db.engine)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    serve(server)
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    if args.warmup:
+        run_level(base_url, args.concurrency[0], args.warmup, args.mix)
+
+    results = {
+        'commit': git_commit(),
+        'config': {
+            'duration': args.duration,
+            'mix': args.mix,
+            'places_latency': args.places_latency,
+            'places_jitter': args.places_jitter,
+            'places_results': args.places_results,
+            'seed': args.seed,
+        },
+        'levels': [run_level(base_url, level, args.duration, args.mix) for level in args.concurrency],
+    }
+
+    server.shutdown()
+    stub.shutdown()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
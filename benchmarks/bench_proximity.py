@@ -0,0 +1,55 @@
+"""
+Benchmark the vectorized proximity-to-place-type insight.
+
+Usage:
+    python -m benchmarks.bench_proximity [num_events] [num_places]
+
+Scores synthetic mood events against synthetic places around one city, without a database, and prints the time
+`insights.place_type_scores` takes as JSON.
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('GOOGLE_API_KEY', 'bench')
+os.environ.setdefault('JWT_SECRET', 'bench')
+
+from moody import insights  # noqa: E402
+
+CENTER = (37.7749, -122.4194)
+SPREAD = 0.05
+TYPES = ['home', 'office', 'park', 'shopping_mall', 'restaurant', 'gym', 'cafe', 'school']
+
+
+def main(num_events=100000, num_places=500):
+    rng = np.random.default_rng(0)
+
+    events = np.column_stack([
+        CENTER[0] + rng.uniform(-SPREAD, SPREAD, num_events),
+        CENTER[1] + rng.uniform(-SPREAD, SPREAD, num_events),
+        rng.choice([-1.0, 0.0, 1.0], num_events),
+    ])
+    place_coords = np.column_stack([
+        CENTER[0] + rng.uniform(-SPREAD, SPREAD, num_places),
+        CENTER[1] + rng.uniform(-SPREAD, SPREAD, num_places),
+    ])
+    place_types = [list(rng.choice(TYPES, 2, replace=False)) + ['establishment'] for _ in range(num_places)]
+
+    started_at = time.perf_counter()
+    scores = insights.place_type_scores(events, place_coords, place_types)
+    elapsed = time.perf_counter() - started_at
+
+    print(json.dumps({
+        'events': num_events,
+        'places': num_places,
+        'types': len(scores),
+        'seconds': elapsed,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
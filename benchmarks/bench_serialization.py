@@ -0,0 +1,94 @@
+"""
+Benchmark serializing a list of mood events: the previous per-request path against `moody.serialization`.
+
+Usage:
+    python -m benchmarks.bench_serialization [count] [repeat]
+
+e.g. `python -m benchmarks.bench_serialization 10000 5`
+
+The previous path builds a new `MoodEventSchema(many=True)` per request, nests the user in every event and encodes
+with `flask.jsonify`. The new path reuses a cached schema, hoists the user to the top level and encodes with
+`serialization.dumps`. No db is needed, events are built in memory.
+"""
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('GOOGLE_API_KEY', 'bench')
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+
+from flask import Flask, jsonify  # noqa: E402
+
+from moody import serialization  # noqa: E402
+from moody.models import MoodEvent, Place, User, place_type_cache  # noqa: E402
+from moody.schemas import MoodEventSchema, UserSchema  # noqa: E402
+
+SENTIMENTS = ['happy', 'sad', 'neutral']
+START = datetime(2017, 1, 1)
+
+
+def make_events(count):
+    user = User(email='bench@example.com', password='bench')
+    user.id = 1
+    # Known place types are named from memory, so no db is needed
+    place_type_cache.add(1, 'cafe')
+    place_type_cache.add(2, 'food')
+    place = Place(name='Cafe', type_ids=[1, 2], latitude=37.77, longitude=-122.42, place_id='bench')
+
+    events = []
+    for i in range(count):
+        event = MoodEvent(random.choice(SENTIMENTS), 37.7 + random.random() / 10, -122.4 + random.random() / 10)
+        event.user = user
+        event.date_created = START + timedelta(minutes=i)
+        event.places = [place]
+        events.append(event)
+
+    return user, events
+
+
+def previous_path(user, events):
+    response = jsonify({'data': MoodEventSchema(many=True).dump(events).data, 'status': 200})
+    return response.get_data()
+
+
+def new_path(user, events):
+    response = serialization.json_response({
+        'data': serialization.get_schema(MoodEventSchema, many=True, exclude=('user',)).dump(events).data,
+        'user': serialization.get_schema(UserSchema).dump(user).data,
+        'status': 200
+    })
+    return response.get_data()
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), len(body)
+
+
+def main(count=10000, repeat=5):
+    user, events = make_events(count)
+    app = Flask('moody')
+
+    results = {}
+    with app.test_request_context():
+        for name, fn in (('previous', previous_path), ('new', new_path)):
+            seconds, size = timed(lambda: fn(user, events), repeat)
+            results[name] = {'seconds': round(seconds, 4), 'bytes': size}
+
+    results['speedup'] = round(results['previous']['seconds'] / results['new']['seconds'], 2)
+    results['events'] = count
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
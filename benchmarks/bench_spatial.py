@@ -0,0 +1,73 @@
+"""
+Benchmark lookup latency of the in-process spatial index of places.
+
+Usage:
+    python -m benchmarks.bench_spatial [sizes...]
+
+e.g. `python -m benchmarks.bench_spatial 10000 100000 1000000`
+
+Places are scattered at random over a metro-sized area (~50km across), and lookups use the default search radius.
+Prints p50/p99 lookup latency and average result count per index size as JSON.
+"""
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ.setdefault('GOOGLE_API_KEY', 'bench')
+os.environ.setdefault('JWT_SECRET', 'bench')
+
+from moody.spatial import PlaceIndex  # noqa: E402
+
+CENTER = (37.7749, -122.4194)
+SPREAD = 0.25
+NUM_LOOKUPS = 10000
+
+
+def random_coord():
+    return CENTER[0] + random.uniform(-SPREAD, SPREAD), CENTER[1] + random.uniform(-SPREAD, SPREAD)
+
+
+def main(sizes):
+    random.seed(0)
+    results = []
+    for size in sizes:
+        index = PlaceIndex()
+        started_at = time.perf_counter()
+        for number in range(size):
+            latitude, longitude = random_coord()
+            index.add({
+                'place_id': str(number),
+                'name': str(number),
+                'types': ['establishment'],
+                'latitude': latitude,
+                'longitude': longitude,
+            })
+        build_seconds = time.perf_counter() - started_at
+
+        latencies = []
+        found = 0
+        for _ in range(NUM_LOOKUPS):
+            latitude, longitude = random_coord()
+            started_at = time.perf_counter()
+            found += len(index.nearby(latitude, longitude))
+            latencies.append(time.perf_counter() - started_at)
+
+        quantiles = statistics.quantiles(latencies, n=100)
+        results.append({
+            'places': size,
+            'build_seconds': build_seconds,
+            'p50_us': quantiles[49] * 1e6,
+            'p99_us': quantiles[98] * 1e6,
+            'avg_results': found / NUM_LOOKUPS,
+        })
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main([int(size) for size in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -1,44 +1,193 @@
 """
 Create flask app
+
+Nothing is initialized on import. `create_app` builds the engine, session, logging and handlers, so it can run in
+each worker after a preforking server forks, and tests can create apps with their own config.
+Background workers start on a worker's first request, never in a parent process that only forks.
+
+For servers and the Flask CLI, `moody.wsgi` exposes an app created from the environment:
+e.g. `gunicorn moody.wsgi:app` or `FLASK_APP=moody.wsgi flask rebuild-rollups`
 """
-from logging.handlers import RotatingFileHandler
 import logging
+import time
 
 from flask import Flask
 from flask_cors import CORS
 from marshmallow.exceptions import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
 
+from moody import config as settings
+from moody import auth, conditional, db, geo, logs, models, passwords
+from moody.commands import (
+    compact_encodings,
+    compute_insights,
+    export_mood_events,
+    maintain_partitions,
+    rebuild_rollups
+)
 from moody.routes import main
-from moody.db import session
-from moody.exceptions import UnauthorizedError
+from moody.enrichment import enrichment_queue
+from moody.metrics import metrics, stage_duration, start_request_timer, record_request
+from moody.exceptions import ServiceUnavailableError, UnauthorizedError
 from moody.handlers import (
     handle_custom_error,
     handle_general_error,
     handle_app_teardown,
-    handle_marshmallow_error
+    handle_marshmallow_error,
+    handle_request_started,
+    handle_request_finished,
+    handle_request_id,
+    handle_request_logged
 )
+from moody.spatial import place_index
+
+# Route label of startup timings in `moody.metrics`
+STARTUP = 'startup'
+
+logger = logging.getLogger(__name__)
+
+
+def create_app(config=None):
+    """
+    Create the app
+
+    `config` is a dict overriding values of `moody.config`, e.g. `create_app({'DATABASE_URL': 'sqlite://'})`.
+    The spatial index of places is loaded by `init_services`. With `PREWARM`, the connection pools are filled
+    before returning too (see `prewarm`).
+    The time it took is logged and kept in `app.config['COLD_START_SECONDS']`.
+    """
+    started_at = time.perf_counter()
+
+    configure(config or {})
+
+    app = Flask(__name__)
+    app.config.from_object(settings)
+
+    db.init_engine(settings.DATABASE_URL, settings.DATABASE_REPLICA_URLS)
+    init_logging(app)
+    init_services()
+
+    # Register routes from main blueprint
+    app.register_blueprint(main)
+
+    # Identify requests in logs and responses
+    app.before_request(handle_request_id)
+    app.after_request(handle_request_logged)
+
+    # Time requests and expose request/stage durations at /metrics
+    app.register_blueprint(metrics)
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+    # Register maintenance commands
+    app.cli.add_command(rebuild_rollups)
+    app.cli.add_command(export_mood_events)
+    app.cli.add_command(maintain_partitions)
+    app.cli.add_command(compact_encodings)
+    app.cli.add_command(compute_insights)
+
+    # Add handlers
+    app.register_error_handler(UnauthorizedError, handle_custom_error)
+    app.register_error_handler(ServiceUnavailableError, handle_custom_error)
+    app.register_error_handler(ValidationError, handle_marshmallow_error)
+    app.register_error_handler(Exception, handle_general_error)
+    app.teardown_appcontext_funcs.append(handle_app_teardown)
+
+    # Count queries per request and log the ones above thresholds
+    app.before_request(handle_request_started)
+    app.after_request(handle_request_finished)
+
+    # Add CORS
+    CORS(app)
+
+    # Start place enrichment workers in the process that serves requests
+    app.before_first_request(start_background_workers)
+
+    if settings.PREWARM:
+        prewarm(app)
+
+    elapsed = time.perf_counter() - started_at
+    stage_duration.observe(elapsed, STARTUP, 'create_app')
+    app.config['COLD_START_SECONDS'] = elapsed
+    app.logger.info('App created in %.1fms', elapsed * 1000)
+
+    return app
+
+
+def configure(overrides):
+    """Apply overrides to `moody.config`, then check required settings are set"""
+    unknown = [name for name in overrides if not hasattr(settings, name)]
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+
+    for name, value in overrides.items():
+        setattr(settings, name, value)
+
+    missing = [name for name in settings.REQUIRED if not getattr(settings, name)]
+    if missing:
+        raise RuntimeError(f"Missing required settings: {', '.join(missing)}")
+
+
+def init_logging(app):
+    """
+    Send records of the app's logger and of `moody.*` loggers through a new `moody.logs` pipeline
+
+    Flask's own handlers of `app.logger` write to stderr on the request thread, so they're replaced.
+    """
+    handler = logs.start_pipeline()
+
+    for logger in (logging.getLogger('moody'), app.logger):
+        logger.setLevel(settings.LOG_LEVEL)
+        for previous in list(logger.handlers):
+            if logger is app.logger or isinstance(previous, logs.NonBlockingQueueHandler):
+                logger.removeHandler(previous)
+        logger.addHandler(handler)
+
+
+def init_services():
+    """
+    Rebuild the module-level caches, clients and pools of the app from `moody.config`
+
+    They're created on import, before `configure` applies overrides, so they're sized again here.
+    Caches start out empty, except for the spatial index of places, which is loaded so the first requests of a
+    worker don't pay for it. If the db can't be read yet, it's loaded on first use instead.
+    """
+    passwords.hasher.configure()
+    auth.init_token_cache()
+    conditional.init_response_cache()
+    models.init_place_id_cache()
+    geo.init_places()
+    place_index.configure()
+    enrichment_queue.configure()
+
+    try:
+        place_index.refresh()
+    except SQLAlchemyError:
+        logger.warning('Could not load the spatial index of places, loading it on first use', exc_info=True)
+
+
+def start_background_workers():
+    enrichment_queue.start()
 
 
-app = Flask(__name__)
+def prewarm(app):
+    """
+    Open `PREWARM_CONNECTIONS` connections to the primary and each replica, and load places added to the db since
+    `init_services` loaded the spatial index
 
-# Register routes from main blueprint
-app.register_blueprint(main)
+    Call it after forking, e.g. from a server's post-fork hook, when the app is created in a parent process:
+    connections opened before a fork are discarded by the children.
+    """
+    started_at = time.perf_counter()
+    count = settings.PREWARM_CONNECTIONS or settings.DATABASE_POOL_SIZE
 
-# Add file logging
-file_handler = RotatingFileHandler('app.log', maxBytes=10000, backupCount=1)
-file_handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s '
-    '[in %(pathname)s:%(lineno)d]'
-))
-file_handler.setLevel(logging.WARNING)
-app.logger.addHandler(file_handler)
-app.logger.setLevel(logging.INFO)
+    for engine in [db.engine] + db.replicas.engines:
+        connections = [engine.connect() for _ in range(count)]
+        for connection in connections:
+            connection.close()
 
-# Add handlers
-app.register_error_handler(UnauthorizedError, handle_custom_error)
-app.register_error_handler(ValidationError, handle_marshmallow_error)
-app.register_error_handler(Exception, handle_general_error)
-app.teardown_appcontext_funcs.append(handle_app_teardown)
+    place_index.refresh()
 
-# Add CORS
-CORS(app)
+    elapsed = time.perf_counter() - started_at
+    stage_duration.observe(elapsed, STARTUP, 'prewarm')
+    app.logger.info('Prewarmed in %.1fms', elapsed * 1000)
@@ -1,41 +1,72 @@
 """Functions for handling authorization are defined here"""
 
 from functools import wraps
+import time
 
 from flask import request, g
+from sqlalchemy import event, inspect
 import arrow
 import jwt
 
-from moody.config import JWT_SECRET, JWT_DURATION, JWT_ISSUER
+from moody.cache import LRUCache
+from moody import config
+from moody.db import session
 from moody.exceptions import UnauthorizedError
+from moody.metrics import stage
+from moody.models import User
+
+# Validated token -> payload (including the resolved `user_id`). Entries never outlive the token itself.
+# Replaced by `init_token_cache`.
+token_cache = None
+
+# User id -> unix time before which tokens are rejected, set when a user's password changes in this process
+revoked_before = {}
+
+
+def init_token_cache():
+    """Create an empty `token_cache` sized by `AUTH_CACHE_SIZE` and `AUTH_CACHE_TTL`"""
+    global token_cache
+    token_cache = LRUCache(maxsize=config.AUTH_CACHE_SIZE, ttl=config.AUTH_CACHE_TTL)
+    return token_cache
+
+
+init_token_cache()
 
 
 def require_token(fn):
-    """Function used to decorate routes that require authorization."""
+    """
+    Function used to decorate routes that require authorization.
+
+    Sets `g.validated_token` and `g.user_id`. Tokens seen recently by this process are served from `token_cache`,
+    so authenticating a request usually touches neither the JWT library nor the db.
+    """
     @wraps(fn)
     def wrapped(*args, **kwargs):
-        token = get_token_from_request()
-        payload = decode_token(token)
+        with stage('auth'):
+            token = get_token_from_request()
+            payload = authenticate(token)
         g.validated_token = payload
+        g.user_id = payload['user_id']
 
         return fn(*args, **kwargs)
     return wrapped
 
 
-def create_token(user, duration=JWT_DURATION):
+def create_token(user, duration=None):
     """Encode and sign a authorization token for user"""
 
     issued_at = arrow.utcnow()
-    expires_at = issued_at.shift(seconds=duration)
+    expires_at = issued_at.shift(seconds=config.JWT_DURATION if duration is None else duration)
 
     payload = {
+        'user_id': user.id,
         'email': user.email,
-        'iss': JWT_ISSUER,
+        'iss': config.JWT_ISSUER,
         'iat': issued_at.datetime,
         'exp': expires_at.datetime,
     }
 
-    token = jwt.encode(payload, JWT_SECRET, algorithm='HS256').decode()
+    token = jwt.encode(payload, config.JWT_SECRET, algorithm='HS256').decode()
 
     return token
 
@@ -56,8 +87,66 @@ def get_token_from_request():
 
 def decode_token(token):
     try:
-        payload = jwt.decode(token.encode('utf-8'), JWT_SECRET)
+        payload = jwt.decode(token.encode('utf-8'), config.JWT_SECRET)
     except jwt.exceptions.InvalidTokenError as error:
         raise UnauthorizedError(str(error))
 
     return payload
+
+
+def authenticate(token):
+    """
+    Return the payload of a valid token, with `user_id` resolved.
+
+    On a cache miss, the token is decoded and its user is checked against the db once: the user must still exist
+    and the token must be issued after their last password change. `iat` only has second precision, so a
+    token issued in the same second as the change is rejected too. The result is then cached for up to
+    `AUTH_CACHE_TTL` seconds, or until the token expires if that's sooner. Tokens issued before `user_id` was
+    added to the payload are resolved by email.
+    """
+    payload = token_cache.get(token)
+
+    if payload is None:
+        payload = decode_token(token)
+
+        if 'user_id' in payload:
+            criterion = User.id == payload['user_id']
+        else:
+            criterion = User.email == payload['email']
+
+        user = session.query(User.id, User.date_password_changed).filter(criterion).one_or_none()
+
+        if user is None:
+            raise UnauthorizedError("User no longer exists.")
+
+        if user.date_password_changed and payload['iat'] <= int(user.date_password_changed.timestamp()):
+            raise UnauthorizedError("Token was issued before the password was last changed.")
+
+        payload = dict(payload, user_id=user.id)
+        token_cache.set(token, payload, ttl=min(config.AUTH_CACHE_TTL, payload['exp'] - time.time()))
+
+    if payload['iat'] <= revoked_before.get(payload['user_id'], 0):
+        token_cache.delete(token)
+        raise UnauthorizedError("Token was issued before the password was last changed.")
+
+    return payload
+
+
+def current_user():
+    """Return the authenticated User, loading it at most once per request"""
+    if 'current_user' not in g:
+        g.current_user = User.query.get(g.user_id)
+
+    return g.current_user
+
+
+def invalidate_user(user_id):
+    """Reject tokens issued to a user up until now, e.g. after their password changes"""
+    revoked_before[user_id] = int(time.time())
+
+
+@event.listens_for(User, 'after_update')
+def invalidate_user_on_password_change(mapper, connection, target):
+    """Invalidate cached tokens of users whose password was changed"""
+    if inspect(target).attrs.date_password_changed.history.has_changes():
+        invalidate_user(target.id)
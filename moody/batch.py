@@ -0,0 +1,120 @@
+"""
+Batch computation of insights for every user is defined here.
+
+Users whose insights are missing or stale are split into shards of consecutive ids, and shards are computed on a
+pool of processes. Each process creates its own engine and session (see `init_worker`), reads from replicas when
+they're configured, and writes a shard's results to `user_insights` with a single upsert. Shards share nothing
+but the db, so throughput grows with the number of processes until the db saturates.
+
+Each shard is committed as a whole. Users whose stored insights were computed from their current `data_version`
+over the same time range are skipped, so running the job again after an interruption or a failed shard resumes
+with the users that are left.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, or_
+from sqlalchemy.dialects.postgresql import insert
+
+from moody import config, db, insights
+from moody.db import reading_from_replica, session
+from moody.models import User, UserInsights
+
+
+def time_range(days=None, now=None):
+    """Return (created_after, created_before) spanning the last `days` (default: `INSIGHTS_DAYS`) whole UTC days"""
+    days = config.INSIGHTS_DAYS if days is None else days
+    created_before = insights.start_of_day(insights.as_utc(now or datetime.now(timezone.utc)))
+    return created_before - timedelta(days=days), created_before
+
+
+def pending_user_ids(created_after, created_before, force=False):
+    """Return ids of users whose insights are missing or stale (all users if `force`), in order"""
+    query = session.query(User.id).outerjoin(UserInsights, UserInsights.user_id == User.id)
+
+    if not force:
+        query = query.filter(or_(
+            UserInsights.user_id.is_(None),
+            UserInsights.data_version != User.data_version,
+            UserInsights.created_after != created_after,
+            UserInsights.created_before != created_before,
+        ))
+
+    try:
+        return [row.id for row in query.order_by(User.id)]
+    finally:
+        session.remove()
+
+
+def shards(user_ids, shard_size=None):
+    shard_size = shard_size or config.INSIGHTS_SHARD_SIZE
+    return [user_ids[start:start + shard_size] for start in range(0, len(user_ids), shard_size)]
+
+
+def init_worker():
+    """Give a worker process its own engine, since pooled connections can't be shared across processes"""
+    db.init_engine()
+
+
+def compute_shard(user_ids, created_after, created_before):
+    """
+    Compute insights of a shard of users and upsert them in one transaction. Return the number of users computed.
+
+    Frequency distributions of the whole shard are read with a few grouped queries (see
+    `insights.get_frequency_distributions`). Versions are read first, so a stored version is never newer than the
+    data its insights were computed from.
+    """
+    try:
+        with reading_from_replica():
+            users = session.query(User.id, User.data_version).filter(User.id.in_(user_ids)).all()
+            distributions = insights.get_frequency_distributions(
+                [user.id for user in users], created_after, created_before
+            )
+            rows = [
+                {
+                    'user_id': user.id,
+                    'data_version': user.data_version,
+                    'created_after': created_after,
+                    'created_before': created_before,
+                    'frequency_distribution': dict(distributions[user.id]),
+                    'place_type_scores': insights.get_place_type_scores(user),
+                }
+                for user in users
+            ]
+
+        if rows:
+            table = UserInsights.__table__
+            statement = insert(table).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.user_id],
+                set_=dict(
+                    {name: statement.excluded[name] for name in rows[0] if name != 'user_id'},
+                    date_computed=func.now()
+                )
+            )
+            session.execute(statement)
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
+
+    return len(rows)
+
+
+def compute(user_ids, created_after, created_before, workers=None, shard_size=None):
+    """
+    Compute insights of users in shards of `shard_size` on a pool of `workers` processes. They default to
+    `INSIGHTS_SHARD_SIZE` and `INSIGHTS_WORKERS`.
+
+    Yield (user ids of a shard, exception or None) as shards finish. A failed shard doesn't stop the others.
+    """
+    with ProcessPoolExecutor(max_workers=workers or config.INSIGHTS_WORKERS, initializer=init_worker) as executor:
+        futures = {
+            executor.submit(compute_shard, shard, created_after, created_before): shard
+            for shard in shards(user_ids, shard_size)
+        }
+        for future in as_completed(futures):
+            yield futures[future], future.exception()
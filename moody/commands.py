@@ -0,0 +1,98 @@
+"""
+Maintenance commands for the Flask CLI are defined here.
+
+e.g. `FLASK_APP=moody.wsgi flask rebuild-rollups`, `FLASK_APP=moody.wsgi flask export-mood-events 1 -f csv`,
+`FLASK_APP=moody.wsgi flask maintain-partitions`, `FLASK_APP=moody.wsgi flask compute-insights --workers 8`
+"""
+import time
+
+import arrow
+import click
+
+from moody import batch, export, migrations, partitions, rollups
+
+
+def parse_datetime(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return arrow.get(value).datetime
+    except (arrow.parser.ParserError, ValueError):
+        raise click.BadParameter(f'Must be an ISO 8601 datetime (given: {value}).')
+
+
+@click.command('rebuild-rollups')
+@click.option('--user-id', type=int, default=None, help='Only rebuild rollups of this user.')
+def rebuild_rollups(user_id):
+    """Rebuild sentiment rollups from mood events"""
+    rollups.rebuild(user_id=user_id)
+    click.echo('Rebuilt rollups for ' + (f'user {user_id}' if user_id is not None else 'all users'))
+
+
+@click.command('export-mood-events')
+@click.argument('user_id', type=int)
+@click.option('--format', '-f', 'format', type=click.Choice(list(export.FORMATS)), default='ndjson',
+              help='Output format. parquet and arrow need pyarrow.')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file, stdout by default.')
+@click.option('--created-after', callback=parse_datetime, help='Only export mood events since then (ISO 8601).')
+@click.option('--created-before', callback=parse_datetime, help='Only export mood events until then (ISO 8601).')
+def export_mood_events(user_id, format, output, created_after, created_before):
+    """Stream a user's complete mood history to a file"""
+    if format not in export.available_formats():
+        raise click.UsageError(f'Format {format} requires pyarrow to be installed.')
+
+    for chunk in export.export_mood_events(user_id, format, created_after, created_before):
+        output.write(chunk)
+
+
+@click.command('maintain-partitions')
+@click.option('--convert', is_flag=True,
+              help='Partition mood_events first if it isn\'t. The table is locked while its rows are copied.')
+def maintain_partitions(convert):
+    """Create upcoming monthly partitions of mood events and archive old ones"""
+    if not partitions.is_partitioned():
+        if not convert:
+            raise click.UsageError('mood_events is not partitioned. Run with --convert to partition it first.')
+        partitions.convert()
+        click.echo('Partitioned mood_events')
+
+    created, archived = partitions.maintain()
+    click.echo(f"Created partitions: {', '.join(created) or 'none'}")
+    click.echo(f"Archived partitions: {', '.join(archived) or 'none'}")
+
+
+@click.command('compact-encodings')
+def compact_encodings():
+    """Migrate sentiments to small ints and place types to the place_types dictionary"""
+    migrated = migrations.compact_encodings()
+    click.echo(f"Migrated: {', '.join(migrated) or 'nothing, already up to date'}")
+
+
+@click.command('compute-insights')
+@click.option('--workers', type=int, help='Number of processes. Defaults to INSIGHTS_WORKERS.')
+@click.option('--shard-size', type=int, help='Users per shard. Defaults to INSIGHTS_SHARD_SIZE.')
+@click.option('--days', type=int,
+              help='Frequency distributions cover this many whole UTC days, up to today. Defaults to INSIGHTS_DAYS.')
+@click.option('--force', is_flag=True, help='Recompute insights that are up to date too.')
+def compute_insights(workers, shard_size, days, force):
+    """Precompute insights of every user into user_insights, resuming where a previous run stopped"""
+    created_after, created_before = batch.time_range(days)
+    user_ids = batch.pending_user_ids(created_after, created_before, force=force)
+    click.echo(f'Computing insights of {len(user_ids)} users, '
+               f'from {created_after:%Y-%m-%d} to {created_before:%Y-%m-%d}')
+
+    started_at = time.monotonic()
+    failed = 0
+    with click.progressbar(length=len(user_ids), label='Users') as bar:
+        for shard, error in batch.compute(user_ids, created_after, created_before, workers, shard_size):
+            if error is not None:
+                failed += len(shard)
+                click.echo(f'\nShard of users {shard[0]}-{shard[-1]} failed: {error!r}', err=True)
+            bar.update(len(shard))
+
+    elapsed = time.monotonic() - started_at
+    computed = len(user_ids) - failed
+    click.echo(f'Computed insights of {computed} users in {elapsed:.1f}s ({computed / max(elapsed, 1e-9):.0f} users/s)')
+
+    if failed:
+        raise click.ClickException(f'{failed} users failed. Run the command again to retry them.')
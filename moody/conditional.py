@@ -0,0 +1,84 @@
+"""
+Conditional GET and the per-user response cache of read routes are defined here.
+
+Every user has a `data_version` that write paths bump in the transaction that changes their data. Read routes
+decorated with `conditional_get` derive a strong ETag from (user, route, query, version, content encoding), answer
+a matching `If-None-Match` with 304, and otherwise serve encoded responses from `response_cache` while the version
+holds. Gzipped and plain bodies are different representations, so they never share a tag.
+An unchanged poll costs one primary key lookup of the version and, without an ETag, one cache lookup.
+"""
+from functools import wraps
+import hashlib
+import json
+
+from flask import current_app, g, make_response, request
+
+from moody import config
+from moody.cache import LRUCache
+from moody.models import User
+
+# (user id, endpoint, query, version, content encoding) -> (body, headers) of a 200 response.
+# Replaced by `init_response_cache`.
+response_cache = None
+
+# Response headers kept with cached bodies
+CACHED_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary')
+
+
+def init_response_cache():
+    """Create an empty `response_cache` holding up to `RESPONSE_CACHE_SIZE` responses"""
+    global response_cache
+    response_cache = LRUCache(maxsize=config.RESPONSE_CACHE_SIZE)
+    return response_cache
+
+
+init_response_cache()
+
+
+def conditional_get(fn):
+    """
+    Decorate GET routes of the authenticated user's data with ETags, 304s and response caching
+
+    The user's version is read before the route runs, through the same session, so a cached body is never older
+    than the version it's stored under.
+    """
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        version = User.get_data_version(g.user_id)
+        query = sorted(request.args.items(multi=True))
+        encoding = preferred_encoding()
+        etag = hashlib.sha1(
+            json.dumps([g.user_id, request.endpoint, query, version, encoding]).encode('utf-8')
+        ).hexdigest()
+
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+            response.set_etag(etag)
+            return response
+
+        key = (g.user_id, request.endpoint, tuple(query), version, encoding)
+        cached = response_cache.get(key)
+
+        if cached is None:
+            response = make_response(fn(*args, **kwargs))
+            body = response.get_data()
+            if response.status_code == 200 and len(body) <= config.RESPONSE_CACHE_MAX_BODY:
+                headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+                response_cache.set(key, (body, headers))
+        else:
+            body, headers = cached
+            response = current_app.response_class(body, status=200, headers=headers)
+
+        response.set_etag(etag)
+        return response
+    return wrapped
+
+
+def preferred_encoding():
+    """Content encoding `serialization.json_response` picks for this request, which cached bodies depend on"""
+    accepted = request.accept_encodings
+    if accepted['gzip']:
+        return 'gzip'
+    if accepted['deflate']:
+        return 'deflate'
+    return 'identity'
@@ -1,9 +1,148 @@
-"""Configuration and secret values are defined here"""
+"""
+Configuration and secret values are defined here
+
+Values are read from the environment on import, but nothing is required until `moody.app.create_app` runs,
+which checks `REQUIRED` and can override any value here. Modules read values from this module when they use them
+(`config.X`, never `from moody.config import X`), so overrides apply everywhere.
+"""
 import os
 
 DEBUG = os.environ.get('DEBUG', False)
-DATABASE_URL = os.environ['DATABASE_URL']
-GOOGLE_API_KEY = os.environ['GOOGLE_API_KEY']
-JWT_SECRET = os.environ['JWT_SECRET']
+DATABASE_URL = os.environ.get('DATABASE_URL')
+# Comma separated URLs of read replicas. Read-only routes and insights are served from them when set (see moody.db)
+DATABASE_REPLICA_URLS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
+JWT_SECRET = os.environ.get('JWT_SECRET')
 JWT_ISSUER = os.environ.get('JWT_ISSUER', 'moody')
 JWT_DURATION = os.environ.get('JWT_DURATION', 86400)
+
+# Settings the app refuses to start without
+REQUIRED = ('DATABASE_URL', 'GOOGLE_API_KEY', 'JWT_SECRET')
+
+# Logs are written as JSON lines by a background thread (see moody.logs): LOG_LEVEL and up to stdout if LOG_STDOUT,
+# and LOG_FILE_LEVEL and up to LOG_FILE, rotated at LOG_MAX_BYTES. Set LOG_FILE to an empty string to disable file
+# logging. Records are dropped rather than blocking once LOG_QUEUE_SIZE of them are waiting to be written.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_STDOUT = os.environ.get('LOG_STDOUT', 'true').lower() in ('1', 'true', 'yes')
+LOG_FILE = os.environ.get('LOG_FILE', 'app.log')
+LOG_FILE_LEVEL = os.environ.get('LOG_FILE_LEVEL', 'WARNING')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Every request is logged with its route, status and duration if LOG_REQUESTS
+LOG_REQUESTS = os.environ.get('LOG_REQUESTS', 'true').lower() in ('1', 'true', 'yes')
+# Tracebacks of the same exception (type and line it was raised from) are logged at most LOG_EXCEPTION_BURST times
+# per LOG_EXCEPTION_WINDOW seconds. The number suppressed is logged with the next one.
+LOG_EXCEPTION_BURST = int(os.environ.get('LOG_EXCEPTION_BURST', 5))
+LOG_EXCEPTION_WINDOW = float(os.environ.get('LOG_EXCEPTION_WINDOW', 60))
+
+# Validated tokens and their users are cached in-process for this many seconds (see moody.auth)
+AUTH_CACHE_SIZE = int(os.environ.get('AUTH_CACHE_SIZE', 10000))
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60))
+
+# bcrypt work factor, and the bounded pool that password hashing/verification runs on (see moody.passwords).
+# Requests are rejected with a 503 once BCRYPT_WORKERS + BCRYPT_QUEUE_SIZE operations are in progress.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+BCRYPT_WORKERS = int(os.environ.get('BCRYPT_WORKERS', 2))
+BCRYPT_QUEUE_SIZE = int(os.environ.get('BCRYPT_QUEUE_SIZE', 8))
+BCRYPT_TIMEOUT = float(os.environ.get('BCRYPT_TIMEOUT', 5.0))
+
+# Maximum number of mood events accepted by POST /mood_events/batch
+MOOD_EVENTS_BATCH_LIMIT = int(os.environ.get('MOOD_EVENTS_BATCH_LIMIT', 1000))
+
+# Page size of GET /mood_events, and the most a client can ask for with `limit`
+MOOD_EVENTS_PAGE_SIZE = int(os.environ.get('MOOD_EVENTS_PAGE_SIZE', 100))
+MOOD_EVENTS_MAX_PAGE_SIZE = int(os.environ.get('MOOD_EVENTS_MAX_PAGE_SIZE', 500))
+
+# Connection pool of each engine (primary and every replica). Ignored for sqlite.
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+DATABASE_POOL_TIMEOUT = float(os.environ.get('DATABASE_POOL_TIMEOUT', 30))
+DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))
+DATABASE_POOL_PRE_PING = os.environ.get('DATABASE_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+
+# With PREWARM, create_app opens PREWARM_CONNECTIONS (default: DATABASE_POOL_SIZE) connections per engine up front,
+# so a freshly started worker doesn't pay for them on its first requests. The spatial index of places is always
+# loaded at startup
+PREWARM = os.environ.get('PREWARM', 'false').lower() in ('1', 'true', 'yes')
+PREWARM_CONNECTIONS = int(os.environ['PREWARM_CONNECTIONS']) if os.environ.get('PREWARM_CONNECTIONS') else None
+
+# A replica that fails is skipped, and reads fall back to the primary, for REPLICA_RETRY_INTERVAL seconds.
+# Replicas are probed at most every REPLICA_CHECK_INTERVAL seconds, and connecting to one gives up after
+# REPLICA_CONNECT_TIMEOUT seconds.
+REPLICA_RETRY_INTERVAL = float(os.environ.get('REPLICA_RETRY_INTERVAL', 30))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+
+# Requests issuing more than SLOW_REQUEST_QUERIES queries or spending more than SLOW_REQUEST_DB_TIME seconds in the db
+# are logged, as are statements repeated N_PLUS_ONE_THRESHOLD or more times in one request (see moody.db)
+SLOW_REQUEST_QUERIES = int(os.environ.get('SLOW_REQUEST_QUERIES', 20))
+SLOW_REQUEST_DB_TIME = float(os.environ.get('SLOW_REQUEST_DB_TIME', 0.5))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+
+# Encoded responses of read routes are cached per user and data version (see moody.conditional).
+# Bodies larger than RESPONSE_CACHE_MAX_BODY bytes aren't cached.
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1000))
+RESPONSE_CACHE_MAX_BODY = int(os.environ.get('RESPONSE_CACHE_MAX_BODY', 256 * 1024))
+
+# Exports stream this many mood events per chunk from a server-side cursor (see moody.export)
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+
+# mood_events is partitioned by month of `date_created` (see moody.partitions). Maintenance keeps partitions
+# PARTITION_MONTHS_AHEAD months ahead, and archives partitions older than the last PARTITION_HOT_MONTHS months
+# (current month included) to the PARTITION_ARCHIVE_SCHEMA schema, and to PARTITION_ARCHIVE_TABLESPACE if set.
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+PARTITION_HOT_MONTHS = int(os.environ.get('PARTITION_HOT_MONTHS', 12))
+PARTITION_ARCHIVE_SCHEMA = os.environ.get('PARTITION_ARCHIVE_SCHEMA', 'archive')
+PARTITION_ARCHIVE_TABLESPACE = os.environ.get('PARTITION_ARCHIVE_TABLESPACE')
+
+# JSON responses of at least COMPRESSION_MIN_SIZE bytes are gzip/deflate compressed when the client accepts it
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 4096))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', 5))
+
+# Outbound Places API client. The timeout is a (connect, read) pair in seconds.
+GOOGLE_PLACES_URL = os.environ.get('GOOGLE_PLACES_URL', 'https://maps.googleapis.com/maps/api/place/nearbysearch/json')
+GOOGLE_PLACES_TIMEOUT = (
+    float(os.environ.get('GOOGLE_PLACES_CONNECT_TIMEOUT', 1.0)),
+    float(os.environ.get('GOOGLE_PLACES_READ_TIMEOUT', 2.0)),
+)
+GOOGLE_PLACES_POOL_SIZE = int(os.environ.get('GOOGLE_PLACES_POOL_SIZE', 10))
+GOOGLE_PLACES_RATE = float(os.environ.get('GOOGLE_PLACES_RATE', 50))
+GOOGLE_PLACES_BURST = int(os.environ.get('GOOGLE_PLACES_BURST', 100))
+GOOGLE_PLACES_BREAKER_THRESHOLD = int(os.environ.get('GOOGLE_PLACES_BREAKER_THRESHOLD', 5))
+GOOGLE_PLACES_BREAKER_RESET = float(os.environ.get('GOOGLE_PLACES_BREAKER_RESET', 30))
+
+# Places lookups are cached per grid cell. The cell size (meters) matches the 100m search radius.
+GEO_CELL_SIZE = int(os.environ.get('GEO_CELL_SIZE', 100))
+GEO_CACHE_SIZE = int(os.environ.get('GEO_CACHE_SIZE', 10000))
+GEO_CACHE_TTL = int(os.environ.get('GEO_CACHE_TTL', 86400))
+# Redis URL (e.g. redis://cache:6379/0) of a cache tier shared by every process, behind the in-process one.
+# Requires the redis package. Unset, each process only has its own cache.
+PLACES_CACHE_URL = os.environ.get('PLACES_CACHE_URL')
+
+# Number of Google place ids whose primary key is kept in memory (see Place.get_or_create_many)
+PLACE_ID_CACHE_SIZE = int(os.environ.get('PLACE_ID_CACHE_SIZE', 100000))
+
+# Places within this many meters of a mood event are associated with it
+PLACES_SEARCH_RADIUS = int(os.environ.get('PLACES_SEARCH_RADIUS', 100))
+
+# Mood events within this many meters of a place count towards its place types in proximity insights
+PROXIMITY_RADIUS = int(os.environ.get('PROXIMITY_RADIUS', 200))
+
+# Known places are kept in an in-process spatial index (see moody.spatial). The Google Places API is only queried
+# when fewer than PLACES_LOCAL_MIN_RESULTS known places are within the search radius.
+PLACES_LOCAL_MIN_RESULTS = int(os.environ.get('PLACES_LOCAL_MIN_RESULTS', 3))
+SPATIAL_INDEX_CELL_SIZE = int(os.environ.get('SPATIAL_INDEX_CELL_SIZE', 100))
+SPATIAL_INDEX_REFRESH = int(os.environ.get('SPATIAL_INDEX_REFRESH', 60))
+
+# Places are attached to new mood events asynchronously by a pool of workers (see moody.enrichment)
+ENRICHMENT_WORKERS = int(os.environ.get('ENRICHMENT_WORKERS', 4))
+ENRICHMENT_BATCH_SIZE = int(os.environ.get('ENRICHMENT_BATCH_SIZE', 50))
+ENRICHMENT_MAX_ATTEMPTS = int(os.environ.get('ENRICHMENT_MAX_ATTEMPTS', 5))
+ENRICHMENT_BACKOFF = float(os.environ.get('ENRICHMENT_BACKOFF', 1.0))
+
+# The batch insights job (see moody.batch) computes shards of INSIGHTS_SHARD_SIZE users on INSIGHTS_WORKERS processes,
+# one per CPU by default. Frequency distributions cover the last INSIGHTS_DAYS whole UTC days.
+INSIGHTS_WORKERS = int(os.environ.get('INSIGHTS_WORKERS', os.cpu_count() or 1))
+INSIGHTS_SHARD_SIZE = int(os.environ.get('INSIGHTS_SHARD_SIZE', 200))
+INSIGHTS_DAYS = int(os.environ.get('INSIGHTS_DAYS', 30))
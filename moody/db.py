@@ -1,29 +1,317 @@
-"""Database"""
+"""
+Database
+
+Engines are created by `init_engine`, which `moody.app.create_app` calls, rather than on import. Pooled connections
+remember the process that opened them and are discarded when checked out in another one, so an app created
+before a preforking server forks its workers never shares connections between processes.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import itertools
+import logging
+import os
+import threading
 import time
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+
+from moody import config
+
+logger = logging.getLogger(__name__)
+
+
+def make_engine(url, connect_timeout=None):
+    """
+    Create an engine with the pool settings of `moody.config` at the time of the call
+
+    `connect_timeout` bounds, in seconds, how long opening a connection may block, e.g. on a replica that stopped
+    answering. By default the driver waits as long as the OS does.
+    """
+    options = {'echo': config.DEBUG}
+    if not url.startswith('sqlite'):
+        options.update(
+            pool_size=config.DATABASE_POOL_SIZE,
+            max_overflow=config.DATABASE_MAX_OVERFLOW,
+            pool_timeout=config.DATABASE_POOL_TIMEOUT,
+            pool_recycle=config.DATABASE_POOL_RECYCLE,
+            pool_pre_ping=config.DATABASE_POOL_PRE_PING,
+        )
+        if connect_timeout:
+            options['connect_args'] = {'connect_timeout': connect_timeout}
+
+    engine = create_engine(url, **options)
+    event.listen(engine, 'connect', _remember_pid)
+    event.listen(engine, 'checkout', _check_pid)
+
+    return engine
+
+
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    """Discard connections inherited from a parent process, without closing the parent's socket"""
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection belongs to process {connection_record.info['pid']}, not {os.getpid()}"
+        )
+
+
+class ReplicaSet:
+    """
+    Read replicas, handed out round robin, skipping the ones that are down
+
+    A replica is marked down when a connection to it fails, and is probed again after `retry_interval` seconds.
+    Replicas are probed with a checkout at most every `check_interval` seconds, so a dead replica is noticed
+    before a request uses it rather than failing that request. Probes run on the request thread: replica engines
+    are created with `REPLICA_CONNECT_TIMEOUT` so a replica that stopped answering can't hang it.
+    """
+
+    def __init__(self, engines, retry_interval=None, check_interval=None, clock=time.monotonic):
+        self.engines = engines
+        self.retry_interval = config.REPLICA_RETRY_INTERVAL if retry_interval is None else retry_interval
+        self.check_interval = config.REPLICA_CHECK_INTERVAL if check_interval is None else check_interval
+        self.clock = clock
+        self._down_until = {}
+        self._checked_at = {}
+        self._next = itertools.cycle(range(len(engines)))
+        self._lock = threading.Lock()
+
+        for replica in engines:
+            event.listen(replica, 'handle_error', self._on_error)
+
+    def choose(self):
+        """Return a healthy replica engine, or None when all of them are down"""
+        for _ in range(len(self.engines)):
+            with self._lock:
+                replica = self.engines[next(self._next)]
+            if self.is_available(replica):
+                return replica
+
+        return None
+
+    def is_available(self, replica):
+        now = self.clock()
+        if self._down_until.get(replica, 0) > now:
+            return False
+
+        if now - self._checked_at.get(replica, float('-inf')) >= self.check_interval:
+            self._checked_at[replica] = now
+            try:
+                with replica.connect():
+                    pass
+            except DBAPIError as error:
+                self.mark_down(replica, error)
+                return False
+
+        return True
+
+    def mark_down(self, replica, error=None):
+        logger.warning('Replica %r is down, reading from the primary for %ss: %s',
+                       replica.url, self.retry_interval, error)
+        self._down_until[replica] = self.clock() + self.retry_interval
+
+    def _on_error(self, context):
+        # No connection means connecting itself failed
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine, context.original_exception)
+
+
+_routing = threading.local()
+
+
+@contextmanager
+def reading_from_replica():
+    """Route reads in the enclosed block to a read replica, when one is configured and up"""
+    previous = getattr(_routing, 'read_only', False)
+    _routing.read_only = True
+    try:
+        yield
+    finally:
+        _routing.read_only = previous
+
+
+def read_only(fn):
+    """Decorate routes that only read, so their queries are served by read replicas"""
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        with reading_from_replica():
+            return fn(*args, **kwargs)
+    return wrapped
+
+
+class RoutingSession(Session):
+    """
+    Session sending reads inside `reading_from_replica` to a replica, and everything else to the primary
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary. A session sticks to the replica it
+    picked first until it's removed (at the end of each request), so a request reads from a single snapshot.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if getattr(_routing, 'read_only', False) and replicas.engines and not self._flushing \
+                and not isinstance(clause, UpdateBase):
+            replica = self.info.get('replica') or replicas.choose()
+            if replica is not None:
+                self.info['replica'] = replica
+                return replica
+
+        return super().get_bind(mapper=mapper, clause=clause)
+
+
+# Set by `init_engine`
+engine = None
+
+replicas = ReplicaSet([])
+
+session = scoped_session(sessionmaker(autocommit=False, autoflush=False, class_=RoutingSession))
+
+
+def init_engine(url=None, replica_urls=None):
+    """
+    Create the primary and replica engines, and bind the session to the primary
+
+    `url` and `replica_urls` default to `DATABASE_URL` and `DATABASE_REPLICA_URLS`. Calling it again replaces the
+    engines, e.g. in tests.
+    """
+    global engine, replicas
+
+    url = url or config.DATABASE_URL
+    if replica_urls is None:
+        replica_urls = config.DATABASE_REPLICA_URLS
+
+    engine = make_engine(url)
+    replicas = ReplicaSet([
+        make_engine(replica_url, connect_timeout=config.REPLICA_CONNECT_TIMEOUT)
+        for replica_url in replica_urls
+    ])
+
+    session.remove()
+    session.configure(bind=engine)
+
+    return engine
+
+
+def get_engine():
+    """Return the primary engine, creating it on first use"""
+    return engine or init_engine()
+
+
+class QueryStats:
+    """Queries issued by one thread while tracking is on, e.g. during one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements[statement] += 1
+
+    def repeated(self, threshold=None):
+        """Statements issued at least `threshold` times, most repeated first. These usually point to N+1 loading."""
+        threshold = config.N_PLUS_ONE_THRESHOLD if threshold is None else threshold
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+    def problems(self, max_queries=None, max_duration=None, n_plus_one_threshold=None):
+        """Return human readable reasons the tracked queries are worth a look, if any. Thresholds default to config."""
+        max_queries = config.SLOW_REQUEST_QUERIES if max_queries is None else max_queries
+        max_duration = config.SLOW_REQUEST_DB_TIME if max_duration is None else max_duration
+        problems = []
+        if self.count > max_queries:
+            problems.append(f'{self.count} queries (threshold: {max_queries})')
+        if self.duration > max_duration:
+            problems.append(f'{self.duration:.3f}s in db (threshold: {max_duration}s)')
+        for statement, count in self.repeated(n_plus_one_threshold):
+            problems.append(f'possible N+1, statement issued {count} times: {" ".join(statement.split())}')
+        return problems
+
+
+_tracking = threading.local()
+
+
+def start_query_tracking():
+    """Start counting queries issued by the current thread, on any engine. Returns the QueryStats."""
+    _tracking.stats = QueryStats()
+    return _tracking.stats
+
+
+def stop_query_tracking():
+    """Stop counting queries issued by the current thread, and return the QueryStats (None if tracking was off)"""
+    stats = getattr(_tracking, 'stats', None)
+    _tracking.stats = None
+    return stats
+
+
+@contextmanager
+def track_queries():
+    """Count queries issued by the current thread in the enclosed block, e.g. `with track_queries() as stats:`"""
+    previous = getattr(_tracking, 'stats', None)
+    stats = start_query_tracking()
+    try:
+        yield stats
+    finally:
+        _tracking.stats = previous
+
+
+@contextmanager
+def assert_max_queries(max_queries):
+    """
+    Test helper failing when the enclosed block issues more than `max_queries` queries, e.g.
+
+        with assert_max_queries(3):
+            client.get('/mood_events', headers=headers)
+    """
+    with track_queries() as stats:
+        yield stats
+
+    if stats.count > max_queries:
+        statements = '\n'.join(
+            f'{count}x {" ".join(statement.split())}'
+            for statement, count in stats.statements.most_common()
+        )
+        raise AssertionError(f'Expected at most {max_queries} queries, got {stats.count}:\n{statements}')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_tracking, 'stats', None) is not None:
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
 
-from moody.config import DATABASE_URL, DEBUG
 
-engine = create_engine(DATABASE_URL, echo=DEBUG)
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    started_at = conn.info.get('query_started_at')
+    if not started_at:
+        return
 
-session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+    duration = time.perf_counter() - started_at.pop()
+    stats = getattr(_tracking, 'stats', None)
+    if stats is not None:
+        stats.record(statement, duration)
 
 
 def create_tables():
     """Create tables"""
     from moody.models import Base
     test_connection()
-    Base.metadata.create_all(bind=engine)
+    Base.metadata.create_all(bind=get_engine())
 
 
 def drop_tables():
     """Drop tables"""
     from moody.models import Base
     test_connection()
-    Base.metadata.drop_all(bind=engine)
+    Base.metadata.drop_all(bind=get_engine())
 
 
 def test_connection(max_attempts=5, interval_secs=1.0):
@@ -35,7 +323,7 @@ def test_connection(max_attempts=5, interval_secs=1.0):
     num_attempts = 1
     while True:
         try:
-            with engine.connect():
+            with get_engine().connect():
                 return
 
         except OperationalError:
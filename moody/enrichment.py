@@ -0,0 +1,292 @@
+"""
+Asynchronous place enrichment of mood events is defined here.
+
+New mood events are persisted without places and enqueued by id. A pool of worker threads pulls ids off the
+queue in batches, resolves places near each event and attaches them through `mood_events_places`.
+Failed batches are retried with exponential backoff, and events that exhaust their attempts are marked as failed.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from moody import config, rollups
+from moody.db import session
+from moody.metrics import stage
+from moody.models import MoodEvent, Place, User, EnrichmentStatus, mood_events_places
+from moody.spatial import place_index, places_near
+
+logger = logging.getLogger(__name__)
+
+# Route label of enrichment stages in `moody.metrics`
+METRICS_ROUTE = 'enrichment'
+
+
+def enrich_mood_events(mood_event_ids):
+    """
+    Resolve and attach places for a batch of pending mood events
+
+    Places near each mood event come from the local spatial index when it covers the area, and from the
+    Google Places API otherwise (see `moody.spatial.places_near`). They're looked up before any row is locked, so a
+    slow Places API never holds locks or a transaction open. Events are then locked (skipping ones another worker
+    holds) and written in one short transaction: places for the whole batch are upserted with one
+    `Place.get_or_create_many` call, links are written to `mood_events_places` with one bulk insert, and counted
+    into place rollups.
+    """
+    place_index.refresh_if_stale()
+
+    try:
+        mood_events = session.query(
+            MoodEvent.id,
+            MoodEvent.user_id,
+            MoodEvent.sentiment,
+            MoodEvent.latitude,
+            MoodEvent.longitude
+        ).filter(
+            MoodEvent.id.in_(mood_event_ids),
+            MoodEvent.enrichment_status == EnrichmentStatus.PENDING
+        ).all()
+    finally:
+        session.remove()
+
+    mood_events = {mood_event.id: mood_event for mood_event in mood_events}
+    with stage('places_lookup', route=METRICS_ROUTE):
+        places_by_mood_event = {
+            mood_event.id: places_near(
+                latitude=mood_event.latitude,
+                longitude=mood_event.longitude
+            )
+            for mood_event in mood_events.values()
+        }
+
+    if not places_by_mood_event:
+        return
+
+    try:
+        # Events enriched or locked by another worker in the meantime are left to it
+        locked = session.query(MoodEvent.id).filter(
+            MoodEvent.id.in_(sorted(places_by_mood_event)),
+            MoodEvent.enrichment_status == EnrichmentStatus.PENDING
+        ).order_by(MoodEvent.id).with_for_update(skip_locked=True).all()
+        places_by_mood_event = {row.id: places_by_mood_event[row.id] for row in locked}
+
+        with stage('place_upserts', route=METRICS_ROUTE):
+            place_ids = Place.get_or_create_many([
+                place
+                for places in places_by_mood_event.values()
+                for place in places
+            ])
+
+        links = []
+        rollup_links = []
+        for mood_event_id, places in places_by_mood_event.items():
+            mood_event = mood_events[mood_event_id]
+            for place_pk in {place_ids[place['place_id']] for place in places}:
+                links.append({'mood_event_id': mood_event_id, 'place_id': place_pk})
+                rollup_links.append((mood_event.user_id, place_pk, mood_event.sentiment))
+
+        if links:
+            with stage('links', route=METRICS_ROUTE):
+                session.execute(mood_events_places.insert(), links)
+                rollups.record_places(rollup_links)
+
+        if places_by_mood_event:
+            # Places change the user's insights, see moody.conditional
+            User.bump_data_version(mood_events[mood_event_id].user_id for mood_event_id in places_by_mood_event)
+            MoodEvent.query.filter(MoodEvent.id.in_(list(places_by_mood_event))).update(
+                {MoodEvent.enrichment_status: EnrichmentStatus.ENRICHED},
+                synchronize_session=False
+            )
+
+        with stage('commit', route=METRICS_ROUTE):
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.remove()
+
+
+def mark_failed(mood_event_ids):
+    """Give up on enriching mood events"""
+    try:
+        MoodEvent.query.filter(
+            MoodEvent.id.in_(mood_event_ids),
+            MoodEvent.enrichment_status == EnrichmentStatus.PENDING
+        ).update({MoodEvent.enrichment_status: EnrichmentStatus.FAILED}, synchronize_session=False)
+        session.commit()
+    finally:
+        session.remove()
+
+
+def pending_mood_event_ids():
+    """Ids of mood events that still need enrichment, e.g. ones left behind by a restart"""
+    try:
+        rows = session.query(MoodEvent.id).filter(MoodEvent.enrichment_status == EnrichmentStatus.PENDING).all()
+        return [row.id for row in rows]
+    finally:
+        session.remove()
+
+
+class EnrichmentQueue:
+    """
+    Local work queue for place enrichment with a pool of worker threads.
+
+    Items are kept in a heap ordered by the time they become ready, which lets retries wait out their backoff
+    without holding up newer work. Workers take up to `batch_size` ready items at a time.
+    Settings left out default to the `ENRICHMENT_*` settings of `moody.config`.
+    """
+
+    def __init__(self, process_batch=enrich_mood_events, on_failure=mark_failed, num_workers=None, batch_size=None,
+                 max_attempts=None, backoff=None):
+        self.process_batch = process_batch
+        self.on_failure = on_failure
+        self.configure(num_workers, batch_size, max_attempts, backoff)
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._threads = []
+        self._stopping = False
+
+    def configure(self, num_workers=None, batch_size=None, max_attempts=None, backoff=None):
+        """
+        Apply settings (the ones left out are read from `moody.config` again)
+
+        Running workers pick up the new batch size and retry policy. A new number of workers applies from the
+        next `start`.
+        """
+        self.num_workers = num_workers or config.ENRICHMENT_WORKERS
+        self.batch_size = batch_size or config.ENRICHMENT_BATCH_SIZE
+        self.max_attempts = max_attempts or config.ENRICHMENT_MAX_ATTEMPTS
+        self.backoff = config.ENRICHMENT_BACKOFF if backoff is None else backoff
+
+    def enqueue(self, mood_event_id, attempt=1, delay=0.0):
+        """Add a mood event id to the queue"""
+        self.enqueue_many([mood_event_id], attempt=attempt, delay=delay)
+
+    def enqueue_many(self, mood_event_ids, attempt=1, delay=0.0):
+        """Add several mood event ids to the queue at once"""
+        ready_at = time.monotonic() + delay
+        with self._condition:
+            for mood_event_id in mood_event_ids:
+                heapq.heappush(self._heap, (ready_at, next(self._counter), mood_event_id, attempt))
+            self._condition.notify_all()
+
+    def start(self, requeue_pending=True):
+        """Start worker threads unless already running. Optionally re-enqueue events still pending in the db."""
+        if any(thread.is_alive() for thread in self._threads):
+            return
+
+        self._stopping = False
+        self._threads = []
+        for index in range(self.num_workers):
+            thread = threading.Thread(
+                target=self._run,
+                args=(requeue_pending and index == 0,),
+                name=f'enrichment-worker-{index}',
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Signal worker threads to exit and wait for them"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+
+    def drain(self):
+        """
+        Process every queued item in the calling thread, ignoring backoff delays.
+
+        Meant for tests and maintenance scripts that need enrichment to have finished before continuing.
+        """
+        while True:
+            with self._condition:
+                if not self._heap:
+                    break
+                batch = self._pop_batch(ignore_delay=True)
+            self._process(batch)
+
+    def join(self, timeout=None):
+        """Block until the queue is empty and no batch is in flight"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._heap or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _pop_batch(self, ignore_delay=False):
+        now = time.monotonic()
+        batch = []
+        while self._heap and len(batch) < self.batch_size:
+            ready_at, _, mood_event_id, attempt = self._heap[0]
+            if ready_at > now and not ignore_delay:
+                break
+            heapq.heappop(self._heap)
+            batch.append((mood_event_id, attempt))
+        return batch
+
+    def _run(self, requeue_pending):
+        if requeue_pending:
+            try:
+                self.enqueue_many(pending_mood_event_ids())
+            except Exception:
+                logger.exception('Failed to re-enqueue pending mood events')
+
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    batch = self._pop_batch()
+                    if batch:
+                        self._in_flight += 1
+                        break
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._condition.wait(timeout)
+                else:
+                    return
+
+            try:
+                self._process(batch)
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _process(self, batch):
+        mood_event_ids = [mood_event_id for mood_event_id, _ in batch]
+        try:
+            self.process_batch(mood_event_ids)
+            return
+        except Exception:
+            logger.exception('Enrichment failed for mood events %s', mood_event_ids)
+
+        exhausted = []
+        for mood_event_id, attempt in batch:
+            if attempt >= self.max_attempts:
+                exhausted.append(mood_event_id)
+            else:
+                self.enqueue(mood_event_id, attempt=attempt + 1, delay=self.backoff * 2 ** (attempt - 1))
+
+        if exhausted:
+            try:
+                self.on_failure(exhausted)
+            except Exception:
+                logger.exception('Failed to mark mood events %s as failed', exhausted)
+
+
+enrichment_queue = EnrichmentQueue()
@@ -20,3 +20,11 @@ class UnauthorizedError(BaseError):
 
 class NotFoundError(BaseError):
     status = 404
+
+
+class ServiceUnavailableError(BaseError):
+    status = 503
+
+
+class PlacesUnavailableError(BaseError):
+    status = 503
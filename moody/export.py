@@ -0,0 +1,258 @@
+"""
+Streaming export of a user's mood history is defined here.
+
+Mood events are read with a server-side cursor, `EXPORT_CHUNK_SIZE` rows at a time, and encoded chunk by chunk,
+so memory use doesn't grow with the size of the history and the first bytes go out before the query finishes.
+Places are flattened into list columns: `place_ids`, `place_names` and `place_types`.
+Exports are read from a read replica when one is configured (see moody.db).
+
+Supported formats are NDJSON, CSV and, when pyarrow is installed, Parquet and the Arrow IPC stream format.
+"""
+from datetime import datetime
+import csv
+import importlib.util
+import io
+
+from sqlalchemy import select
+
+from moody import config
+from moody.db import reading_from_replica, session
+from moody.models import MoodEvent, Place, PlaceType, mood_events_places
+from moody.serialization import dumps
+
+# pyarrow is imported on first use, since importing it noticeably slows down app startup
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+COLUMNS = [
+    'id',
+    'date_created',
+    'sentiment',
+    'latitude',
+    'longitude',
+    'enrichment_status',
+    'place_ids',
+    'place_names',
+    'place_types',
+]
+
+# Format -> (mimetype, file extension, needs pyarrow)
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson', False),
+    'csv': ('text/csv', 'csv', False),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', True),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow', True),
+}
+
+# Separator of list values in CSV cells
+CSV_LIST_SEPARATOR = '|'
+
+
+def available_formats():
+    return [name for name, (_, _, needs_pyarrow) in FORMATS.items() if HAS_PYARROW or not needs_pyarrow]
+
+
+def iter_chunks(user_id, created_after=None, created_before=None, chunk_size=None):
+    """
+    Yield lists of up to about `chunk_size` (default: `EXPORT_CHUNK_SIZE`) mood event dicts of a user, oldest first,
+    with places flattened
+
+    Rows of the mood event/place join are streamed from the db and folded into one dict per mood event.
+    A mood event is only emitted once all of its rows have been read, so it never straddles two chunks.
+
+    Reads are routed to a replica for the whole iteration rather than by the caller, since a streamed response
+    consumes the generator after its route has returned.
+    """
+    with reading_from_replica():
+        yield from _iter_chunks(user_id, created_after, created_before, chunk_size or config.EXPORT_CHUNK_SIZE)
+
+
+def _iter_chunks(user_id, created_after, created_before, chunk_size):
+    table = MoodEvent.__table__
+    statement = select([
+        table.c.id,
+        table.c.date_created,
+        table.c.sentiment,
+        table.c.latitude,
+        table.c.longitude,
+        table.c.enrichment_status,
+        Place.place_id,
+        Place.name,
+        Place.type_ids,
+    ]) \
+        .select_from(
+            table
+            .outerjoin(mood_events_places, mood_events_places.c.mood_event_id == table.c.id)
+            .outerjoin(Place.__table__, Place.id == mood_events_places.c.place_id)
+        ) \
+        .where(table.c.user_id == user_id) \
+        .order_by(table.c.date_created, table.c.id)
+
+    if created_after is not None:
+        statement = statement.where(table.c.date_created >= created_after)
+    if created_before is not None:
+        statement = statement.where(table.c.date_created <= created_before)
+
+    result = session.connection().execution_options(stream_results=True).execute(statement)
+
+    chunk = []
+    current = None
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            for row in rows:
+                if current is None or current['id'] != row.id:
+                    if current is not None:
+                        chunk.append(current)
+                    current = {
+                        'id': row.id,
+                        'date_created': row.date_created,
+                        'sentiment': row.sentiment,
+                        'latitude': row.latitude,
+                        'longitude': row.longitude,
+                        'enrichment_status': row.enrichment_status,
+                        'place_ids': [],
+                        'place_names': [],
+                        'place_types': [],
+                    }
+
+                if row.place_id is not None:
+                    current['place_ids'].append(row.place_id)
+                    current['place_names'].append(row.name)
+                    for place_type in PlaceType.get_names(row.type_ids):
+                        if place_type not in current['place_types']:
+                            current['place_types'].append(place_type)
+
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    finally:
+        result.close()
+
+    if current is not None:
+        chunk.append(current)
+    if chunk:
+        yield chunk
+
+
+def to_ndjson(chunks):
+    for chunk in chunks:
+        yield b''.join(
+            dumps(dict(mood_event, date_created=mood_event['date_created'].isoformat())) + b'\n'
+            for mood_event in chunk
+        )
+
+
+def to_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+
+    for chunk in chunks:
+        for mood_event in chunk:
+            writer.writerow([csv_value(mood_event[column]) for column in COLUMNS])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    # The header goes out even for an empty history
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def csv_value(value):
+    if isinstance(value, list):
+        return CSV_LIST_SEPARATOR.join(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def arrow_schema():
+    import pyarrow
+
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('date_created', pyarrow.timestamp('us', tz='UTC')),
+        ('sentiment', pyarrow.string()),
+        ('latitude', pyarrow.float64()),
+        ('longitude', pyarrow.float64()),
+        ('enrichment_status', pyarrow.string()),
+        ('place_ids', pyarrow.list_(pyarrow.string())),
+        ('place_names', pyarrow.list_(pyarrow.string())),
+        ('place_types', pyarrow.list_(pyarrow.string())),
+    ])
+
+
+class _ChunkSink:
+    """Write-only file object collecting what pyarrow writes, so it can be yielded as it's produced"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _to_arrow_format(chunks, open_writer):
+    """Write each chunk as one record batch / row group, yielding encoded bytes as they're produced"""
+    import pyarrow
+
+    schema = arrow_schema()
+    sink = _ChunkSink()
+    writer = open_writer(pyarrow.PythonFile(sink, mode='w'), schema)
+
+    for chunk in chunks:
+        writer.write_table(pyarrow.Table.from_pylist(chunk, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+
+    writer.close()
+    yield sink.drain()
+
+
+def to_parquet(chunks):
+    import pyarrow.parquet
+
+    return _to_arrow_format(chunks, pyarrow.parquet.ParquetWriter)
+
+
+def to_arrow(chunks):
+    import pyarrow.ipc
+
+    return _to_arrow_format(chunks, pyarrow.ipc.new_stream)
+
+
+ENCODERS = {
+    'ndjson': to_ndjson,
+    'csv': to_csv,
+    'parquet': to_parquet,
+    'arrow': to_arrow,
+}
+
+
+def export_mood_events(user_id, format='ndjson', created_after=None, created_before=None, chunk_size=None):
+    """Return a generator of encoded chunks of a user's mood history in `format` (see `FORMATS`)"""
+    return ENCODERS[format](iter_chunks(user_id, created_after, created_before, chunk_size))
@@ -1,8 +1,259 @@
 """Helper functions to handle location context are defined here"""
+import json
+import math
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from moody.config import GOOGLE_API_KEY
+from moody import config
+from moody.cache import LRUCache
+from moody.exceptions import PlacesUnavailableError
+from moody.ratelimit import CircuitBreaker, TokenBucket
+
+# Approximate length of one degree of latitude in meters
+METERS_PER_DEGREE = 111320.0
+
+
+def quantize(latitude, longitude, cell_size=None):
+    """
+    Snap coordinates to a fixed grid cell roughly `cell_size` meters wide.
+
+    Rows are fixed steps of latitude. Within a row, the longitude step is widened by 1/cos(latitude)
+    so that cells stay close to square no matter how far they are from the equator.
+
+    Returns a tuple of (row, column, center latitude, center longitude). `cell_size` defaults to `GEO_CELL_SIZE`.
+    """
+    cell_size = cell_size or config.GEO_CELL_SIZE
+    lat_step = cell_size / METERS_PER_DEGREE
+    row = math.floor((latitude + 90) / lat_step)
+    center_latitude = min(row * lat_step + lat_step / 2 - 90, 90.0)
+
+    lon_step = cell_size / (METERS_PER_DEGREE * max(math.cos(math.radians(center_latitude)), 1e-6))
+    column = math.floor((longitude + 180) / lon_step)
+    center_longitude = min(column * lon_step + lon_step / 2 - 180, 180.0)
+
+    return row, column, center_latitude, center_longitude
+
+
+class GeoCellCache:
+    """
+    Two-tier cache of places keyed by quantized location cell.
+
+    The local tier is an in-process LRU with a TTL. The optional shared tier can be any client exposing
+    `get(key)` and `setex(key, ttl, value)` (e.g. `redis.Redis`), so workers can share lookups.
+    Values in the shared tier are stored as JSON.
+    """
+
+    def __init__(self, maxsize=None, ttl=None, cell_size=None, shared=None):
+        self.ttl = config.GEO_CACHE_TTL if ttl is None else ttl
+        self.local = LRUCache(maxsize=maxsize or config.GEO_CACHE_SIZE, ttl=self.ttl)
+        self.shared = shared
+        self.cell_size = cell_size or config.GEO_CELL_SIZE
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def key(self, row, column):
+        return f"geo:{self.cell_size}:{row}:{column}"
+
+    def get_or_fetch(self, latitude, longitude, fetch):
+        """
+        Return places for the cell containing the coordinates, calling `fetch(lat, lon)` on a miss.
+
+        `fetch` is called with the center of the cell rather than the exact coordinates,
+        so that the cached result is the same for every point within the cell.
+        """
+        row, column, center_latitude, center_longitude = quantize(latitude, longitude, self.cell_size)
+        key = self.key(row, column)
+
+        places = self.local.get(key)
+        if places is not None:
+            return places
+
+        if self.shared is not None:
+            cached = self.shared.get(key)
+            if cached is not None:
+                self.shared_hits += 1
+                places = json.loads(cached)
+                self.local.set(key, places)
+                return places
+            self.shared_misses += 1
+
+        places = fetch(center_latitude, center_longitude)
+
+        self.local.set(key, places)
+        if self.shared is not None:
+            self.shared.setex(key, int(self.ttl), json.dumps(places))
+
+        return places
+
+    def stats(self):
+        stats = self.local.stats.to_dict()
+        stats['shared_hits'] = self.shared_hits
+        stats['shared_misses'] = self.shared_misses
+        return stats
+
+
+class _InFlight:
+    """A lookup in progress that other threads can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Statuses of Places API responses that carry results, see
+# https://developers.google.com/places/web-service/search#PlaceSearchResponses
+SUCCESS_STATUSES = ('OK', 'ZERO_RESULTS')
+
+
+class PlacesClient:
+    """
+    Client for the Google Places nearby search web service.
+
+    - Keeps a pooled keep-alive `requests.Session` and applies explicit (connect, read) timeouts
+    - Coalesces concurrent identical lookups into a single upstream request (single-flight)
+    - Applies a token bucket rate limit to upstream requests
+    - Trips a circuit breaker when the upstream keeps failing or timing out
+
+    Whenever a lookup can't be served, including when Google answers with an error status (e.g. OVER_QUERY_LIMIT),
+    `PlacesUnavailableError` is raised.
+
+    `base_url` can point at a local stub server for tests and benchmarks.
+    `api_key` defaults to `GOOGLE_API_KEY` at the time of each request. Other settings left out default to the
+    `GOOGLE_PLACES_*` settings of `moody.config` when the client is created.
+    """
+
+    def __init__(self, api_key=None, base_url=None, timeout=None, pool_size=None, rate=None, burst=None,
+                 breaker_threshold=None, breaker_reset=None, session=None):
+        self.api_key = api_key
+        self.base_url = base_url or config.GOOGLE_PLACES_URL
+        self.timeout = timeout or config.GOOGLE_PLACES_TIMEOUT
+        self.rate_limiter = TokenBucket(rate=rate or config.GOOGLE_PLACES_RATE,
+                                        capacity=burst or config.GOOGLE_PLACES_BURST)
+        self.breaker = CircuitBreaker(threshold=breaker_threshold or config.GOOGLE_PLACES_BREAKER_THRESHOLD,
+                                      reset_timeout=breaker_reset or config.GOOGLE_PLACES_BREAKER_RESET)
+
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or config.GOOGLE_PLACES_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def nearby(self, latitude, longitude, radius=100):
+        """Return places within `radius` meters of the coordinates"""
+        key = (latitude, longitude, radius)
+
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = _InFlight()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._request(latitude, longitude, radius)
+        except Exception as error:
+            # Followers raise whatever the leader did, rather than returning no result
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+        return call.result
+
+    def _request(self, latitude, longitude, radius):
+        if not self.rate_limiter.acquire(timeout=self.timeout[1]):
+            raise PlacesUnavailableError('Places API request budget exhausted.')
+
+        if not self.breaker.allow():
+            raise PlacesUnavailableError('Places API circuit is open.')
+
+        query_params = {
+            "location": f"{latitude},{longitude}",
+            "radius": str(radius),
+            "key": self.api_key or config.GOOGLE_API_KEY
+        }
+
+        try:
+            response = self.session.get(self.base_url, params=query_params, timeout=self.timeout)
+            response.raise_for_status()
+            response_body = response.json()
+        except (requests.RequestException, ValueError) as error:
+            self.breaker.record_failure()
+            raise PlacesUnavailableError(f'Places API request failed: {error}')
+
+        # Anything but OK/ZERO_RESULTS means the lookup failed, even though the request itself succeeded
+        status = response_body.get('status')
+        if status not in SUCCESS_STATUSES:
+            self.breaker.record_failure()
+            raise PlacesUnavailableError(
+                f"Places API returned {status}: {response_body.get('error_message', 'no details')}"
+            )
+
+        self.breaker.record_success()
+
+        # Example responses can be found in Google Places API documentation:
+        # https://developers.google.com/places/web-service/search
+        return [
+            {
+                "place_id": result["place_id"],
+                "name": result["name"],
+                "types": result["types"],
+                "latitude": result["geometry"]["location"]["lat"],
+                "longitude": result["geometry"]["location"]["lng"]
+            }
+            for result in response_body["results"]
+        ]
+
+
+# Replaced by `init_places`
+places_cache = None
+places_client = None
+
+
+def shared_cache_client(url):
+    """Return a client of the Redis server at `url`, to be used as the shared tier of `GeoCellCache`"""
+    import redis
+
+    return redis.Redis.from_url(url)
+
+
+def init_places():
+    """
+    Create an empty `places_cache` and a new `places_client` from the settings of `moody.config`
+
+    The cache gets a shared tier when `PLACES_CACHE_URL` is set.
+    """
+    global places_cache, places_client
+    shared = shared_cache_client(config.PLACES_CACHE_URL) if config.PLACES_CACHE_URL else None
+    places_cache = GeoCellCache(shared=shared)
+    places_client = PlacesClient()
+
+
+init_places()
+
+
+def nearby_places(latitude, longitude):
+    """
+    Return places near given coordinates, through `places_cache` and `places_client`
+
+    Raises `PlacesUnavailableError` when the Places API can't serve the lookup. Failed lookups aren't cached, so
+    background callers like `moody.enrichment` can retry them later.
+    """
+    return places_cache.get_or_fetch(latitude, longitude, places_client.nearby)
 
 
 def google_places_from_coord(latitude, longitude):
@@ -15,30 +266,13 @@ def google_places_from_coord(latitude, longitude):
     Or can be done via Google Maps Python SDK:
     https://github.com/googlemaps/google-maps-services-python
 
-    For this implementation, we'll be using their HTTP web service via the python `requests` module.
-    """
-    url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-    query_params = {
-        "location": f"{latitude},{longitude}",
-        "radius": "100",
-        "key": GOOGLE_API_KEY
-    }
-
-    response = requests.get(url, params=query_params)
-    response.raise_for_status()
-
-    # Example responses can be found in Google Places API documentation:
-    # https://developers.google.com/places/web-service/search
-    response_body = response.json()
-    places = [
-        {
-            "place_id": result["place_id"],
-            "name": result["name"],
-            "types": result["types"],
-            "latitude": result["geometry"]["location"]["lat"],
-            "longitude": result["geometry"]["location"]["long"]
-        }
-        for result in response_body["results"]
-    ]
+    For this implementation, we'll be using their HTTP web service through `places_client`.
+    Lookups go through `places_cache` first, since users tend to log moods from the same few spots over and over.
 
-    return places
+    If the Places API is unavailable, we degrade to "no places" rather than failing, which suits callers serving a
+    request. Use `nearby_places` where a failed lookup should be retried instead.
+    """
+    try:
+        return nearby_places(latitude, longitude)
+    except PlacesUnavailableError:
+        return []
@@ -1,10 +1,16 @@
 """
 Functions that handle Flask app/request/response lifecycle events are defined here.
 """
+import time
+import uuid
 
-from flask import jsonify, current_app as app
+from flask import g, jsonify, request, current_app as app
 
-from moody.db import session
+from moody import config
+from moody.db import session, start_query_tracking, stop_query_tracking
+
+# Longest client supplied request id that is kept, rather than replaced by a generated one
+MAX_REQUEST_ID_LENGTH = 128
 
 
 def handle_custom_error(exception):
@@ -40,3 +46,47 @@ def handle_general_error(exception):
 def handle_app_teardown(exception=None):
     """Remove db session on teardown"""
     session.remove()
+
+
+def handle_request_started():
+    """Count queries issued while handling the request"""
+    start_query_tracking()
+
+
+def handle_request_id():
+    """Identify the request by the client's `X-Request-ID`, or a new id, so its log records can be correlated"""
+    request_id = request.headers.get('X-Request-ID')
+    if not request_id or len(request_id) > MAX_REQUEST_ID_LENGTH:
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+
+
+def handle_request_logged(response):
+    """Return the request id to the client, and log the request with its route, status and duration"""
+    request_id = g.get('request_id')
+    if request_id is not None:
+        response.headers['X-Request-ID'] = request_id
+
+    started_at = g.get('request_started_at')
+    if config.LOG_REQUESTS and started_at is not None:
+        duration = time.perf_counter() - started_at
+        app.logger.info(
+            '%s %s %d %.1fms', request.method, request.path, response.status_code, duration * 1000,
+            extra={'status': response.status_code, 'duration_ms': round(duration * 1000, 3)}
+        )
+
+    return response
+
+
+def handle_request_finished(response):
+    """Log requests that issued too many or too slow queries, or likely N+1 patterns"""
+    stats = stop_query_tracking()
+    if stats is not None:
+        problems = stats.problems()
+        if problems:
+            app.logger.warning(
+                '%s %s issued %d queries in %.3fs: %s',
+                request.method, request.path, stats.count, stats.duration, '; '.join(problems)
+            )
+
+    return response
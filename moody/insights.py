@@ -1,52 +1,308 @@
-import itertools
+"""Functions that compute insights from a user's mood events are defined here"""
 from collections import Counter
+from datetime import datetime, timedelta, timezone
 
-from sqlalchemy import joinedload
+from sqlalchemy import SmallInteger, func, select, type_coerce
+import numpy as np
 
-from moody.models import MoodEvent
+from moody import config
+from moody.db import session
+from moody.models import (
+    SENTIMENT_CODES,
+    MoodEvent,
+    Place,
+    PlaceType,
+    SentimentRollup,
+    PlaceSentimentRollup,
+    mood_events_places
+)
+from moody.spatial import EARTH_RADIUS
+
+# Sentiments mapped onto a happiness scale: their stored codes already run from sad (-1) to happy (1)
+SENTIMENT_VALUES = {sentiment: float(code) for sentiment, code in SENTIMENT_CODES.items()}
+
+# Upper bound on the number of cells in an event x place distance matrix held in memory at once
+PROXIMITY_CHUNK_CELLS = 1000000
 
 
 def get_frequency_distribution(created_before, created_after, user):
     """
     Get frequency distribution for a user's mood events
+
+    Whole UTC days within the range are summed from `SentimentRollup`, one row per day and sentiment.
+    Only the partial days at either end of the range are counted from `mood_events`,
+    so the cost scales with the number of days rather than the number of mood events.
+    """
+    return get_frequency_distributions([user.id], created_after, created_before)[user.id]
+
+
+def get_frequency_distributions(user_ids, created_after, created_before):
+    """
+    Get frequency distributions of several users' mood events at once, as a dict of user id -> Counter
+
+    Computed like `get_frequency_distribution`, with each source read by one query grouped by user,
+    so batch jobs don't issue queries per user.
+    """
+    created_after = as_utc(created_after)
+    created_before = as_utc(created_before)
+    distributions = {user_id: Counter() for user_id in user_ids}
+
+    first_full_day = start_of_day(created_after)
+    if first_full_day < created_after:
+        first_full_day += timedelta(days=1)
+    end_of_full_days = start_of_day(created_before)
+
+    if first_full_day >= end_of_full_days:
+        ranges = [(created_after, created_before, True)]
+    else:
+        query = session.query(SentimentRollup.user_id, SentimentRollup.sentiment, func.sum(SentimentRollup.count)) \
+            .filter(
+                SentimentRollup.user_id.in_(user_ids),
+                SentimentRollup.day >= first_full_day.date(),
+                SentimentRollup.day < end_of_full_days.date()
+            ) \
+            .group_by(SentimentRollup.user_id, SentimentRollup.sentiment)
+
+        for user_id, sentiment, count in query.all():
+            distributions[user_id][sentiment] += int(count)
+
+        ranges = [(created_after, first_full_day, False), (end_of_full_days, created_before, True)]
+
+    for range_start, range_end, include_end in ranges:
+        for user_id, sentiment, count in count_mood_events(user_ids, range_start, range_end, include_end):
+            distributions[user_id][sentiment] += count
+
+    return distributions
+
+
+def count_mood_events(user_ids, created_after, created_before, include_end=True):
+    """
+    Count users' mood events per user and sentiment within a time range, straight from `mood_events`
+
+    Returns (user id, sentiment, count) rows. The counting is done entirely in the query and served by the
+    (user_id, date_created) index.
     """
+    end_filter = MoodEvent.date_created <= created_before if include_end else MoodEvent.date_created < created_before
 
-    query = MoodEvent.query
+    query = session.query(MoodEvent.user_id, MoodEvent.sentiment, func.count(MoodEvent.id)) \
         .filter(
+            MoodEvent.user_id.in_(user_ids),
             MoodEvent.date_created >= created_after,
-            MoodEvent.date_created <= created_before,
-            MoodEvent.user_id == user.id
-        )
+            end_filter
+        ) \
+        .group_by(MoodEvent.user_id, MoodEvent.sentiment)
 
-    mood_events = query.all()
+    return query.all()
 
-    sentiments = (mood_event.sentiment for mood_event in mood_events)
 
-    frequency_distribution = Counter(sentiments)
+def as_utc(moment):
+    """Return an aware datetime in UTC. Naive datetimes are assumed to be in UTC."""
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
 
-    return frequency_distribution
 
-    # It's also possible to do this calculation entirely in the query
-    # query = session.query(MoodEvent.sentiment, func.count(MoodEvent.sentiment)).group_by(MoodEvent.sentiment).filter(...)
+def start_of_day(moment):
+    return datetime(moment.year, moment.month, moment.day, tzinfo=timezone.utc)
 
 
 def get_place_counts(user, sentiment):
     """
     Get count of how many MoodEvents with a particular sentiment are associated with each place
+
+    Summed from `PlaceSentimentRollup`, so the cost scales with the number of places rather than mood events.
     """
+    query = session.query(Place.name, func.sum(PlaceSentimentRollup.count)) \
+        .join(PlaceSentimentRollup, PlaceSentimentRollup.place_id == Place.id) \
+        .filter(PlaceSentimentRollup.user_id == user.id, PlaceSentimentRollup.sentiment == sentiment) \
+        .group_by(Place.name)
 
-    query = MoodEvent.query
-        .filter(MoodEvent.sentiment == sentiment, MoodEvent.user_id == user.id)
-        .options(joinedload(MoodEvent.places))
+    counts = Counter({name: int(count) for name, count in query.all()})
 
-    mood_events = query.all()
+    return counts
 
-    places = (place for mood_event in mood_events for place in mood_event.places)
 
-    counts = Counter((place.name for place in places))
+def get_time_histograms(user, created_after=None, created_before=None, tz='UTC'):
+    """
+    Get sentiment histograms of a user's mood events by hour of day and by weekday, in the timezone `tz`
+
+    Both histograms come from a single grouped query returning at most 24 * 7 rows per sentiment.
+    Returns dense arrays per sentiment: 24 counts by hour (0-23) and 7 counts by weekday (Monday first), e.g.
+    {'hour': {'happy': [0, 0, ..., 3], ...}, 'weekday': {'happy': [5, 2, 0, 1, 4, 9, 7], ...}}
+
+    The daily rollups are kept in UTC days and can't be split by hour, so this reads `mood_events`
+    through the (user_id, date_created) index.
+    """
+    local_time = func.timezone(tz, MoodEvent.date_created)
+    hour = func.extract('hour', local_time)
+    weekday = func.extract('isodow', local_time)
+
+    query = session.query(hour, weekday, MoodEvent.sentiment, func.count(MoodEvent.id)) \
+        .filter(MoodEvent.user_id == user.id)
+
+    if created_after is not None:
+        query = query.filter(MoodEvent.date_created >= created_after)
+
+    if created_before is not None:
+        query = query.filter(MoodEvent.date_created <= created_before)
+
+    query = query.group_by(hour, weekday, MoodEvent.sentiment)
+
+    by_hour = {sentiment: np.zeros(24, dtype=np.int64) for sentiment in SENTIMENT_VALUES}
+    by_weekday = {sentiment: np.zeros(7, dtype=np.int64) for sentiment in SENTIMENT_VALUES}
+
+    for row_hour, row_weekday, sentiment, count in query.all():
+        by_hour[sentiment][int(row_hour)] += count
+        by_weekday[sentiment][int(row_weekday) - 1] += count
+
+    return {
+        'hour': {sentiment: counts.tolist() for sentiment, counts in by_hour.items()},
+        'weekday': {sentiment: counts.tolist() for sentiment, counts in by_weekday.items()},
+    }
+
+
+def get_place_type_scores(user, radius=None):
+    """
+    Get how happy a user is near each type of place (e.g. home, office, park, shopping_mall)
+
+    The user's mood events and the places associated with them are pulled as NumPy arrays,
+    and scored with `place_type_scores` by place type id. Ids are only resolved to names for the result.
+    """
+    # Sentiments are stored as their happiness value (see models.SENTIMENT_CODES), so they're read as is
+    events = session.execute(
+        select([MoodEvent.latitude, MoodEvent.longitude, type_coerce(MoodEvent.sentiment, SmallInteger)])
+        .where(MoodEvent.user_id == user.id)
+    ).fetchall()
+
+    places = session.execute(
+        select([Place.latitude, Place.longitude, Place.type_ids])
+        .where(Place.id.in_(
+            select([mood_events_places.c.place_id])
+            .select_from(mood_events_places.join(MoodEvent, MoodEvent.id == mood_events_places.c.mood_event_id))
+            .where(MoodEvent.user_id == user.id)
+        ))
+    ).fetchall()
+
+    scores = place_type_scores(
+        events=np.array(events, dtype=np.float64).reshape(-1, 3),
+        place_coords=np.array([place[:2] for place in places], dtype=np.float64).reshape(-1, 2),
+        place_types=[place.type_ids for place in places],
+        radius=radius
+    )
+
+    return dict(zip(PlaceType.get_names(list(scores)), scores.values()))
+
+
+def place_type_scores(events, place_coords, place_types, radius=None):
+    """
+    Score each place type by the sentiment of mood events near places of that type
+
+    `events` is an (n, 3) array of latitude, longitude and sentiment value, `place_coords` is an (m, 2) array of
+    latitude and longitude, and `place_types` holds the list of types (names or ids) of each place.
+
+    Each event is weighted per type by its distance to the nearest place of that type, decaying linearly from 1 at
+    the place to 0 at `radius` meters (default: `PROXIMITY_RADIUS`). For each type, returns:
+    - score: weighted mean sentiment value, from -1 (always sad) to 1 (always happy)
+    - happy: weighted share of happy events
+    - samples: number of events within `radius` of a place of that type
+
+    Everything is computed in batch with NumPy. Places are expanded into (place, type) pairs and bucketed into rows
+    of latitude `radius` meters tall, sorted by (row, longitude). Candidates for every event are then found with
+    binary searches over the longitude range around it in its own row and the two adjacent ones, and distances are
+    only computed for those candidates. Events are processed in chunks that keep the number of candidates in
+    memory bounded.
+    """
+    radius = radius or config.PROXIMITY_RADIUS
+    types = sorted({place_type for place in place_types for place_type in place})
+    if not len(events) or not types:
+        return {}
+
+    type_indexes = {place_type: index for index, place_type in enumerate(types)}
+    pair_places, pair_types = np.array([
+        (place, type_indexes[place_type])
+        for place, place_type_list in enumerate(place_types)
+        for place_type in set(place_type_list)
+    ]).T
+
+    # Sort pairs by a key combining latitude row and longitude, so a longitude range within a row is contiguous
+    row_height = np.degrees(radius / EARTH_RADIUS)
+    pair_keys = grid_keys(place_coords[pair_places, 0], place_coords[pair_places, 1], row_height)
+    order = np.argsort(pair_keys)
+    pair_keys = pair_keys[order]
+    pair_types = pair_types[order]
+    pair_lat = place_coords[pair_places[order], 0]
+    pair_lon = place_coords[pair_places[order], 1]
+
+    event_lat = events[:, 0]
+    event_lon = events[:, 1]
+    lon_delta = row_height / np.maximum(np.cos(np.radians(np.abs(event_lat) + row_height)), 1e-6)
+    lows = np.stack([
+        np.searchsorted(pair_keys, grid_keys(event_lat + row * row_height, event_lon - lon_delta, row_height))
+        for row in (-1, 0, 1)
+    ])
+    highs = np.stack([
+        np.searchsorted(pair_keys, grid_keys(event_lat + row * row_height, event_lon + lon_delta, row_height), 'right')
+        for row in (-1, 0, 1)
+    ])
+
+    candidates = np.cumsum((highs - lows).sum(axis=0))
+    chunk_ends = np.searchsorted(candidates, np.arange(PROXIMITY_CHUNK_CELLS, candidates[-1], PROXIMITY_CHUNK_CELLS))
+    chunk_bounds = np.unique(np.concatenate([[0], chunk_ends + 1, [len(events)]]))
+
+    weight_sums = np.zeros(len(types))
+    score_sums = np.zeros(len(types))
+    happy_sums = np.zeros(len(types))
+    samples = np.zeros(len(types), dtype=np.int64)
+
+    for start, end in zip(chunk_bounds[:-1], chunk_bounds[1:]):
+        chunk_lows = lows[:, start:end].ravel()
+        counts = highs[:, start:end].ravel() - chunk_lows
+        event_index = np.repeat(np.tile(np.arange(end - start), 3), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_index = np.repeat(chunk_lows, counts) + offsets
+
+        distances = haversine(
+            event_lat[start:end][event_index],
+            event_lon[start:end][event_index],
+            pair_lat[pair_index],
+            pair_lon[pair_index]
+        )
+        close = distances < radius
+
+        # Weight of each event for each type, from the nearest place of that type
+        weights = np.zeros((end - start, len(types)))
+        np.maximum.at(
+            weights,
+            (event_index[close], pair_types[pair_index[close]]),
+            1 - distances[close] / radius
+        )
+
+        sentiments = events[start:end, 2]
+        weight_sums += weights.sum(axis=0)
+        score_sums += sentiments @ weights
+        happy_sums += (sentiments > 0) @ weights
+        samples += (weights > 0).sum(axis=0)
+
+    return {
+        place_type: {
+            'score': float(score_sums[index] / weight_sums[index]),
+            'happy': float(happy_sums[index] / weight_sums[index]),
+            'samples': int(samples[index]),
+        }
+        for index, place_type in enumerate(types)
+        if samples[index]
+    }
+
+
+def grid_keys(latitude, longitude, row_height):
+    """Sort keys ordering coordinates by row of latitude first, then by longitude"""
+    return np.floor((latitude + 90) / row_height) * 1000 + np.clip(longitude + 180, 0, 360)
 
-    return counts
 
-    # query = session.query(Place.name, func.count(Place.name)).group_by(Place.name)
-    #   .join(Place.mood_events)
-    #   .filter(MoodEvent.sentiment = sentiment, MoodEvent.user_id == user.id)
+def haversine(latitude_a, longitude_a, latitude_b, longitude_b):
+    """Great-circle distances in meters between arrays of coordinates"""
+    phi_a = np.radians(latitude_a)
+    phi_b = np.radians(latitude_b)
+    a = np.sin((phi_b - phi_a) / 2) ** 2 \
+        + np.cos(phi_a) * np.cos(phi_b) * np.sin(np.radians(longitude_b - longitude_a) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
@@ -0,0 +1,242 @@
+"""
+The logging pipeline is defined here.
+
+Loggers only put records on a bounded in-memory queue. A `QueueListener` thread owns the sinks (stdout and the
+rotating `LOG_FILE`), formats records as JSON lines and writes them, so a request never waits on a disk or a slow
+terminal, and tracebacks are formatted off the request thread. When the queue is full, records are dropped and
+counted rather than blocking; the count is logged with the next record that makes it.
+
+Records logged while handling a request carry its `request_id` and `route`. Tracebacks of the same exception are
+rate limited by `ExceptionRateLimiter`, so an error spike doesn't turn into a logging spike.
+
+The file sink isn't shared safely between processes. With several worker processes, log to stdout and let the
+process manager collect the output.
+"""
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import copy
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+
+from flask import g, has_request_context
+
+from moody import config
+from moody.cache import LRUCache
+from moody.metrics import current_route
+from moody.ratelimit import TokenBucket
+from moody.serialization import dumps
+
+# Attributes every record has. Any other attribute was added with `extra` or by a filter, and becomes a field.
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+JSON_TYPES = (str, int, float, bool, type(None), list, dict)
+
+# Number of distinct exceptions whose rate is tracked
+EXCEPTION_KEYS = 1000
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as single line JSON objects"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                entry[name] = value if isinstance(value, JSON_TYPES) else str(value)
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+
+        return dumps(entry).decode('utf-8')
+
+
+class RequestContext(logging.Filter):
+    """Add the id and route of the current request to records logged while handling it"""
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.route = current_route()
+        return True
+
+
+def exception_key(exc_info):
+    """Identify an exception by its type and the line it was raised from"""
+    exc_type, _, tb = exc_info
+    while tb is not None and tb.tb_next is not None:
+        tb = tb.tb_next
+
+    if tb is None:
+        return exc_type, None, None
+    return exc_type, tb.tb_frame.f_code.co_filename, tb.tb_lineno
+
+
+class ExceptionRateLimiter(logging.Filter):
+    """
+    Let at most `burst` records with the same exception through per `window` seconds
+
+    Records without an exception always pass. The next record of an exception to pass after some were dropped
+    carries their number as `suppressed`.
+    """
+
+    def __init__(self, burst=None, window=None, clock=time.monotonic):
+        super().__init__()
+        self.burst = burst or config.LOG_EXCEPTION_BURST
+        self.window = window or config.LOG_EXCEPTION_WINDOW
+        self._clock = clock
+        # exception key -> [token bucket, number of records dropped since the last one let through]
+        self._limits = LRUCache(maxsize=EXCEPTION_KEYS)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not record.exc_info or record.exc_info[0] is None:
+            return True
+
+        key = exception_key(record.exc_info)
+        with self._lock:
+            limit = self._limits.get(key)
+            if limit is None:
+                limit = [TokenBucket(self.burst / self.window, self.burst, clock=self._clock), 0]
+                self._limits.set(key, limit)
+
+            if not limit[0].acquire():
+                limit[1] += 1
+                return False
+
+            suppressed, limit[1] = limit[1], 0
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Queue handler that drops records when the queue is full, and leaves formatting to the listener"""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Arguments may change after the call returns, so the message is built now. Tracebacks only reference
+        # code and line numbers, so they're formatted by the listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                record.dropped = dropped
+
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                with self._dropped_lock:
+                    self.dropped += dropped + 1
+        except Exception:
+            self.handleError(record)
+
+
+def stream_sink(stream, level):
+    handler = logging.StreamHandler(stream)
+    handler.setLevel(level)
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+
+def file_sink(path, level, max_bytes, backup_count):
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+    handler.setLevel(level)
+    handler.setFormatter(JSONFormatter())
+    return handler
+
+
+class LogPipeline:
+    """A queue handler for loggers, and the listener thread writing what it queues to `sinks`"""
+
+    def __init__(self, sinks, queue_size=None):
+        self.sinks = sinks
+        self.queue_size = queue_size or config.LOG_QUEUE_SIZE
+        self.handler = NonBlockingQueueHandler(queue.Queue(maxsize=self.queue_size))
+        self.handler.addFilter(ExceptionRateLimiter())
+        self.handler.addFilter(RequestContext())
+        self.listener = None
+        self.started = False
+
+    def start(self):
+        self.listener = QueueListener(self.handler.queue, *self.sinks, respect_handler_level=True)
+        self.listener.start()
+        self.started = True
+
+    def stop(self):
+        """Write out queued records and stop the listener"""
+        if self.started:
+            self.listener.stop()
+            self.started = False
+        for sink in self.sinks:
+            sink.close()
+
+    def reset_after_fork(self):
+        """Start a listener on a new queue in a forked child, where the parent's listener thread doesn't exist"""
+        self.handler.queue = queue.Queue(maxsize=self.queue_size)
+        self.start()
+
+
+pipeline = None
+
+
+def start_pipeline():
+    """Start a pipeline writing to the sinks in `moody.config`, replacing the running one. Returns its handler."""
+    global pipeline
+
+    sinks = []
+    if config.LOG_STDOUT:
+        sinks.append(stream_sink(sys.stdout, config.LOG_LEVEL))
+    if config.LOG_FILE:
+        sinks.append(file_sink(config.LOG_FILE, config.LOG_FILE_LEVEL, config.LOG_MAX_BYTES, config.LOG_BACKUP_COUNT))
+
+    previous = pipeline
+    pipeline = LogPipeline(sinks)
+    pipeline.start()
+    if previous is not None:
+        previous.stop()
+
+    return pipeline.handler
+
+
+def stop_pipeline():
+    if pipeline is not None:
+        pipeline.stop()
+
+
+def _reset_after_fork():
+    if pipeline is not None:
+        pipeline.reset_after_fork()
+
+
+atexit.register(stop_pipeline)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
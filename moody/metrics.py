@@ -0,0 +1,168 @@
+"""
+Request and stage timing metrics are defined here.
+
+Routes wrap the expensive parts of handling a request (auth, validation, db work, commit, serialization) in
+`stage(...)`, and every request's total duration is recorded by the hooks registered in `moody.app.create_app`.
+Durations go into fixed-bucket histograms labelled by route and stage, which `/metrics` exposes in the
+Prometheus text format. Recording a sample is a bisect and a few integer increments under a lock.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+from flask import Blueprint, g, has_request_context, request, current_app
+
+# Upper bounds (seconds) of histogram buckets, spanning sub-millisecond cache hits to multi-second upstream calls
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Route label of stages timed outside a request, e.g. by enrichment workers
+BACKGROUND = 'background'
+
+
+class Histogram:
+    """Thread-safe cumulative histogram of durations"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """Return ([(upper bound, cumulative count)...], sum, count), with a final '+Inf' bucket"""
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+
+        return cumulative, total, count
+
+
+class HistogramFamily:
+    """Histograms of one metric, one per combination of label values"""
+
+    def __init__(self, name, documentation, label_names, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values):
+        histogram = self._histograms.get(label_values)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(label_values, Histogram(self.buckets))
+        return histogram
+
+    def observe(self, value, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def expose(self):
+        """Return the family in the Prometheus text exposition format"""
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram',
+        ]
+
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+
+        for label_values, histogram in histograms:
+            labels = ','.join(
+                f'{name}="{escape(value)}"'
+                for name, value in zip(self.label_names, label_values)
+            )
+            buckets, total, count = histogram.snapshot()
+            for bound, cumulative in buckets:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = HistogramFamily(
+    'moody_request_duration_seconds',
+    'Time spent handling requests.',
+    ('route', 'status'),
+)
+stage_duration = HistogramFamily(
+    'moody_stage_duration_seconds',
+    'Time spent in each stage of handling a request or background job.',
+    ('route', 'stage'),
+)
+FAMILIES = (request_duration, stage_duration)
+
+
+def current_route():
+    """Label of the route handling the current request, e.g. 'POST /mood_events'"""
+    if not has_request_context():
+        return BACKGROUND
+
+    if request.url_rule is None:
+        return 'unmatched'
+
+    return f'{request.method} {request.url_rule.rule}'
+
+
+@contextmanager
+def stage(name, route=None):
+    """Time the enclosed block as stage `name` of `route` (the current route by default)"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_duration.observe(time.perf_counter() - started_at, route or current_route(), name)
+
+
+def start_request_timer():
+    """`before_request` hook that stamps when handling the request started"""
+    g.request_started_at = time.perf_counter()
+
+
+def record_request(response):
+    """`after_request` hook that records the duration of the request"""
+    started_at = g.get('request_started_at')
+    if started_at is not None:
+        request_duration.observe(time.perf_counter() - started_at, current_route(), str(response.status_code))
+
+    return response
+
+
+def expose():
+    """Return every metric in the Prometheus text exposition format"""
+    return ''.join(family.expose() for family in FAMILIES)
+
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose request and stage durations to Prometheus"""
+    return current_app.response_class(expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,89 @@
+"""
+Schema migrations of existing PostgreSQL databases are defined here.
+
+Tables created by `Base.metadata.create_all` are already up to date. Each migration checks what it has to do first,
+so running it again is a no-op.
+"""
+import logging
+
+from sqlalchemy import text
+
+from moody.db import session
+from moody.models import (
+    SENTIMENT_CODES,
+    MoodEvent,
+    Place,
+    PlaceType,
+    SentimentRollup,
+    PlaceSentimentRollup,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def column_type(table, column):
+    """Return the data type of a column of the default schema, or None if it doesn't exist"""
+    return session.execute(
+        text(
+            'SELECT data_type FROM information_schema.columns '
+            'WHERE table_schema = current_schema() AND table_name = :table AND column_name = :column'
+        ),
+        {'table': table, 'column': column}
+    ).scalar()
+
+
+def compact_encodings():
+    """
+    Store sentiments as small ints and place types as ids into the `place_types` dictionary, in one transaction
+
+    - `sentiment` of mood events and rollups is converted in place from strings to `SENTIMENT_CODES`
+    - `place_types` is filled with the distinct types of places, and `places.types` is replaced by `type_ids`
+
+    Converting rewrites the tables and their indexes, and locks them for the duration.
+    Partitions archived by `moody.partitions` are left as they are.
+    Return the names of the migrated columns.
+    """
+    migrated = []
+    codes = ' '.join(f"WHEN '{sentiment}' THEN {code}" for sentiment, code in SENTIMENT_CODES.items())
+
+    try:
+        for model in (MoodEvent, SentimentRollup, PlaceSentimentRollup):
+            table = model.__tablename__
+            if column_type(table, 'sentiment') == 'smallint':
+                continue
+
+            session.execute(text(
+                f'ALTER TABLE {table} ALTER COLUMN sentiment TYPE smallint USING CASE sentiment {codes} END'
+            ))
+            migrated.append(f'{table}.sentiment')
+
+        places = Place.__tablename__
+        if column_type(places, 'types') is not None:
+            PlaceType.__table__.create(bind=session.connection(), checkfirst=True)
+            session.execute(text(
+                f'INSERT INTO {PlaceType.__tablename__} (name) '
+                f'SELECT DISTINCT name FROM {places}, unnest({places}.types) AS name ORDER BY name '
+                'ON CONFLICT (name) DO NOTHING'
+            ))
+            session.execute(text(f'ALTER TABLE {places} ADD COLUMN type_ids smallint[]'))
+            session.execute(text(
+                f'UPDATE {places} SET type_ids = ARRAY('
+                f'SELECT {PlaceType.__tablename__}.id '
+                f'FROM unnest({places}.types) WITH ORDINALITY AS type (name, position) '
+                f'JOIN {PlaceType.__tablename__} ON {PlaceType.__tablename__}.name = type.name '
+                'ORDER BY type.position'
+                ')'
+            ))
+            session.execute(text(f'ALTER TABLE {places} ALTER COLUMN type_ids SET NOT NULL'))
+            session.execute(text(f'ALTER TABLE {places} DROP COLUMN types'))
+            migrated.append(f'{places}.types')
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    for column in migrated:
+        logger.info('Migrated %s', column)
+
+    return migrated
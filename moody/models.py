@@ -1,24 +1,54 @@
 """Database models and relationships are defined here"""
-from sqlalchemy import Table, Column, Integer, Float, ARRAY, String, DateTime, ForeignKey, func
-from sqlalchemy.orm import relationship
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Table, Column, Index, Integer, SmallInteger, Float, ARRAY, String, Date, DateTime, ForeignKey, TypeDecorator,
+    func, literal_column, tuple_
+)
+from sqlalchemy.orm import relationship, selectinload
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.dialects.postgresql import JSONB
-import bcrypt
-
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from moody import config
+from moody.cache import LRUCache
 from moody.db import session
+from moody.passwords import hasher
 
 
 Base = declarative_base()
 Base.query = session.query_property()
 
 
+class EnrichmentStatus:
+    """Values for `MoodEvent.enrichment_status`"""
+    PENDING = 'pending'
+    ENRICHED = 'enriched'
+    FAILED = 'failed'
+
+
+# Sentiments are stored as small ints, which are also their values on a happiness scale
+SENTIMENT_CODES = {'sad': -1, 'neutral': 0, 'happy': 1}
+SENTIMENT_NAMES = {code: sentiment for sentiment, code in SENTIMENT_CODES.items()}
+
+
+class Sentiment(TypeDecorator):
+    """Sentiment column stored as a SMALLINT (see `SENTIMENT_CODES`), read and written as the sentiment's name"""
+    impl = SmallInteger
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else SENTIMENT_CODES[value]
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else SENTIMENT_NAMES[value]
+
+
 # This defines our association table for associating MoodEvents with Places
 mood_events_places = Table(
     'mood_events_places',
     Base.metadata,
     Column('mood_event_id', Integer, ForeignKey('mood_events.id')),
-    Column('place_id', Integer, ForeignKey('places.id'))
+    Column('place_id', Integer, ForeignKey('places.id')),
+    Index('ix_mood_events_places_mood_event_id', 'mood_event_id')
 )
 
 
@@ -38,18 +68,34 @@ class MoodEvent(Base):
     b) convert coordinates to places on the server-side when handling POST request of mood data
     c) convert coordinates to places asynchronously server-side by delegating a worker to do the conversion after a new MoodEvent is inserted to the db
 
-    For this implementation, we'll go with option b), and also pretend we have fast and unrestricted access to the Google Places API.
+    For this implementation, we'll go with option c). The mood event is committed right away with an `enrichment_status` of "pending",
+    and a worker from `moody.enrichment` attaches places afterwards, so write latency doesn't depend on the Google Places API.
     """
+    # Partitioned by month of `date_created` in production, where the primary key is (id, date_created).
+    # See moody.partitions.
     __tablename__ = 'mood_events'
+    __table_args__ = (
+        # Every insight is scoped to a user, and filters by either time range or sentiment
+        Index('ix_mood_events_user_id_date_created', 'user_id', 'date_created'),
+        Index('ix_mood_events_user_id_sentiment', 'user_id', 'sentiment'),
+    )
+    # Fetch server-generated columns like `date_created` with RETURNING on insert, since rollups need them right away
+    __mapper_args__ = {'eager_defaults': True}
 
     id = Column(Integer, primary_key=True, nullable=False)
 
-    sentiment = Column(String, nullable=False)
+    sentiment = Column(Sentiment, nullable=False)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     date_created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    enrichment_status = Column(
+        String,
+        nullable=False,
+        default=EnrichmentStatus.PENDING,
+        server_default=EnrichmentStatus.PENDING
+    )
 
-    user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     user = relationship('User')
 
     places = relationship(
@@ -58,21 +104,45 @@ class MoodEvent(Base):
         secondary=mood_events_places
     )
 
-    def __init__(self, sentiment, latitude, longitude, user):
+    def __init__(self, sentiment, latitude, longitude, user=None, user_id=None):
         self.sentiment = sentiment
         self.latitude = latitude
         self.longitude = longitude
-        self.user = user
+        if user is not None:
+            self.user = user
+        else:
+            self.user_id = user_id
 
     @classmethod
     def apply_query_params(cls, kwargs):
         """
         Return a MoodEvent query with various parameters applied.
+
+        `kwargs` are loaded by `MoodEventQuerySchema`:
+        - sentiment: only mood events with this sentiment
+        - created_after / created_before: only mood events created within this range (inclusive)
+        - cursor: (date_created, id) of the last mood event of the previous page
+
+        Mood events are ordered newest first by (date_created, id). Pagination is keyset based, so the db seeks
+        straight to the next page through the (user_id, date_created) index no matter how deep the page is.
+        Places are loaded with one batched SELECT ... IN per page rather than one query per mood event.
         """
-        query = cls.query
+        query = cls.query.options(selectinload(cls.places))
+
+        if kwargs.get('sentiment') is not None:
+            query = query.filter(cls.sentiment == kwargs['sentiment'])
+
+        if kwargs.get('created_after') is not None:
+            query = query.filter(cls.date_created >= kwargs['created_after'])
 
-        # One application for this method is to create a query for all mood events with a particular sentiment value, e.g
-        # query = query.filter(cls.sentiment == kwargs['sentiment'])
+        if kwargs.get('created_before') is not None:
+            query = query.filter(cls.date_created <= kwargs['created_before'])
+
+        if kwargs.get('cursor') is not None:
+            date_created, mood_event_id = kwargs['cursor']
+            query = query.filter(tuple_(cls.date_created, cls.id) < tuple_(date_created, mood_event_id))
+
+        query = query.order_by(cls.date_created.desc(), cls.id.desc())
 
         return query
 
@@ -92,6 +162,7 @@ class Place(Base):
 
     For each place, we'll keep track of:
     - unique id
+    - external id of the place from the Google Places API (`place_id`), used to deduplicate places
     - name of place
     - latitude of place
     - longitude of place
@@ -102,26 +173,242 @@ class Place(Base):
         - country
         - continent
 
-    It might make sense to put columns like types, city, country, and continent as their own tables if want this data to be normalized
+    It might make sense to put columns like types, city, country, and continent as their own tables if want this data to be normalized.
+    Types are normalized: places store the ids of their types in the `place_types` dictionary (see `PlaceType`).
+    Constructing a Place doesn't touch the db: type names are resolved to ids by `get_or_create_many`.
     """
     __tablename__ = 'places'
 
     id = Column(Integer, primary_key=True, nullable=False)
 
+    place_id = Column(String, unique=True)
     name = Column(String, nullable=False)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
-    types = Column(ARRAY(String), nullable=False)
+    type_ids = Column(ARRAY(SmallInteger), nullable=False)
     # address = Column(String, nullable=False)
     # city = Column(String, nullable=False)
     # country = Column(String, nullable=False)
     # continent = Column(String, nullable=False)
 
-    def __init__(self, name, latitude, longitude, types):
+    def __init__(self, name, latitude, longitude, type_ids, place_id=None):
+        self.place_id = place_id
         self.name = name
         self.latitude = latitude
         self.longitude = longitude
-        self.types = types
+        self.type_ids = list(type_ids)
+
+    @property
+    def types(self):
+        """Names of the place's types, e.g. ["restaurant", "food", "establishment"]"""
+        return PlaceType.get_names(self.type_ids)
+
+    @classmethod
+    def get_or_create(cls, **place):
+        """Return the Place with the given `place_id`, creating it if it doesn't exist yet"""
+        ids = cls.get_or_create_many([place])
+        return cls.query.get(ids[place['place_id']])
+
+    @classmethod
+    def get_or_create_many(cls, places):
+        """
+        Resolve a list of place dicts (as returned by `moody.geo`) to primary keys, creating any missing places.
+
+        Returns a dict mapping `place_id` to primary key.
+
+        Hot places are served from `place_id_cache` without touching the db. The rest are resolved in one round-trip
+        with `INSERT ... ON CONFLICT (place_id) DO UPDATE ... RETURNING`. The no-op update makes existing rows show up
+        in RETURNING along with new ones.
+
+        This runs in the caller's transaction, so only rows that already existed are cached.
+        Newly inserted rows get cached the next time they are looked up, after their transaction has committed.
+        Rows are upserted in `place_id` order, so concurrent callers lock them in the same order and can't deadlock.
+        """
+        ids = {}
+        missing = {}
+        for place in places:
+            place_id = place['place_id']
+            pk = place_id_cache.get(place_id)
+            if pk is not None:
+                ids[place_id] = pk
+            else:
+                missing[place_id] = place
+
+        if not missing:
+            return ids
+
+        type_ids = PlaceType.get_or_create_many(
+            place_type
+            for place in missing.values()
+            for place_type in place['types']
+        )
+
+        statement = insert(cls.__table__).values([
+            {
+                'place_id': place['place_id'],
+                'name': place['name'],
+                'latitude': place['latitude'],
+                'longitude': place['longitude'],
+                'type_ids': [type_ids[place_type] for place_type in place['types']],
+            }
+            for _, place in sorted(missing.items())
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.__table__.c.place_id],
+            set_={'place_id': statement.excluded.place_id}
+        ).returning(
+            cls.__table__.c.id,
+            cls.__table__.c.place_id,
+            literal_column('xmax = 0').label('inserted')
+        )
+
+        for row in session.execute(statement):
+            ids[row.place_id] = row.id
+            if not row.inserted:
+                place_id_cache.set(row.place_id, row.id)
+
+        return ids
+
+
+class PlaceType(Base):
+    """
+    Dictionary of place types (e.g. "restaurant", "park")
+
+    Places store small int ids of their types rather than repeating the names on every row, which keeps place rows
+    small and lets type-level insights group by ints. Types are never renamed or deleted and there are a few hundred
+    at most, so the dictionary is kept in memory by `place_type_cache`.
+    """
+    __tablename__ = 'place_types'
+
+    id = Column(SmallInteger, primary_key=True, nullable=False)
+    name = Column(String, nullable=False, unique=True)
+
+    @classmethod
+    def get_or_create_many(cls, names):
+        """
+        Resolve place type names to ids, creating any missing types. Returns a dict mapping name to id.
+
+        Like `Place.get_or_create_many`, cached types are served without touching the db, the rest are resolved with
+        one upsert in the caller's transaction, and only types that already existed are cached.
+        """
+        ids = {}
+        missing = set()
+        for name in names:
+            type_id = place_type_cache.ids.get(name)
+            if type_id is not None:
+                ids[name] = type_id
+            else:
+                missing.add(name)
+
+        if not missing:
+            return ids
+
+        statement = insert(cls.__table__).values([{'name': name} for name in sorted(missing)])
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.__table__.c.name],
+            set_={'name': statement.excluded.name}
+        ).returning(
+            cls.__table__.c.id,
+            cls.__table__.c.name,
+            literal_column('xmax = 0').label('inserted')
+        )
+
+        for row in session.execute(statement):
+            ids[row.name] = row.id
+            place_type_cache.names[row.id] = row.name
+            if not row.inserted:
+                place_type_cache.ids[row.name] = row.id
+
+        return ids
+
+    @classmethod
+    def get_names(cls, type_ids):
+        """Return the names of place types by id, loading the dictionary if any of them isn't cached"""
+        if any(type_id not in place_type_cache.names for type_id in type_ids):
+            for row in session.query(cls.id, cls.name):
+                place_type_cache.names[row.id] = row.name
+
+        return [place_type_cache.names[type_id] for type_id in type_ids]
+
+
+class PlaceTypeCache:
+    """
+    In-memory copy of the `place_types` dictionary
+
+    `names` maps ids to names and `ids` maps names to ids. Ids are never reused, even when the transaction that
+    created a type is rolled back, so any id seen can be named. Only types known to be committed are in `ids`.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+
+    def add(self, type_id, name):
+        self.ids[name] = type_id
+        self.names[type_id] = name
+
+
+class SentimentRollup(Base):
+    """
+    Count of a user's mood events per day (UTC) and sentiment
+
+    Kept up to date in the same transaction as every mood event insert (see `moody.rollups`),
+    so time-range insights can sum a row per day instead of scanning mood events.
+    """
+    __tablename__ = 'sentiment_rollups'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    sentiment = Column(Sentiment, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class PlaceSentimentRollup(Base):
+    """
+    Count of a user's mood events per place and sentiment
+
+    Kept up to date in the same transaction that attaches places to mood events (see `moody.enrichment`).
+    """
+    __tablename__ = 'place_sentiment_rollups'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    place_id = Column(Integer, ForeignKey('places.id'), primary_key=True)
+    sentiment = Column(Sentiment, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class UserInsights(Base):
+    """
+    Insights of a user precomputed by the batch insights job (see `moody.batch`)
+
+    `data_version` is the user's `data_version` the insights were computed from. While it matches, and the time
+    range is the same, the row is up to date and the job skips the user.
+    """
+    __tablename__ = 'user_insights'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    data_version = Column(Integer, nullable=False)
+    created_after = Column(DateTime(timezone=True), nullable=False)
+    created_before = Column(DateTime(timezone=True), nullable=False)
+    frequency_distribution = Column(JSONB, nullable=False)
+    place_type_scores = Column(JSONB, nullable=False)
+    date_computed = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+
+# Bounded identity cache of Google `place_id` -> `places.id`. Replaced by `init_place_id_cache`.
+place_id_cache = None
+
+
+def init_place_id_cache():
+    """Create an empty `place_id_cache` holding up to `PLACE_ID_CACHE_SIZE` ids"""
+    global place_id_cache
+    place_id_cache = LRUCache(maxsize=config.PLACE_ID_CACHE_SIZE)
+    return place_id_cache
+
+
+init_place_id_cache()
+
+place_type_cache = PlaceTypeCache()
 
 
 class User(Base):
@@ -130,12 +417,20 @@ class User(Base):
     id = Column(Integer, nullable=False, primary_key=True)
 
     email = Column(String, nullable=False)
+    first_name = Column(String)
+    last_name = Column(String)
     _password = Column('password', String, nullable=False)
     date_created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
     date_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), onupdate=func.now())
+    date_password_changed = Column(DateTime(timezone=True))
+    # Bumped whenever the user's mood events or anything derived from them changes. Drives ETags and the
+    # response cache of read routes (see moody.conditional).
+    data_version = Column(Integer, nullable=False, default=0, server_default='0')
 
-    def __init__(self, email, password):
+    def __init__(self, email, password, first_name=None, last_name=None):
         self.email = email
+        self.first_name = first_name
+        self.last_name = last_name
         self.password = password
 
     @hybrid_property
@@ -145,9 +440,53 @@ class User(Base):
 
     @password.setter
     def password(self, password):
-        """Hash the password in a cryptographically secure way. We don't want to persist plain text passwords to the db."""
-        self._password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        """
+        Hash the password in a cryptographically secure way. We don't want to persist plain text passwords to the db.
+
+        Changing the password of an existing user invalidates tokens issued to them before now (see `moody.auth`).
+        """
+        if self._password is not None:
+            self.date_password_changed = datetime.now(timezone.utc)
+        self._password = hasher.hash(password)
 
     def password_equals(self, password):
         """Return True if User's password matches the given input"""
-        return bcrypt.checkpw(password.encode('utf-8'), self.password.encode('utf-8'))
+        return hasher.check(password, self.password)
+
+    def rehash_password_if_needed(self, password):
+        """
+        Rehash a verified password if it was hashed with a different work factor than the configured one.
+
+        Unlike setting `password`, this doesn't count as a password change, so existing tokens stay valid.
+        Return True if the hash was updated.
+        """
+        if not hasher.needs_rehash(self.password):
+            return False
+
+        self._password = hasher.hash(password)
+        return True
+
+    @classmethod
+    def get_data_version(cls, user_id):
+        """Return the `data_version` of a user"""
+        return session.query(cls.data_version).filter(cls.id == user_id).scalar()
+
+    @classmethod
+    def bump_data_version(cls, user_ids=None):
+        """
+        Increment the `data_version` of users (all users if `user_ids` is None) in the caller's transaction
+
+        Must be called by every write that changes what read routes return for a user.
+        """
+        statement = cls.__table__.update().values(
+            data_version=cls.data_version + 1,
+            # Not a change to the user itself
+            date_updated=cls.date_updated
+        )
+        if user_ids is not None:
+            user_ids = sorted(set(user_ids))
+            if not user_ids:
+                return
+            statement = statement.where(cls.id.in_(user_ids))
+
+        session.execute(statement)
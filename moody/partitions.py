@@ -0,0 +1,222 @@
+"""
+Monthly range partitioning of `mood_events` by `date_created` is managed here.
+
+Every query of mood events filters by user and time, so once `mood_events` is partitioned PostgreSQL only scans
+the partitions a time range overlaps, and each partition's indexes only cover a month of data. The current
+month's partition takes all writes and most reads, and stays small enough to be cache resident however much
+history accumulates.
+
+`convert` turns the table created by `Base.metadata.create_all` into a partitioned table, once. `maintain`, run
+periodically (e.g. daily with `flask maintain-partitions`), creates partitions ahead of time and archives old
+ones: they're detached and moved, with their `mood_events_places` links, to the archive schema (and tablespace),
+where they stay queryable without bloating the hot tables. Archived mood events drop out of the API: archiving
+subtracts them from the rollups, so later rebuilds agree, and bumps the data version of their users (see
+moody.conditional).
+
+This is PostgreSQL only. Unique constraints of a partitioned table must include the partition key, so the primary
+key becomes (id, date_created), and `mood_events_places.mood_event_id` can't reference `mood_events` anymore.
+"""
+from datetime import datetime, timezone
+import logging
+import re
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from moody import config, rollups
+from moody.db import session
+from moody.models import MoodEvent, User, mood_events_places
+
+logger = logging.getLogger(__name__)
+
+TABLE = MoodEvent.__tablename__
+
+# e.g. mood_events_y2018m01 holds mood events created in January 2018 (UTC)
+PARTITION_NAME = re.compile(rf'^{TABLE}_y(\d{{4}})m(\d{{2}})$')
+
+quote = postgresql.dialect().identifier_preparer.quote
+
+
+def month_start(moment):
+    """Return the start of the UTC month of a datetime. Naive datetimes are assumed to be in UTC."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month):
+    return f'{TABLE}_y{month.year:04d}m{month.month:02d}'
+
+
+def partition_month(name):
+    """Return the month a partition holds, or None if `name` isn't a monthly partition"""
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+
+
+def plan(existing, now, months_ahead=None, hot_months=None):
+    """
+    Return (months to create partitions for, months of partitions to archive)
+
+    `existing` is the months of the attached partitions. Partitions are kept from the current month to
+    `months_ahead` months ahead, and partitions before the last `hot_months` months are archived. They default to
+    `PARTITION_MONTHS_AHEAD` and `PARTITION_HOT_MONTHS`.
+    """
+    months_ahead = config.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    hot_months = config.PARTITION_HOT_MONTHS if hot_months is None else hot_months
+    current = month_start(now)
+    existing = set(existing)
+
+    to_create = [
+        month
+        for month in (add_months(current, offset) for offset in range(months_ahead + 1))
+        if month not in existing
+    ]
+    oldest_hot = add_months(current, 1 - max(hot_months, 1))
+    to_archive = sorted(month for month in existing if month < oldest_hot)
+
+    return to_create, to_archive
+
+
+def is_partitioned():
+    return session.execute(
+        text('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table))'),
+        {'table': TABLE}
+    ).scalar()
+
+
+def attached_months():
+    """Return the months of the partitions attached to `mood_events`"""
+    rows = session.execute(
+        text(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(:table)'
+        ),
+        {'table': TABLE}
+    ).fetchall()
+
+    return [month for month in (partition_month(row[0]) for row in rows) if month is not None]
+
+
+def create_partition(month):
+    """Create the partition of a month in the caller's transaction. Indexes of `mood_events` are created with it."""
+    session.execute(text(
+        f'CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {TABLE} '
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    ))
+
+
+def archive_partition(month, schema=None, tablespace=None):
+    """
+    Detach the partition of a month and move it, with its links to places, to `schema` in the caller's transaction
+
+    `schema` and `tablespace` default to `PARTITION_ARCHIVE_SCHEMA` and `PARTITION_ARCHIVE_TABLESPACE`.
+    Mood events in the partition are subtracted from the rollups, and their users get their data version bumped, so
+    cached responses and ETags including those mood events are invalidated.
+    """
+    name = partition_name(month)
+    links = mood_events_places.name
+    schema = quote(schema or config.PARTITION_ARCHIVE_SCHEMA)
+    tablespace = tablespace or config.PARTITION_ARCHIVE_TABLESPACE
+
+    session.execute(text(f'CREATE SCHEMA IF NOT EXISTS {schema}'))
+    session.execute(text(f'CREATE TABLE IF NOT EXISTS {schema}.{links} (LIKE {links} INCLUDING ALL)'))
+
+    user_ids = [row[0] for row in session.execute(text(f'SELECT DISTINCT user_id FROM {name}')).fetchall()]
+    User.bump_data_version(user_ids)
+    rollups.forget(name, month.date(), add_months(month, 1).date())
+
+    session.execute(text(f'ALTER TABLE {TABLE} DETACH PARTITION {name}'))
+    session.execute(text(
+        f'WITH moved AS ('
+        f'DELETE FROM {links} USING {name} WHERE {links}.mood_event_id = {name}.id RETURNING {links}.*'
+        f') INSERT INTO {schema}.{links} SELECT * FROM moved'
+    ))
+    session.execute(text(f'ALTER TABLE {name} SET SCHEMA {schema}'))
+
+    if tablespace:
+        session.execute(text(f'ALTER TABLE {schema}.{name} SET TABLESPACE {quote(tablespace)}'))
+
+
+def convert(now=None, months_ahead=None):
+    """
+    Turn an unpartitioned `mood_events` into a partitioned table and copy its rows over, in a single transaction
+
+    Partitions are created from the month of the oldest mood event to `months_ahead` (default:
+    `PARTITION_MONTHS_AHEAD`) months ahead.
+    `mood_events` is locked exclusively while rows are copied, so plan for downtime on large tables.
+    """
+    now = now or datetime.now(timezone.utc)
+    months_ahead = config.PARTITION_MONTHS_AHEAD if months_ahead is None else months_ahead
+    old = f'{TABLE}_unpartitioned'
+
+    try:
+        session.execute(text(f'LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE'))
+
+        # Links can't reference a partitioned table by id alone. The primary key and indexes are recreated on the
+        # partitioned table under the same names.
+        links = mood_events_places.name
+        session.execute(text(f'ALTER TABLE {links} DROP CONSTRAINT IF EXISTS {links}_mood_event_id_fkey'))
+        session.execute(text(f'ALTER TABLE {TABLE} RENAME TO {old}'))
+        session.execute(text(f'ALTER TABLE {old} DROP CONSTRAINT {TABLE}_pkey'))
+        for index in MoodEvent.__table__.indexes:
+            session.execute(text(f'DROP INDEX {index.name}'))
+
+        session.execute(text(
+            f'CREATE TABLE {TABLE} (LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+            'PARTITION BY RANGE (date_created)'
+        ))
+        session.execute(text(f'ALTER SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id'))
+        session.execute(text(f'ALTER TABLE {TABLE} ADD PRIMARY KEY (id, date_created)'))
+        session.execute(text(f'ALTER TABLE {TABLE} ADD FOREIGN KEY (user_id) REFERENCES users (id)'))
+        for index in MoodEvent.__table__.indexes:
+            index.create(bind=session.connection())
+
+        oldest = session.execute(text(f'SELECT min(date_created) FROM {old}')).scalar()
+        month = month_start(oldest or now)
+        last = add_months(month_start(now), months_ahead)
+        while month <= last:
+            create_partition(month)
+            month = add_months(month, 1)
+
+        session.execute(text(f'INSERT INTO {TABLE} SELECT * FROM {old}'))
+        session.execute(text(f'DROP TABLE {old}'))
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+def maintain(now=None, months_ahead=None, hot_months=None):
+    """
+    Create upcoming partitions and archive old ones (see `plan`)
+
+    Each partition is archived in its own transaction, so `mood_events` is only locked briefly at a time.
+    Return the names of the (created, archived) partitions.
+    """
+    now = now or datetime.now(timezone.utc)
+    to_create, to_archive = plan(attached_months(), now, months_ahead, hot_months)
+
+    try:
+        for month in to_create:
+            create_partition(month)
+        session.commit()
+
+        for month in to_archive:
+            archive_partition(month)
+            session.commit()
+            logger.info('Archived partition %s', partition_name(month))
+    except Exception:
+        session.rollback()
+        raise
+
+    return [partition_name(month) for month in to_create], [partition_name(month) for month in to_archive]
@@ -0,0 +1,91 @@
+"""
+Password hashing and verification are defined here.
+
+bcrypt is deliberately slow, so its work runs on a small bounded pool of threads (bcrypt releases the GIL while
+hashing). That caps how much CPU password work can take at once, so a login storm can't starve other requests.
+When the pool and its queue are full, callers get a fast `ServiceUnavailableError` instead of piling up.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import os
+import threading
+
+import bcrypt
+
+from moody import config
+from moody.exceptions import ServiceUnavailableError
+
+
+class PasswordHasher:
+    """Runs bcrypt on a bounded executor with backpressure. Settings left out default to `moody.config`."""
+
+    def __init__(self, rounds=None, workers=None, queue_size=None, timeout=None):
+        self._executor = None
+        self.configure(rounds, workers, queue_size, timeout)
+
+    def configure(self, rounds=None, workers=None, queue_size=None, timeout=None):
+        """Apply settings (the ones left out are read from `moody.config` again) and replace the executor"""
+        self.rounds = config.BCRYPT_ROUNDS if rounds is None else rounds
+        self.workers = config.BCRYPT_WORKERS if workers is None else workers
+        self.queue_size = config.BCRYPT_QUEUE_SIZE if queue_size is None else queue_size
+        self.timeout = config.BCRYPT_TIMEOUT if timeout is None else timeout
+
+        if self._executor is not None:
+            # Operations in progress finish on the old executor and release slots of the old semaphore
+            self._executor.shutdown(wait=False)
+        self._start()
+
+    def _start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+        # Bounds work that is either running or waiting for a worker
+        self._slots = threading.BoundedSemaphore(self.workers + self.queue_size)
+
+    def reset_after_fork(self):
+        """Replace the executor in a forked child, where the parent's worker threads don't exist"""
+        self._start()
+
+    def hash(self, password):
+        """Return the bcrypt hash of `password` using the configured work factor"""
+        return self._run(self._hash, password)
+
+    def check(self, password, hashed):
+        """Return True if `password` matches `hashed`"""
+        return self._run(self._check, password, hashed)
+
+    def needs_rehash(self, hashed):
+        """Return True if `hashed` was made with a different work factor than the configured one"""
+        return cost_of(hashed) != self.rounds
+
+    def _run(self, fn, *args):
+        # The slot is released to the semaphore it was taken from, even if `configure` replaces it meanwhile
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise ServiceUnavailableError("Too many concurrent password operations. Please try again later.")
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+
+        future.add_done_callback(lambda _: slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise ServiceUnavailableError("Timed out waiting for password operation. Please try again later.")
+
+    def _hash(self, password):
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(self.rounds)).decode('utf-8')
+
+    @staticmethod
+    def _check(password, hashed):
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+def cost_of(hashed):
+    """Return the work factor of a bcrypt hash, e.g. 12 for '$2b$12$...'"""
+    return int(hashed.split('$')[2])
+
+
+hasher = PasswordHasher()
+os.register_at_fork(after_in_child=hasher.reset_after_fork)
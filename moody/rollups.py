@@ -0,0 +1,167 @@
+"""
+Incrementally maintained sentiment rollups are defined here.
+
+`SentimentRollup` holds per-user, per-day (UTC) sentiment counts and `PlaceSentimentRollup` holds per-user,
+per-place sentiment counts. Both are incremented in the same transaction that writes the underlying rows,
+decremented by `forget` when mood events are archived, and can be rebuilt from scratch with `rebuild`.
+"""
+from collections import Counter
+from datetime import timezone
+
+from sqlalchemy import Date, and_, bindparam, cast, column, func, literal_column, select, table, text
+from sqlalchemy.dialects.postgresql import insert
+
+from moody.db import session
+from moody.models import MoodEvent, User, Sentiment, SentimentRollup, PlaceSentimentRollup, mood_events_places
+
+
+def utc_day(moment):
+    """Return the UTC date of a datetime. Naive datetimes are assumed to be in UTC."""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc)
+    return moment.date()
+
+
+def increment(model, counts):
+    """
+    Add `counts`, a Counter keyed by the model's primary key columns (minus `count`), to rollup rows
+
+    Rows are upserted in key order, so concurrent transactions lock them in the same order and can't deadlock.
+    """
+    if not counts:
+        return
+
+    table = model.__table__
+    key_columns = [column.name for column in table.primary_key.columns]
+
+    statement = insert(table).values([
+        dict(zip(key_columns, key), count=count)
+        for key, count in sorted(counts.items())
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={'count': table.c.count + statement.excluded.count}
+    )
+
+    session.execute(statement)
+
+
+def record_mood_events(mood_events):
+    """
+    Count new mood events into `SentimentRollup`. Must be called in the transaction that inserts them.
+
+    `mood_events` can be MoodEvent instances or rows, as long as they have `user_id`, `date_created` and `sentiment`.
+    """
+    counts = Counter(
+        (mood_event.user_id, utc_day(mood_event.date_created), mood_event.sentiment)
+        for mood_event in mood_events
+    )
+    increment(SentimentRollup, counts)
+
+
+def record_places(links):
+    """
+    Count new links between mood events and places into `PlaceSentimentRollup`.
+    Must be called in the transaction that inserts the links.
+
+    `links` is an iterable of (user_id, place primary key, sentiment) tuples.
+    """
+    increment(PlaceSentimentRollup, Counter(links))
+
+
+def forget(mood_events, start, end):
+    """
+    Subtract the mood events of the table named `mood_events`, e.g. a partition being archived, from rollups.
+    Must be called in the transaction that takes them out of `mood_events`, while their links to places exist.
+
+    The table must hold every mood event created in [`start`, `end`) and no others. Both are UTC days, so the daily
+    rollups of that range are deleted outright. Place rollups are decremented in key order, and the ones left at
+    zero are deleted, so rollups keep matching what `rebuild` computes.
+    """
+    daily = SentimentRollup.__table__
+    session.execute(daily.delete().where(and_(daily.c.day >= start, daily.c.day < end)))
+
+    archived = table(mood_events, column('id'), column('user_id'), column('sentiment', Sentiment))
+    counts = session.execute(
+        select([archived.c.user_id, mood_events_places.c.place_id, archived.c.sentiment, func.count()])
+        .select_from(archived.join(mood_events_places, mood_events_places.c.mood_event_id == archived.c.id))
+        .group_by(archived.c.user_id, mood_events_places.c.place_id, archived.c.sentiment)
+    ).fetchall()
+
+    if not counts:
+        return
+
+    places = PlaceSentimentRollup.__table__
+    session.execute(
+        places.update()
+        .where(and_(
+            places.c.user_id == bindparam('key_user_id'),
+            places.c.place_id == bindparam('key_place_id'),
+            places.c.sentiment == bindparam('key_sentiment')
+        ))
+        .values(count=places.c.count - bindparam('archived')),
+        [
+            {'key_user_id': user_id, 'key_place_id': place_id, 'key_sentiment': sentiment, 'archived': count}
+            for user_id, place_id, sentiment, count in sorted(counts)
+        ]
+    )
+    session.execute(places.delete().where(and_(
+        places.c.count <= 0,
+        places.c.user_id.in_(sorted({row[0] for row in counts}))
+    )))
+
+
+def rebuild(user_id=None):
+    """
+    Recompute rollups from `mood_events`, for one user or for everyone, and commit.
+
+    The rollup tables are locked for the duration, so concurrent inserts wait and then apply their increments on
+    top of the rebuilt counts rather than being lost or counted twice.
+    Mood events in archived partitions (see moody.partitions) aren't counted, as `forget` took them out of the
+    rollups when they were archived.
+    """
+    try:
+        session.execute(text(
+            f'LOCK TABLE {SentimentRollup.__tablename__}, {PlaceSentimentRollup.__tablename__} '
+            'IN SHARE ROW EXCLUSIVE MODE'
+        ))
+
+        for model in (SentimentRollup, PlaceSentimentRollup):
+            query = model.query
+            if user_id is not None:
+                query = query.filter(model.user_id == user_id)
+            query.delete(synchronize_session=False)
+
+        day = cast(func.timezone('UTC', MoodEvent.date_created), Date)
+        daily = select([MoodEvent.user_id, day, MoodEvent.sentiment, func.count(MoodEvent.id)]) \
+            .group_by(MoodEvent.user_id, day, MoodEvent.sentiment)
+
+        places = select([
+            MoodEvent.user_id,
+            mood_events_places.c.place_id,
+            MoodEvent.sentiment,
+            func.count(literal_column('*'))
+        ]) \
+            .select_from(MoodEvent.__table__.join(
+                mood_events_places,
+                mood_events_places.c.mood_event_id == MoodEvent.id
+            )) \
+            .group_by(MoodEvent.user_id, mood_events_places.c.place_id, MoodEvent.sentiment)
+
+        if user_id is not None:
+            daily = daily.where(MoodEvent.user_id == user_id)
+            places = places.where(MoodEvent.user_id == user_id)
+
+        session.execute(SentimentRollup.__table__.insert().from_select(
+            ['user_id', 'day', 'sentiment', 'count'], daily
+        ))
+        session.execute(PlaceSentimentRollup.__table__.insert().from_select(
+            ['user_id', 'place_id', 'sentiment', 'count'], places
+        ))
+
+        User.bump_data_version(None if user_id is None else [user_id])
+
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
@@ -1,20 +1,39 @@
 """
 Routes for API are defined here.
 """
-from flask import Blueprint, jsonify, request, g
-
-from moody import geo
-from moody.auth import require_token
-from moody.db import session
-from moody.models import MoodEvent, Place, User
-from moody.schemas import CreateMoodEventSchema, MoodEventSchema, CreateUserSchema, UserSchema
+import json
+
+from flask import Blueprint, Response, request, g, stream_with_context
+from marshmallow import ValidationError
+
+from moody import auth, config, export, insights, rollups
+from moody.auth import current_user, require_token
+from moody.conditional import conditional_get
+from moody.db import read_only, session
+from moody.enrichment import enrichment_queue
+from moody.exceptions import UnauthorizedError
+from moody.metrics import stage
+from moody.models import MoodEvent, User
+from moody.serialization import get_schema, json_response
+from moody.schemas import (
+    CreateMoodEventSchema,
+    CreateTokenSchema,
+    CreateUserSchema,
+    Cursor,
+    ExportQuerySchema,
+    MoodEventQuerySchema,
+    MoodEventSchema,
+    PlaceTypeInsightsQuerySchema,
+    TimeHistogramsQuerySchema,
+    UserSchema
+)
 
 
 main = Blueprint('main', __name__)
 
 
-@require_token
 @main.route('/mood_events', methods=['POST'])
+@require_token
 def create_mood_event():
     """
     Create a mood event from request data
@@ -23,93 +42,316 @@ def create_mood_event():
     1. Require user auth
     2. Validate request data
     3. Instantiate MoodEvent from request data
-    4. Query places near mood event coords from Google Places API
-    5. Get or create these places for our db
-    6. Associate mood event with places
-    7. Commit mood event and any new places to db
-    8. Return serialized/jsonified mood event
+    4. Count mood event into sentiment rollups and bump the user's data version (see moody.conditional)
+    5. Commit mood event and rollups to db
+    6. Enqueue mood event for place enrichment (see moody.enrichment)
+    7. Return serialized/jsonified mood event
     """
-    request_body = request.get_json()
-    kwargs = CreateMoodEventSchema(strict=True).load(request_body).data
+    with stage('validation'):
+        request_body = request.get_json()
+        kwargs = get_schema(CreateMoodEventSchema, strict=True).load(request_body).data
 
-    user = User.query.filter(User.email == g.validated_token['email']).one()
-    mood_event = MoodEvent(**kwargs)
+    mood_event = MoodEvent(user_id=g.user_id, **kwargs)
+
+    with stage('insert'):
+        session.add(mood_event)
+        session.flush()
+    with stage('rollups'):
+        rollups.record_mood_events([mood_event])
+        User.bump_data_version([g.user_id])
+    with stage('commit'):
+        session.commit()
+
+    enrichment_queue.enqueue(mood_event.id)
+
+    status = 201
+    with stage('serialization'):
+        response_body = {
+            'data': get_schema(MoodEventSchema).dump(mood_event).data,
+            'status': status
+        }
+
+    return json_response(response_body, status)
 
-    places_from_google_api = geo.google_places_from_coord(
-        latitude=mood_event.latitude,
-        longitude=mood_event.longitude
-    )
 
-    places_from_db = [
-        Place.get_or_create(**place)
-        for place in places_from_google_api
-    ]
+@main.route('/mood_events/batch', methods=['POST'])
+@require_token
+def create_mood_events_batch():
+    """
+    Create many mood events at once, e.g. when a client replays events it buffered offline
+
+    The request body is either a JSON array of mood events or NDJSON (`Content-Type: application/x-ndjson`).
+
+    Steps:
+    1. Require user auth
+    2. Parse and validate every item, collecting errors per item
+    3. Take the user id from the validated token, once for the whole batch
+    4. Bulk insert valid mood events, count them into sentiment rollups and bump the user's data version
+       in a single transaction
+    5. Enqueue inserted mood events for place enrichment. Workers dedupe place lookups across the batch
+       since nearby events share a cached geo cell.
+    6. Return the id of each created item and the errors of each rejected item, keyed by position in the batch
+    """
+    with stage('validation'):
+        items = parse_batch_body()
+        valid_items, errors = load_batch_items(items)
+
+    if not valid_items:
+        status = 400
+        response_body = {
+            'message': 'No valid mood events in batch.',
+            'errors': errors,
+            'status': status
+        }
+        return json_response(response_body, status)
+
+    table = MoodEvent.__table__
+    rows = [dict(kwargs, user_id=g.user_id) for _, kwargs in valid_items]
+    statement = table.insert().values(rows).returning(
+        table.c.id,
+        table.c.user_id,
+        table.c.date_created,
+        table.c.sentiment
+    )
+    with stage('insert'):
+        inserted = session.execute(statement).fetchall()
+    with stage('rollups'):
+        rollups.record_mood_events(inserted)
+        User.bump_data_version([g.user_id])
+    with stage('commit'):
+        session.commit()
 
-    mood_event.places = places_from_db
+    mood_event_ids = [row.id for row in inserted]
 
-    session.add(mood_event)
-    session.commit()
+    enrichment_queue.enqueue_many(mood_event_ids)
 
     status = 201
     response_body = {
-        'data': MoodEventSchema().dump(mood_event).data,
+        'data': {
+            'created': [
+                {'index': index, 'id': mood_event_id}
+                for (index, _), mood_event_id in zip(valid_items, mood_event_ids)
+            ],
+            'errors': errors,
+        },
         'status': status
     }
 
-    return jsonify(response_body), status
+    return json_response(response_body, status)
+
+
+def load_batch_items(items):
+    """
+    Validate batch items one by one. Return ([(index, kwargs) of valid items], {index: errors of invalid items}).
+
+    Items that aren't JSON objects are rejected under their own index too, so clients can tell which ones failed.
+    """
+    schema = get_schema(CreateMoodEventSchema)
+    valid_items = []
+    errors = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = {'_schema': ['Mood event must be a JSON object.']}
+            continue
+
+        result = schema.load(item)
+        if result.errors:
+            errors[index] = result.errors
+        else:
+            valid_items.append((index, result.data))
+
+    return valid_items, errors
+
+
+def parse_batch_body():
+    """Return the list of items in a batch request body, which is either a JSON array or NDJSON"""
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            items = [
+                json.loads(line)
+                for line in request.get_data(as_text=True).splitlines()
+                if line.strip()
+            ]
+        except ValueError as error:
+            raise ValidationError(f"Invalid NDJSON: {error}")
+    else:
+        items = request.get_json()
+
+    if not isinstance(items, list):
+        raise ValidationError("Request body must be a JSON array or NDJSON.")
+
+    if len(items) > config.MOOD_EVENTS_BATCH_LIMIT:
+        raise ValidationError(f"Batch must have at most {config.MOOD_EVENTS_BATCH_LIMIT} items (given: {len(items)}).")
+
+    return items
 
 
-@require_token
 @main.route('/mood_events', methods=['GET'])
-def get_mood_events(**kwargs):
-    """Get mood events"""
-    user = User.query.filter(User.email == g.validated_token['email']).one()
+@require_token
+@read_only
+@conditional_get
+def get_mood_events():
+    """
+    Get a page of the user's mood events, newest first
+
+    Supports `sentiment`, `created-after` and `created-before` filters, and `limit` + `cursor` for pagination.
+    The response includes `next_cursor`, which is null on the last page, and the `user` all mood events belong to.
+    Served from a read replica when configured, so events created moments ago may be missing for a moment.
+    """
+    with stage('validation'):
+        kwargs = get_schema(MoodEventQuerySchema, strict=True).load(request.args).data
+    limit = kwargs['limit']
 
     query = MoodEvent.apply_query_params(kwargs)
-    query = query.filter(MoodEvent.user_id == user.id)
-    mood_events = query.all()
+    query = query.filter(MoodEvent.user_id == g.user_id)
+    with stage('query'):
+        # Fetch one extra row to know whether there's a next page
+        mood_events = query.limit(limit + 1).all()
+        user = current_user()
+
+    next_cursor = None
+    if len(mood_events) > limit:
+        mood_events = mood_events[:limit]
+        last = mood_events[-1]
+        next_cursor = (last.date_created, last.id)
+
+    # Every mood event belongs to the current user, so the user is serialized once rather than nested in each event
+    status = 200
+    with stage('serialization'):
+        response_body = {
+            'data': get_schema(MoodEventSchema, many=True, exclude=('user',)).dump(mood_events).data,
+            'user': get_schema(UserSchema).dump(user).data,
+            'next_cursor': Cursor().serialize('next_cursor', {'next_cursor': next_cursor}),
+            'status': status
+        }
+
+    return json_response(response_body, status)
+
+
+@main.route('/mood_events/export', methods=['GET'])
+@require_token
+@read_only
+def export_mood_events():
+    """
+    Stream the user's complete mood history, oldest first, as a file download
+
+    Query parameters: `format` (ndjson, csv, parquet or arrow), `created-after` and `created-before`.
+    Rows are streamed from a server-side cursor and encoded chunk by chunk (see moody.export), so the response
+    starts right away and memory use stays flat however long the history is. The stream reads from a replica
+    when one is configured.
+    """
+    with stage('validation'):
+        kwargs = get_schema(ExportQuerySchema, strict=True).load(request.args).data
+
+    mimetype, extension, _ = export.FORMATS[kwargs['format']]
+    chunks = export.export_mood_events(g.user_id, **kwargs)
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=mood_events.{extension}'
+    return response
+
+
+@main.route('/insights/place-types', methods=['GET'])
+@require_token
+@read_only
+@conditional_get
+def get_place_type_insights():
+    """
+    Get how happy the user is near each type of place
+
+    See `insights.get_place_type_scores`. The proximity radius in meters can be set with `radius`.
+    """
+    with stage('validation'):
+        kwargs = get_schema(PlaceTypeInsightsQuerySchema, strict=True).load(request.args).data
+
+    with stage('insights'):
+        scores = insights.get_place_type_scores(current_user(), **kwargs)
+
+    status = 200
+    response_body = {
+        'data': scores,
+        'status': status
+    }
+
+    return json_response(response_body, status)
+
+
+@main.route('/insights/histograms', methods=['GET'])
+@require_token
+@read_only
+@conditional_get
+def get_time_histograms():
+    """
+    Get the user's sentiment histograms by hour of day and weekday in a timezone
+
+    Query parameters: `created-after`, `created-before` and `tz` (IANA name, defaults to UTC).
+    See `insights.get_time_histograms`.
+
+    Clients poll this route. A matching `If-None-Match` is answered with 304 before any aggregation runs,
+    see moody.conditional.
+    """
+    with stage('validation'):
+        kwargs = get_schema(TimeHistogramsQuerySchema, strict=True).load(request.args).data
+
+    with stage('insights'):
+        histograms = insights.get_time_histograms(current_user(), **kwargs)
 
     status = 200
     response_body = {
-        'data': MoodEventSchema(many=True).dump(mood_events).data,
+        'data': histograms,
         'status': status
     }
 
-    return jsonify(response_body), status
+    return json_response(response_body, status)
 
 
 @main.route('/users', methods=['POST'])
 def create_user():
     """Create a user"""
-    request_body = request.get_json()
-    kwargs = CreateUserSchema(strict=True).load(request_body).data
+    with stage('validation'):
+        request_body = request.get_json()
+        kwargs = get_schema(CreateUserSchema, strict=True).load(request_body).data
 
-    user = User(**kwargs)
+    with stage('password_hash'):
+        user = User(**kwargs)
     session.add(user)
-    session.commit()
+    with stage('commit'):
+        session.commit()
 
     status = 201
     response_body = {
-        'data': UserSchema().dump(user).data,
+        'data': get_schema(UserSchema).dump(user).data,
         'status': status
     }
 
-    return jsonify(response_body), status
+    return json_response(response_body, status)
 
 
 @main.route('/tokens', methods=['POST'])
 def create_token():
-    """Route to issue a token for a user based on authentication request"""
-    request_body = request.get_json()
-    kwargs = CreateTokenSchema(strict=True).load(request_body).data
+    """
+    Route to issue a token for a user based on authentication request
+
+    Password verification runs on the bounded bcrypt executor (see moody.passwords),
+    which responds with 503 rather than queueing without bound during login storms.
+    """
+    with stage('validation'):
+        request_body = request.get_json()
+        kwargs = get_schema(CreateTokenSchema, strict=True).load(request_body).data
 
-    user = User.query.filter(User.email == kwargs['email']).one_or_none()
+    with stage('query'):
+        user = User.query.filter(User.email == kwargs['email']).one_or_none()
 
     if not user:
         raise UnauthorizedError("User with email does not exist or password is incorrect.")
 
-    if not user.is_password_valid(kwargs['password']):
-        raise UnauthorizedError("User with email does not exist or password is incorrect.")
+    with stage('password_check'):
+        if not user.password_equals(kwargs['password']):
+            raise UnauthorizedError("User with email does not exist or password is incorrect.")
+
+    # Transparently upgrade the hash when the configured bcrypt work factor has changed
+    if user.rehash_password_if_needed(kwargs['password']):
+        session.commit()
 
     token = auth.create_token(user)
 
@@ -119,11 +361,11 @@ def create_token():
         'data': token
     }
 
-    return jsonify(response_body), status
+    return json_response(response_body, status)
 
 
-@require_token
 @main.route('/tokeninfo', methods=['GET'])
+@require_token
 def get_token_info():
     """Route to validate token and return token payload without db access"""
     status = 200
@@ -132,4 +374,4 @@ def get_token_info():
         'data': g.validated_token
     }
 
-    return jsonify(response_body), status
+    return json_response(response_body, status)
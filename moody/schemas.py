@@ -1,5 +1,60 @@
 """Request schemas are defined here"""
-from marshmallow import Schema, ValidationError, fields, validates
+from functools import lru_cache
+import base64
+import json
+import zoneinfo
+
+from marshmallow import Schema, ValidationError, fields, validate, validates
+import arrow
+
+from moody import config, export
+
+SENTIMENTS = {'happy', 'sad', 'neutral'}
+
+
+@lru_cache(maxsize=None)
+def timezone_names():
+    """
+    Names of the IANA timezone database, which PostgreSQL's `timezone()` understands too
+
+    Some systems add a `localtime` link to their copy of the database. It isn't an IANA name, so it's left out.
+    """
+    return frozenset(zoneinfo.available_timezones() - {'localtime'})
+
+
+class DateTimeParam(fields.Field):
+    """Datetime query parameter given either in ISO 8601 or as MM-DD-YY (e.g. `created-after=12-11-17`)"""
+
+    def _deserialize(self, value, attr, data):
+        for formats in ([], ['MM-DD-YY']):
+            try:
+                return arrow.get(value, *formats).datetime
+            except (arrow.parser.ParserError, ValueError, TypeError):
+                continue
+
+        raise ValidationError(f"Must be an ISO 8601 datetime or MM-DD-YY (given: {value}).")
+
+
+class Cursor(fields.Field):
+    """
+    Opaque pagination cursor encoding the (date_created, id) of the last mood event of a page
+
+    Serializes from and deserializes to a (datetime, id) tuple.
+    """
+
+    def _serialize(self, value, attr, obj):
+        if value is None:
+            return None
+        date_created, mood_event_id = value
+        payload = json.dumps([date_created.isoformat(), mood_event_id]).encode('utf-8')
+        return base64.urlsafe_b64encode(payload).decode('ascii')
+
+    def _deserialize(self, value, attr, data):
+        try:
+            date_created, mood_event_id = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+            return arrow.get(date_created).datetime, int(mood_event_id)
+        except (ValueError, TypeError, arrow.parser.ParserError):
+            raise ValidationError("Invalid cursor.")
 
 
 class MoodEventSchema(Schema):
@@ -7,6 +62,8 @@ class MoodEventSchema(Schema):
     sentiment = fields.Str()
     longitude = fields.Float()
     latitude = fields.Float()
+    date_created = fields.DateTime()
+    enrichment_status = fields.Str()
     user = fields.Nested('UserSchema')
     places = fields.Nested('PlaceSchema', many=True)
 
@@ -20,12 +77,10 @@ class CreateMoodEventSchema(Schema):
     @validates('sentiment')
     def validate_sentiment(self, value):
         """Sentiment validation logic goes here"""
-        sentiments = {'happy', 'sad', 'neutral'}
-
-        if value not in sentiments:
-            raise ValidationError(f"Sentiment must be one of {list(sentiments)} (given: {value}).")
+        if value not in SENTIMENTS:
+            raise ValidationError(f"Sentiment must be one of {list(SENTIMENTS)} (given: {value}).")
 
-        return sentiments
+        return SENTIMENTS
 
     @validates('longitude')
     def validate_longitude(self, value):
@@ -40,8 +95,58 @@ class CreateMoodEventSchema(Schema):
             raise ValidationError(f"Latitude must be between -90 and 90 (given: {value}).")
 
 
+class MoodEventQuerySchema(Schema):
+    """Schema for loading query parameters of GET /mood_events"""
+    sentiment = fields.Str(validate=validate.OneOf(SENTIMENTS))
+    created_after = DateTimeParam(load_from='created-after')
+    created_before = DateTimeParam(load_from='created-before')
+    limit = fields.Int(missing=lambda: config.MOOD_EVENTS_PAGE_SIZE)
+    cursor = Cursor()
+
+    @validates('limit')
+    def validate_limit(self, value):
+        """Page size must be between 1 and `MOOD_EVENTS_MAX_PAGE_SIZE`, read on each load since schemas are cached"""
+        validate.Range(min=1, max=config.MOOD_EVENTS_MAX_PAGE_SIZE)(value)
+
+
+class PlaceTypeInsightsQuerySchema(Schema):
+    """Schema for loading query parameters of GET /insights/place-types"""
+    radius = fields.Int(validate=validate.Range(min=1, max=5000))
+
+
+class TimeHistogramsQuerySchema(Schema):
+    """Schema for loading query parameters of GET /insights/histograms"""
+    created_after = DateTimeParam(load_from='created-after')
+    created_before = DateTimeParam(load_from='created-before')
+    tz = fields.Str(missing='UTC')
+
+    @validates('tz')
+    def validate_tz(self, value):
+        """
+        Timezone must be a name from the IANA timezone database, e.g. America/Los_Angeles
+
+        Paths and POSIX TZ strings (e.g. UTC+3, where the offset's sign is the opposite of ISO 8601) are rejected.
+        """
+        if value not in timezone_names():
+            raise ValidationError(f"Unknown timezone (given: {value}).")
+
+
+class ExportQuerySchema(Schema):
+    """Schema for loading query parameters of GET /mood_events/export"""
+    format = fields.Str(missing='ndjson', validate=validate.OneOf(export.FORMATS))
+    created_after = DateTimeParam(load_from='created-after')
+    created_before = DateTimeParam(load_from='created-before')
+
+    @validates('format')
+    def validate_format(self, value):
+        """Arrow based formats need pyarrow"""
+        if value in export.FORMATS and value not in export.available_formats():
+            raise ValidationError(f"Format {value} requires pyarrow to be installed.")
+
+
 class PlaceSchema(Schema):
     """Schema for dumping a Place instance"""
+    place_id = fields.Str()
     name = fields.Str()
     latitude = fields.Float()
     longitude = fields.Float()
@@ -0,0 +1,84 @@
+"""
+Response serialization helpers are defined here.
+
+- `get_schema` reuses schema instances instead of building new ones on every request
+- `dumps` encodes JSON with the fastest backend installed (orjson, then ujson, then the standard library)
+- `json_response` builds a response, compressing large bodies with gzip or deflate when the client accepts it
+"""
+import gzip
+import json
+import threading
+import zlib
+
+from flask import request, current_app
+
+from moody import config
+from moody.metrics import stage
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+_schemas = threading.local()
+
+
+def get_schema(schema_class, **kwargs):
+    """
+    Return a cached instance of `schema_class` built with `kwargs`, e.g. `get_schema(MoodEventSchema, many=True)`
+
+    Marshmallow schemas keep per-call state on the instance, so instances are cached per thread.
+    """
+    cache = getattr(_schemas, 'cache', None)
+    if cache is None:
+        cache = _schemas.cache = {}
+
+    key = (schema_class, tuple(sorted(
+        (name, tuple(value) if isinstance(value, (list, set)) else value)
+        for name, value in kwargs.items()
+    )))
+    schema = cache.get(key)
+    if schema is None:
+        schema = cache[key] = schema_class(**kwargs)
+
+    return schema
+
+
+def dumps(obj):
+    """Encode `obj` as JSON bytes with the fastest backend available"""
+    if orjson is not None:
+        # Validation errors of batch loads are keyed by item index
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def json_response(body, status=200):
+    """
+    Build a JSON response for `body`
+
+    Bodies of at least `COMPRESSION_MIN_SIZE` bytes are compressed with gzip or deflate, if the client accepts either.
+    """
+    with stage('encode'):
+        data = dumps(body)
+        headers = {}
+
+        if len(data) >= config.COMPRESSION_MIN_SIZE:
+            headers['Vary'] = 'Accept-Encoding'
+            accepted = request.accept_encodings
+            if accepted['gzip']:
+                data = gzip.compress(data, compresslevel=config.COMPRESSION_LEVEL)
+                headers['Content-Encoding'] = 'gzip'
+            elif accepted['deflate']:
+                data = zlib.compress(data, config.COMPRESSION_LEVEL)
+                headers['Content-Encoding'] = 'deflate'
+
+    return current_app.response_class(data, status=status, headers=headers, mimetype='application/json')
@@ -0,0 +1,172 @@
+"""
+In-process spatial index of known places is defined here.
+
+Once the `places` table holds many rows, most new mood events fall near a place we already know about.
+`place_index` answers "places within r meters of (lat, lon)" from memory, and `places_near` only falls back to the
+Google Places API when local coverage around the coordinates is too thin.
+"""
+import math
+import threading
+import time
+
+from moody import config, geo
+from moody.db import session
+from moody.models import Place, PlaceType
+
+EARTH_RADIUS = 6371000.0
+
+# Refreshes re-scan this many ids below the highest one seen, to pick up places whose transaction committed after a
+# higher id was indexed
+REFRESH_OVERLAP = 1000
+
+
+def haversine(latitude_a, longitude_a, latitude_b, longitude_b):
+    """Great-circle distance in meters between two coordinates"""
+    phi_a = math.radians(latitude_a)
+    phi_b = math.radians(latitude_b)
+    d_phi = phi_b - phi_a
+    d_lambda = math.radians(longitude_b - longitude_a)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi_a) * math.cos(phi_b) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class PlaceIndex:
+    """
+    Uniform grid over latitude/longitude holding known places.
+
+    Cells are `cell_size` meters tall and the same number of degrees wide. A radius query scans the cells overlapping
+    the bounding box of the circle, then filters candidates by exact distance.
+    Entries are stored as the same place dicts `moody.geo` returns, so they can be used interchangeably.
+    """
+
+    def __init__(self, cell_size=None, refresh_interval=None):
+        self._refresh_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.configure(cell_size, refresh_interval)
+
+    def configure(self, cell_size=None, refresh_interval=None):
+        """Apply settings (the ones left out are read from `moody.config` again) and empty the index"""
+        with self._refresh_lock, self._write_lock:
+            self.step = (cell_size or config.SPATIAL_INDEX_CELL_SIZE) / geo.METERS_PER_DEGREE
+            self.refresh_interval = config.SPATIAL_INDEX_REFRESH if refresh_interval is None else refresh_interval
+            self.max_id = 0
+            self.refreshed_at = None
+            self._cells = {}
+            self._place_ids = set()
+
+    def __len__(self):
+        return len(self._place_ids)
+
+    def cell(self, latitude, longitude):
+        return math.floor(latitude / self.step), math.floor(longitude / self.step)
+
+    def add(self, place):
+        """Add a place dict (`place_id`, `name`, `types`, `latitude`, `longitude`) to the index, unless it's known"""
+        key = self.cell(place['latitude'], place['longitude'])
+
+        with self._write_lock:
+            if place['place_id'] in self._place_ids:
+                return
+
+            self._place_ids.add(place['place_id'])
+            self._cells.setdefault(key, []).append(place)
+
+    def nearby(self, latitude, longitude, radius=None):
+        """Return places within `radius` meters (default: `PLACES_SEARCH_RADIUS`) of the coordinates, closest first"""
+        radius = radius or config.PLACES_SEARCH_RADIUS
+        lat_delta = radius / geo.METERS_PER_DEGREE
+        lon_delta = radius / (geo.METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+
+        min_row, min_column = self.cell(latitude - lat_delta, longitude - lon_delta)
+        max_row, max_column = self.cell(latitude + lat_delta, longitude + lon_delta)
+
+        results = []
+        for row in range(min_row, max_row + 1):
+            for column in range(min_column, max_column + 1):
+                for place in self._cells.get((row, column), ()):
+                    distance = haversine(latitude, longitude, place['latitude'], place['longitude'])
+                    if distance <= radius:
+                        results.append((distance, place))
+
+        results.sort(key=lambda result: result[0])
+
+        return [place for _, place in results]
+
+    def refresh(self, chunk_size=10000, overlap=REFRESH_OVERLAP):
+        """
+        Load places added to the db since the last refresh. The first refresh loads every place.
+
+        Places are append-only, so refreshes resume from the highest primary key seen. Ids are assigned when rows
+        are inserted rather than when they commit, so a place can show up after higher ids were indexed. Each refresh
+        re-scans the last `overlap` ids to catch those, and `add` skips places already indexed.
+        """
+        with self._refresh_lock:
+            last_id = max(self.max_id - overlap, 0)
+            try:
+                while True:
+                    rows = session.query(
+                        Place.id,
+                        Place.place_id,
+                        Place.name,
+                        Place.type_ids,
+                        Place.latitude,
+                        Place.longitude
+                    ) \
+                        .filter(Place.id > last_id, Place.place_id.isnot(None)) \
+                        .order_by(Place.id) \
+                        .limit(chunk_size) \
+                        .all()
+
+                    for row in rows:
+                        self.add({
+                            'place_id': row.place_id,
+                            'name': row.name,
+                            'types': PlaceType.get_names(row.type_ids),
+                            'latitude': row.latitude,
+                            'longitude': row.longitude,
+                        })
+
+                    if rows:
+                        last_id = rows[-1].id
+                        self.max_id = max(self.max_id, last_id)
+                    if len(rows) < chunk_size:
+                        break
+            finally:
+                session.remove()
+
+            self.refreshed_at = time.monotonic()
+
+    def refresh_if_stale(self):
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.refresh_interval:
+            self.refresh()
+
+
+place_index = PlaceIndex()
+
+
+def places_near(latitude, longitude, min_results=None):
+    """
+    Return places near the coordinates, preferring places we already know about.
+
+    If the local index has at least `min_results` (default: `PLACES_LOCAL_MIN_RESULTS`) places within the search
+    radius, those are used.
+    Otherwise local coverage is too thin and the Google Places API is queried. Set `min_results` to 0 to never
+    call the API, or to a very large number to always call it.
+
+    Raises `PlacesUnavailableError` when the API is needed but unavailable, so enrichment is retried rather than
+    attaching no places.
+    """
+    if min_results is None:
+        min_results = config.PLACES_LOCAL_MIN_RESULTS
+
+    places = place_index.nearby(latitude, longitude)
+
+    if len(places) >= min_results:
+        return places
+
+    places = geo.nearby_places(latitude=latitude, longitude=longitude)
+    for place in places:
+        place_index.add(place)
+
+    return places
@@ -0,0 +1,8 @@
+"""
+App created from the environment, for WSGI servers and the Flask CLI
+
+e.g. `gunicorn moody.wsgi:app` or `FLASK_APP=moody.wsgi flask run`
+"""
+from moody.app import create_app
+
+app = create_app()
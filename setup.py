@@ -10,8 +10,15 @@ setup(
         'Flask',
         'Flask-Cors',
         'marshmallow',
+        'numpy',
         'PyJWT',
         'requests',
         'SQLAlchemy',
+        'tzdata',
     ],
+    extras_require={
+        'fast': ['orjson'],
+        'export': ['pyarrow'],
+        'cache': ['redis'],
+    },
 )
@@ -0,0 +1,112 @@
+from unittest.mock import Mock, patch
+
+from sqlalchemy import exc
+import pytest
+
+from moody import app as moody_app
+from moody import auth, config, db, passwords
+from moody.enrichment import enrichment_queue
+
+CONFIG = {
+    'DATABASE_URL': 'sqlite://',
+    'GOOGLE_API_KEY': 'key',
+    'JWT_SECRET': 'secret',
+    'LOG_FILE': '',
+    'LOG_STDOUT': False,
+}
+
+
+@pytest.fixture(autouse=True)
+def restore_config(monkeypatch):
+    """create_app overrides moody.config in place, so restore it, and what was built from it, after each test"""
+    for name in list(CONFIG) + ['PREWARM', 'BCRYPT_ROUNDS', 'AUTH_CACHE_SIZE', 'DATABASE_POOL_SIZE']:
+        monkeypatch.setattr(config, name, getattr(config, name))
+
+    yield
+
+    monkeypatch.undo()
+    with patch.object(moody_app.place_index, 'refresh'):
+        moody_app.init_services()
+
+
+def test_create_app_applies_config_and_times_cold_start(monkeypatch):
+    monkeypatch.setattr(enrichment_queue, 'start', Mock())
+
+    app = moody_app.create_app(CONFIG)
+
+    assert config.JWT_SECRET == 'secret'
+    assert str(db.engine.url) == 'sqlite://'
+    assert app.config['COLD_START_SECONDS'] > 0
+    assert 'rebuild-rollups' in app.cli.commands
+
+    # Background workers start with the first request, not when the app is created
+    assert not enrichment_queue.start.called
+    response = app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert 'route="startup",stage="create_app"' in response.get_data(as_text=True)
+    assert enrichment_queue.start.call_count == 1
+
+
+def test_create_app_rebuilds_what_depends_on_overridden_settings():
+    moody_app.create_app(dict(CONFIG, BCRYPT_ROUNDS=4, AUTH_CACHE_SIZE=7))
+
+    assert passwords.hasher.rounds == 4
+    assert passwords.cost_of(passwords.hasher.hash('correct horse')) == 4
+    assert auth.token_cache.maxsize == 7
+
+
+def test_make_engine_reads_pool_settings_when_called(monkeypatch):
+    create_engine = Mock()
+    monkeypatch.setattr(db, 'create_engine', create_engine)
+    monkeypatch.setattr(db, 'event', Mock())
+    monkeypatch.setattr(config, 'DATABASE_POOL_SIZE', 20)
+
+    db.make_engine('postgresql://localhost/moody')
+
+    assert create_engine.call_args.kwargs['pool_size'] == 20
+
+
+def test_create_app_requires_settings():
+    with pytest.raises(RuntimeError, match='JWT_SECRET'):
+        moody_app.create_app(dict(CONFIG, JWT_SECRET=None))
+
+    with pytest.raises(ValueError, match='DATABASE_ULR'):
+        moody_app.create_app(dict(CONFIG, DATABASE_ULR='sqlite://'))
+
+
+def test_create_app_loads_the_spatial_index(monkeypatch):
+    refresh = Mock()
+    monkeypatch.setattr(moody_app.place_index, 'refresh', refresh)
+
+    moody_app.create_app(CONFIG)
+
+    assert refresh.call_count == 1
+
+
+def test_create_app_starts_without_a_places_table():
+    # sqlite:// is an empty db: the index is left to be loaded on first use
+    moody_app.create_app(CONFIG)
+
+    assert len(moody_app.place_index) == 0
+    assert moody_app.place_index.refreshed_at is None
+
+
+def test_create_app_prewarms(monkeypatch):
+    refresh = Mock()
+    monkeypatch.setattr(moody_app.place_index, 'refresh', refresh)
+
+    moody_app.create_app(dict(CONFIG, PREWARM=True))
+
+    # Once from init_services, then again after the connections are opened
+    assert refresh.call_count == 2
+
+
+def test_connections_from_another_process_are_discarded():
+    record = Mock(info={'pid': -1})
+    proxy = Mock()
+
+    with pytest.raises(exc.DisconnectionError):
+        db._check_pid(Mock(), record, proxy)
+
+    assert record.connection is None
+    assert proxy.connection is None
@@ -1,11 +1,78 @@
+from collections import namedtuple
+from datetime import datetime
+from unittest.mock import Mock
+import time
+
 import pytest
 
-from moody import auth
+from moody import auth, config
+from moody.cache import LRUCache
+from moody.exceptions import UnauthorizedError
+
+UserRow = namedtuple('UserRow', ['id', 'date_password_changed'])
+
+
+@pytest.fixture(autouse=True)
+def jwt_secret(monkeypatch):
+    monkeypatch.setattr(config, 'JWT_SECRET', 'secret')
+
+
+@pytest.fixture
+def query(monkeypatch):
+    """Stub the user lookup done by `auth.authenticate` and give each test fresh caches"""
+    query = Mock()
+    query.filter.return_value.one_or_none.return_value = UserRow(7, None)
+    monkeypatch.setattr(auth.session, 'query', Mock(return_value=query))
+    monkeypatch.setattr(auth, 'token_cache', LRUCache(maxsize=10, ttl=60))
+    monkeypatch.setattr(auth, 'revoked_before', {})
+    return query
 
 
 def test_create_token():
     # Mock user and check token matches expected token
-    pass
+    user = Mock(id=7, email='user@example.com')
+
+    payload = auth.decode_token(auth.create_token(user))
+
+    assert payload['user_id'] == 7
+    assert payload['email'] == 'user@example.com'
+
+
+def test_authenticate_caches_validated_tokens(query):
+    token = auth.create_token(Mock(id=7, email='user@example.com'))
+
+    assert auth.authenticate(token)['user_id'] == 7
+    assert auth.authenticate(token)['user_id'] == 7
+    assert query.filter.call_count == 1
+
+
+def test_authenticate_rejects_tokens_issued_before_password_change(query):
+    token = auth.create_token(Mock(id=7, email='user@example.com'))
+    auth.authenticate(token)
+
+    auth.revoked_before[7] = int(time.time()) + 1
+
+    with pytest.raises(UnauthorizedError):
+        auth.authenticate(token)
+
+
+def test_authenticate_rejects_tokens_issued_in_the_second_of_a_password_change(query):
+    token = auth.create_token(Mock(id=7, email='user@example.com'))
+    issued_at = auth.decode_token(token)['iat']
+    query.filter.return_value.one_or_none.return_value = UserRow(7, datetime.fromtimestamp(issued_at + 0.5))
+
+    with pytest.raises(UnauthorizedError):
+        auth.authenticate(token)
+
+
+def test_authenticate_rejects_cached_tokens_issued_in_the_second_of_a_revocation(query):
+    token = auth.create_token(Mock(id=7, email='user@example.com'))
+    issued_at = auth.authenticate(token)['iat']
+
+    auth.revoked_before[7] = issued_at
+
+    with pytest.raises(UnauthorizedError):
+        auth.authenticate(token)
 
 
 def get_token_from_request():
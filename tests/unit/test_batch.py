@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from unittest.mock import Mock
+
+from moody import batch
+
+
+def test_time_range_spans_whole_utc_days():
+    created_after, created_before = batch.time_range(days=7, now=datetime(2017, 12, 11, 15, tzinfo=timezone.utc))
+
+    assert created_after == datetime(2017, 12, 4, tzinfo=timezone.utc)
+    assert created_before == datetime(2017, 12, 11, tzinfo=timezone.utc)
+
+
+def test_time_range_respects_zero_days(monkeypatch):
+    monkeypatch.setattr(batch.config, 'INSIGHTS_DAYS', 30)
+
+    created_after, created_before = batch.time_range(days=0, now=datetime(2017, 12, 11, 15, tzinfo=timezone.utc))
+
+    assert created_after == created_before == datetime(2017, 12, 11, tzinfo=timezone.utc)
+
+
+def test_shards_split_users_into_consecutive_chunks():
+    assert batch.shards([1, 2, 3, 4, 5], shard_size=2) == [[1, 2], [3, 4], [5]]
+
+
+def test_compute_runs_every_shard_and_reports_failures(monkeypatch):
+    def compute_shard(user_ids, created_after, created_before):
+        if 3 in user_ids:
+            raise RuntimeError('db went away')
+        return len(user_ids)
+
+    init_worker = Mock()
+    monkeypatch.setattr(batch, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(batch, 'compute_shard', compute_shard)
+    monkeypatch.setattr(batch, 'init_worker', init_worker)
+
+    results = list(batch.compute([1, 2, 3, 4, 5], None, None, workers=2, shard_size=2))
+
+    assert sorted(shard for shard, error in results if error is None) == [[1, 2], [5]]
+    assert [(shard, str(error)) for shard, error in results if error is not None] == [([3, 4], 'db went away')]
+    assert init_worker.called
@@ -0,0 +1,111 @@
+from unittest.mock import Mock
+
+from sqlalchemy import create_engine, text
+import pytest
+
+from moody import db
+from moody.db import QueryStats, ReplicaSet, RoutingSession, assert_max_queries, reading_from_replica, track_queries
+
+
+@pytest.fixture
+def connection():
+    with create_engine('sqlite://').connect() as connection:
+        yield connection
+
+
+def test_track_queries_counts_statements(connection):
+    with track_queries() as stats:
+        for _ in range(3):
+            connection.execute(text('SELECT 1'))
+        connection.execute(text('SELECT 2'))
+
+    assert stats.count == 4
+    assert stats.duration > 0
+    assert stats.repeated(threshold=3) == [('SELECT 1', 3)]
+
+    connection.execute(text('SELECT 1'))
+    assert stats.count == 4
+
+
+def test_assert_max_queries(connection):
+    with assert_max_queries(2):
+        connection.execute(text('SELECT 1'))
+        connection.execute(text('SELECT 1'))
+
+    with pytest.raises(AssertionError, match='at most 1 queries, got 2:\n2x SELECT 1'):
+        with assert_max_queries(1):
+            connection.execute(text('SELECT 1'))
+            connection.execute(text('SELECT 1'))
+
+
+def test_query_stats_problems():
+    stats = QueryStats()
+    for _ in range(5):
+        stats.record('SELECT *\n  FROM places WHERE id = ?', 0.1)
+
+    assert stats.problems(max_queries=10, max_duration=1.0, n_plus_one_threshold=10) == []
+    assert stats.problems(max_queries=4, max_duration=0.2, n_plus_one_threshold=5) == [
+        '5 queries (threshold: 4)',
+        '0.500s in db (threshold: 0.2s)',
+        'possible N+1, statement issued 5 times: SELECT * FROM places WHERE id = ?',
+    ]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_db(name):
+    engine = create_engine('sqlite://')
+    with engine.connect() as connection:
+        connection.execute(text('CREATE TABLE source (name TEXT)'))
+        connection.execute(text('INSERT INTO source VALUES (:name)'), name=name)
+    return engine
+
+
+def read_source(session):
+    return session.execute(text('SELECT name FROM source')).scalar()
+
+
+def test_routing_session_sends_reads_in_read_only_blocks_to_replicas(monkeypatch):
+    monkeypatch.setattr(db, 'replicas', ReplicaSet([make_db('replica')]))
+    session = RoutingSession(bind=make_db('primary'))
+
+    assert read_source(session) == 'primary'
+    with reading_from_replica():
+        assert read_source(session) == 'replica'
+    assert read_source(session) == 'primary'
+
+
+def test_routing_session_falls_back_to_primary_when_replicas_are_down(monkeypatch, tmp_path):
+    clock = FakeClock()
+    # sqlite can't open a db in a missing directory, until the directory is created
+    replica = create_engine(f'sqlite:///{tmp_path}/missing/replica.db')
+    monkeypatch.setattr(db, 'replicas', ReplicaSet([replica], retry_interval=30, check_interval=5, clock=clock))
+    session = RoutingSession(bind=make_db('primary'))
+
+    with reading_from_replica():
+        assert read_source(session) == 'primary'
+
+    (tmp_path / 'missing').mkdir()
+    clock.now = 29
+    assert db.replicas.choose() is None
+    clock.now = 31
+    assert db.replicas.choose() is replica
+
+
+def test_make_engine_bounds_connect_time_when_asked(monkeypatch):
+    create_engine = Mock()
+    monkeypatch.setattr(db, 'create_engine', create_engine)
+    monkeypatch.setattr(db, 'event', Mock())
+
+    db.make_engine('postgresql://primary/moody')
+    db.make_engine('postgresql://replica/moody', connect_timeout=3)
+
+    primary, replica = create_engine.call_args_list
+    assert 'connect_args' not in primary.kwargs
+    assert replica.kwargs['connect_args'] == {'connect_timeout': 3}
@@ -0,0 +1,51 @@
+from unittest.mock import Mock
+
+from moody.enrichment import EnrichmentQueue
+
+
+def test_drain_processes_items_in_batches():
+    process_batch = Mock()
+    queue = EnrichmentQueue(process_batch=process_batch, on_failure=Mock(), batch_size=2)
+    queue.enqueue_many([1, 2, 3])
+
+    queue.drain()
+
+    assert [call.args[0] for call in process_batch.call_args_list] == [[1, 2], [3]]
+    assert len(queue) == 0
+
+
+def test_failed_batches_are_retried():
+    process_batch = Mock(side_effect=[RuntimeError('upstream down'), None])
+    on_failure = Mock()
+    queue = EnrichmentQueue(process_batch=process_batch, on_failure=on_failure, max_attempts=3, backoff=0)
+    queue.enqueue(1)
+
+    queue.drain()
+
+    assert process_batch.call_count == 2
+    on_failure.assert_not_called()
+
+
+def test_exhausted_items_are_marked_failed():
+    process_batch = Mock(side_effect=RuntimeError('upstream down'))
+    on_failure = Mock()
+    queue = EnrichmentQueue(process_batch=process_batch, on_failure=on_failure, max_attempts=2, backoff=0)
+    queue.enqueue(1)
+
+    queue.drain()
+
+    assert process_batch.call_count == 2
+    on_failure.assert_called_once_with([1])
+
+
+def test_workers_process_queue():
+    process_batch = Mock()
+    queue = EnrichmentQueue(process_batch=process_batch, on_failure=Mock(), num_workers=2)
+    queue.start(requeue_pending=False)
+    queue.enqueue_many([1, 2])
+
+    assert queue.join(timeout=5)
+    queue.stop(timeout=5)
+
+    processed = [item for call in process_batch.call_args_list for item in call.args[0]]
+    assert sorted(processed) == [1, 2]
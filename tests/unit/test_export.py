@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import csv
+import io
+import json
+
+from sqlalchemy import create_engine, text
+import pytest
+
+from moody import export
+from moody.db import session
+from moody.models import MoodEvent, User, mood_events_places
+
+MOOD_EVENT = {
+    'id': 1,
+    'date_created': datetime(2017, 12, 11, 8),
+    'sentiment': 'happy',
+    'latitude': 1.0,
+    'longitude': 2.0,
+    'enrichment_status': 'enriched',
+    'place_ids': ['a', 'b'],
+    'place_names': ['Cafe', 'Park'],
+    'place_types': ['cafe', 'food', 'park'],
+}
+
+
+@pytest.fixture
+def user():
+    """Bind the session to a throwaway sqlite db with mood events and (empty) place tables"""
+    engine = create_engine('sqlite://')
+    MoodEvent.__table__.metadata.create_all(engine, tables=[User.__table__, MoodEvent.__table__])
+    # `places.type_ids` is a PostgreSQL array, so the table is created by hand
+    with engine.connect() as connection:
+        connection.execute(text('CREATE TABLE places (id INTEGER PRIMARY KEY, place_id TEXT, name TEXT, type_ids TEXT)'))
+    mood_events_places.create(engine)
+    session.remove()
+    session.configure(bind=engine)
+
+    user = User(email='user@example.com', password='password')
+    user.id = 1
+    session.add(user)
+    session.commit()
+
+    yield user
+
+    session.remove()
+
+
+def test_iter_chunks_streams_mood_events_oldest_first(user):
+    start = datetime(2017, 12, 11)
+    for hours in (2, 0, 1):
+        mood_event = MoodEvent(sentiment='happy', latitude=1.0, longitude=2.0, user=user)
+        mood_event.date_created = start + timedelta(hours=hours)
+        session.add(mood_event)
+    session.commit()
+
+    chunks = list(export.iter_chunks(user.id, chunk_size=2))
+
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert [mood_event['date_created'].hour for chunk in chunks for mood_event in chunk] == [0, 1, 2]
+    assert chunks[0][0]['place_ids'] == []
+
+    chunks = list(export.iter_chunks(user.id, created_after=start + timedelta(hours=1)))
+    assert [len(chunk) for chunk in chunks] == [2]
+
+
+def test_to_ndjson():
+    body = b''.join(export.to_ndjson([[MOOD_EVENT], [dict(MOOD_EVENT, id=2)]]))
+    lines = [json.loads(line) for line in body.splitlines()]
+
+    assert [line['id'] for line in lines] == [1, 2]
+    assert lines[0]['date_created'] == '2017-12-11T08:00:00'
+    assert lines[0]['place_types'] == ['cafe', 'food', 'park']
+
+
+def test_to_csv_flattens_places():
+    rows = list(csv.DictReader(io.StringIO(b''.join(export.to_csv([[MOOD_EVENT]])).decode('utf-8'))))
+
+    assert rows == [{
+        'id': '1',
+        'date_created': '2017-12-11T08:00:00',
+        'sentiment': 'happy',
+        'latitude': '1.0',
+        'longitude': '2.0',
+        'enrichment_status': 'enriched',
+        'place_ids': 'a|b',
+        'place_names': 'Cafe|Park',
+        'place_types': 'cafe|food|park',
+    }]
+
+
+def test_to_csv_writes_header_for_empty_history():
+    assert b''.join(export.to_csv([])).decode('utf-8').strip() == ','.join(export.COLUMNS)
+
+
+@pytest.mark.skipif(not export.HAS_PYARROW, reason='pyarrow is not installed')
+def test_to_parquet_writes_a_row_group_per_chunk():
+    import pyarrow.parquet
+
+    body = b''.join(export.to_parquet([[MOOD_EVENT], [dict(MOOD_EVENT, id=2)]]))
+    parquet_file = pyarrow.parquet.ParquetFile(io.BytesIO(body))
+
+    assert parquet_file.num_row_groups == 2
+    table = parquet_file.read()
+    assert table.column('id').to_pylist() == [1, 2]
+    assert table.column('place_names').to_pylist() == [['Cafe', 'Park'], ['Cafe', 'Park']]
+
+
+@pytest.mark.skipif(not export.HAS_PYARROW, reason='pyarrow is not installed')
+def test_to_arrow():
+    import pyarrow
+
+    body = b''.join(export.to_arrow([[MOOD_EVENT]]))
+    table = pyarrow.ipc.open_stream(body).read_all()
+
+    assert table.column('sentiment').to_pylist() == ['happy']
@@ -0,0 +1,180 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+import threading
+import time
+
+import pytest
+import requests
+
+from moody import geo
+from moody.exceptions import PlacesUnavailableError
+from moody.ratelimit import CircuitBreaker
+
+
+def test_quantize_groups_nearby_points():
+    # Points ~10m apart should fall within the same 100m cell
+    row_a, column_a, _, _ = geo.quantize(37.77490, -122.41940, cell_size=100)
+    row_b, column_b, _, _ = geo.quantize(37.77495, -122.41945, cell_size=100)
+
+    assert (row_a, column_a) == (row_b, column_b)
+
+
+def test_quantize_separates_distant_points():
+    # Points ~1km apart should not share a cell
+    cell_a = geo.quantize(37.7749, -122.4194, cell_size=100)[:2]
+    cell_b = geo.quantize(37.7839, -122.4194, cell_size=100)[:2]
+
+    assert cell_a != cell_b
+
+
+def test_geo_cell_cache_fetches_once_per_cell():
+    cache = geo.GeoCellCache(maxsize=10, ttl=60, cell_size=100)
+    fetch = Mock(return_value=[{'place_id': 'abc'}])
+
+    first = cache.get_or_fetch(37.77490, -122.41940, fetch)
+    second = cache.get_or_fetch(37.77495, -122.41945, fetch)
+
+    assert first == second == [{'place_id': 'abc'}]
+    assert fetch.call_count == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_geo_cell_cache_uses_shared_tier():
+    shared = Mock()
+    shared.get.return_value = '[{"place_id": "abc"}]'
+    cache = geo.GeoCellCache(maxsize=10, ttl=60, cell_size=100, shared=shared)
+    fetch = Mock()
+
+    places = cache.get_or_fetch(37.7749, -122.4194, fetch)
+
+    assert places == [{'place_id': 'abc'}]
+    fetch.assert_not_called()
+    assert cache.stats()['shared_hits'] == 1
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def stub_response(results, status='OK'):
+    response = Mock()
+    response.json.return_value = {'status': status, 'results': results}
+    return response
+
+
+def test_init_places_adds_a_shared_tier_when_configured(monkeypatch):
+    client = Mock()
+    shared_cache_client = Mock(return_value=client)
+    monkeypatch.setattr(geo, 'shared_cache_client', shared_cache_client)
+    monkeypatch.setattr(geo, 'places_cache', None)
+    monkeypatch.setattr(geo, 'places_client', None)
+
+    monkeypatch.setattr(geo.config, 'PLACES_CACHE_URL', None)
+    geo.init_places()
+    assert geo.places_cache.shared is None
+
+    monkeypatch.setattr(geo.config, 'PLACES_CACHE_URL', 'redis://cache:6379/0')
+    geo.init_places()
+    assert geo.places_cache.shared is client
+    shared_cache_client.assert_called_once_with('redis://cache:6379/0')
+
+
+def test_places_client_parses_results():
+    session = Mock()
+    session.get.return_value = stub_response([{
+        'place_id': 'abc',
+        'name': 'Dolores Park',
+        'types': ['park'],
+        'geometry': {'location': {'lat': 37.7596, 'lng': -122.4269}}
+    }])
+    client = geo.PlacesClient(api_key='key', base_url='http://localhost/stub', session=session)
+
+    places = client.nearby(37.7596, -122.4269)
+
+    assert places == [{
+        'place_id': 'abc',
+        'name': 'Dolores Park',
+        'types': ['park'],
+        'latitude': 37.7596,
+        'longitude': -122.4269,
+    }]
+    assert session.get.call_args.kwargs['timeout'] == client.timeout
+
+
+def test_places_client_coalesces_concurrent_lookups():
+    release = threading.Event()
+    session = Mock()
+
+    def slow_get(*args, **kwargs):
+        release.wait(5)
+        return stub_response([])
+
+    session.get.side_effect = slow_get
+    client = geo.PlacesClient(api_key='key', session=session)
+
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = [executor.submit(client.nearby, 1.0, 2.0) for _ in range(5)]
+        time.sleep(0.1)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert results == [[]] * 5
+    assert session.get.call_count == 1
+
+
+def test_places_client_circuit_breaker_degrades_to_no_places(monkeypatch):
+    session = Mock()
+    session.get.side_effect = requests.Timeout('too slow')
+    client = geo.PlacesClient(api_key='key', session=session, breaker_threshold=2)
+    monkeypatch.setattr(geo, 'places_client', client)
+    monkeypatch.setattr(geo, 'places_cache', geo.GeoCellCache(maxsize=10, ttl=60))
+
+    assert geo.google_places_from_coord(1.0, 2.0) == []
+    assert geo.google_places_from_coord(1.0, 2.0) == []
+    assert geo.google_places_from_coord(1.0, 2.0) == []
+
+    assert session.get.call_count == 2
+    assert client.breaker.state == CircuitBreaker.OPEN
+
+
+def test_places_client_raises_on_error_statuses_and_they_are_not_cached(monkeypatch):
+    session = Mock()
+    session.get.return_value = stub_response([], status='OVER_QUERY_LIMIT')
+    client = geo.PlacesClient(api_key='key', session=session)
+    monkeypatch.setattr(geo, 'places_client', client)
+    monkeypatch.setattr(geo, 'places_cache', geo.GeoCellCache(maxsize=10, ttl=60))
+
+    with pytest.raises(PlacesUnavailableError, match='OVER_QUERY_LIMIT'):
+        geo.nearby_places(1.0, 2.0)
+    assert len(geo.places_cache.local) == 0
+
+    session.get.return_value = stub_response([], status='ZERO_RESULTS')
+    assert geo.nearby_places(1.0, 2.0) == []
+    assert len(geo.places_cache.local) == 1
+
+
+def test_places_client_followers_raise_any_error_of_the_leader():
+    release = threading.Event()
+    session = Mock()
+
+    def broken_get(*args, **kwargs):
+        release.wait(5)
+        response = stub_response([])
+        response.json.return_value = {'status': 'OK'}
+        return response
+
+    session.get.side_effect = broken_get
+    client = geo.PlacesClient(api_key='key', session=session)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(client.nearby, 1.0, 2.0) for _ in range(3)]
+        time.sleep(0.1)
+        release.set()
+        errors = [future.exception() for future in futures]
+
+    assert all(isinstance(error, KeyError) for error in errors)
+    assert session.get.call_count == 1
@@ -0,0 +1,30 @@
+from flask import Flask, g
+
+from moody import handlers
+
+app = Flask('moody')
+
+
+def test_handle_request_id_keeps_the_client_id():
+    with app.test_request_context(headers={'X-Request-ID': 'abc'}):
+        handlers.handle_request_id()
+        assert g.request_id == 'abc'
+
+
+def test_handle_request_id_generates_missing_or_oversized_ids():
+    with app.test_request_context():
+        handlers.handle_request_id()
+        assert len(g.request_id) == 32
+
+    with app.test_request_context(headers={'X-Request-ID': 'x' * 1000}):
+        handlers.handle_request_id()
+        assert g.request_id != 'x' * 1000
+
+
+def test_handle_request_logged_returns_the_request_id():
+    with app.test_request_context():
+        g.request_id = 'abc'
+        g.request_started_at = 0.0
+        response = handlers.handle_request_logged(app.response_class('ok'))
+
+    assert response.headers['X-Request-ID'] == 'abc'
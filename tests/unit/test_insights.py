@@ -0,0 +1,113 @@
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine
+import numpy as np
+import pytest
+
+from moody import insights
+from moody.db import session
+from moody.models import MoodEvent, SentimentRollup, User
+
+
+@pytest.fixture
+def user():
+    """Bind the session to a throwaway sqlite db with the tables insights need"""
+    engine = create_engine('sqlite://')
+    MoodEvent.__table__.metadata.create_all(engine, tables=[User.__table__, MoodEvent.__table__, SentimentRollup.__table__])
+    session.remove()
+    session.configure(bind=engine)
+
+    user = User(email='user@example.com', password='password')
+    user.id = 1
+    session.add(user)
+    session.commit()
+
+    yield user
+
+    session.remove()
+
+
+def add_mood_event(user, sentiment, date_created):
+    mood_event = MoodEvent(sentiment=sentiment, latitude=1.0, longitude=2.0, user=user)
+    mood_event.date_created = date_created
+    session.add(mood_event)
+
+
+def test_get_frequency_distribution(user):
+    now = datetime(2017, 12, 11)
+    add_mood_event(user, 'happy', now)
+    add_mood_event(user, 'happy', now + timedelta(hours=1))
+    add_mood_event(user, 'sad', now + timedelta(hours=2))
+    add_mood_event(user, 'sad', now - timedelta(days=30))
+    session.commit()
+
+    distribution = insights.get_frequency_distribution(
+        created_before=now + timedelta(hours=12),
+        created_after=now,
+        user=user
+    )
+
+    assert distribution == {'happy': 2, 'sad': 1}
+
+
+def test_get_frequency_distribution_sums_rollups_for_whole_days(user):
+    start = datetime(2017, 12, 11, 12)
+    # Partial first and last days are counted from mood events
+    add_mood_event(user, 'happy', start)
+    add_mood_event(user, 'happy', start - timedelta(hours=1))
+    add_mood_event(user, 'sad', datetime(2017, 12, 14, 6))
+    # Whole days in between are summed from rollups
+    session.add(SentimentRollup(user_id=user.id, day=date(2017, 12, 12), sentiment='happy', count=5))
+    session.add(SentimentRollup(user_id=user.id, day=date(2017, 12, 13), sentiment='sad', count=3))
+    session.add(SentimentRollup(user_id=user.id, day=date(2017, 12, 14), sentiment='sad', count=100))
+    session.commit()
+
+    distribution = insights.get_frequency_distribution(
+        created_before=datetime(2017, 12, 14, 12),
+        created_after=start,
+        user=user
+    )
+
+    assert distribution == {'happy': 6, 'sad': 4}
+
+
+def test_get_frequency_distributions_groups_by_user(user):
+    other = User(email='other@example.com', password='password')
+    other.id = 2
+    session.add(other)
+    add_mood_event(user, 'happy', datetime(2017, 12, 11, 12))
+    add_mood_event(other, 'sad', datetime(2017, 12, 13, 6))
+    session.add(SentimentRollup(user_id=other.id, day=date(2017, 12, 12), sentiment='sad', count=2))
+    session.commit()
+
+    distributions = insights.get_frequency_distributions(
+        [user.id, other.id, 3],
+        created_after=datetime(2017, 12, 11, 6),
+        created_before=datetime(2017, 12, 13, 12)
+    )
+
+    assert distributions == {1: {'happy': 1}, 2: {'sad': 3}, 3: {}}
+
+
+def test_place_type_scores_weights_sentiment_by_distance():
+    events = np.array([
+        [37.7749, -122.4194, 1.0],   # at the park
+        [37.7749, -122.4194, 1.0],   # at the park
+        [37.7800, -122.4194, -1.0],  # at the office
+        [38.0000, -122.0000, -1.0],  # far from everything
+    ])
+    place_coords = np.array([
+        [37.7749, -122.4194],
+        [37.7800, -122.4194],
+    ])
+    place_types = [['park'], ['office', 'establishment']]
+
+    scores = insights.place_type_scores(events, place_coords, place_types, radius=200)
+
+    assert set(scores) == {'park', 'office', 'establishment'}
+    assert scores['park'] == {'score': 1.0, 'happy': 1.0, 'samples': 2}
+    assert scores['office'] == {'score': -1.0, 'happy': 0.0, 'samples': 1}
+
+
+def test_place_type_scores_handles_users_without_places():
+    assert insights.place_type_scores(np.empty((0, 3)), np.empty((0, 2)), [], radius=200) == {}
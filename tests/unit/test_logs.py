@@ -0,0 +1,102 @@
+from logging.handlers import MemoryHandler
+import json
+import logging
+import queue
+import sys
+
+from flask import Flask, g
+
+from moody import logs
+
+app = Flask('moody')
+
+
+def make_record(msg='message', args=(), exc_info=None, **extra):
+    record = logging.LogRecord('moody.test', logging.ERROR, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+def raise_error():
+    raise ValueError('boom')
+
+
+def error_info():
+    try:
+        raise_error()
+    except ValueError:
+        return sys.exc_info()
+
+
+def test_json_formatter_includes_extra_fields_and_tracebacks():
+    record = make_record('%s failed', ('export',), error_info(), request_id='abc', duration_ms=1.5)
+
+    entry = json.loads(logs.JSONFormatter().format(record))
+
+    assert entry['message'] == 'export failed'
+    assert entry['level'] == 'ERROR'
+    assert entry['request_id'] == 'abc'
+    assert entry['duration_ms'] == 1.5
+    assert 'ValueError: boom' in entry['exception']
+
+
+def test_request_context_adds_request_id_and_route():
+    record = make_record()
+
+    with app.test_request_context('/mood_events'):
+        g.request_id = 'abc'
+        assert logs.RequestContext().filter(record)
+
+    assert record.request_id == 'abc'
+    assert record.route == 'unmatched'
+
+
+def test_exception_rate_limiter_suppresses_repeated_exceptions():
+    now = [0.0]
+    limiter = logs.ExceptionRateLimiter(burst=2, window=10, clock=lambda: now[0])
+    exc_info = error_info()
+
+    passed = [limiter.filter(make_record(exc_info=exc_info)) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+
+    # Records without exceptions are never limited
+    assert limiter.filter(make_record())
+
+    now[0] = 5.0
+    record = make_record(exc_info=exc_info)
+    assert limiter.filter(record)
+    assert record.suppressed == 3
+
+
+def test_queue_handler_drops_records_when_full_and_reports_them():
+    records = queue.Queue(maxsize=1)
+    handler = logs.NonBlockingQueueHandler(records)
+
+    handler.handle(make_record('first %d', (1,)))
+    handler.handle(make_record('second'))
+    handler.handle(make_record('third'))
+    assert handler.dropped == 2
+
+    first = records.get_nowait()
+    assert first.msg == 'first 1'
+    assert first.args is None
+
+    handler.handle(make_record('fourth'))
+    fourth = records.get_nowait()
+    assert fourth.dropped == 2
+    assert handler.dropped == 0
+
+
+def test_pipeline_writes_from_a_background_thread():
+    sink = MemoryHandler(capacity=100)
+    pipeline = logs.LogPipeline([sink], queue_size=10)
+    pipeline.start()
+
+    pipeline.handler.handle(make_record('hello'))
+    pipeline.stop()
+
+    assert [record.getMessage() for record in sink.buffer] == ['hello']
+    assert not pipeline.started
+
+    # Stopping twice, e.g. at exit after a replacement pipeline stopped this one, is a no-op
+    pipeline.stop()
@@ -0,0 +1,64 @@
+from flask import Flask
+import pytest
+
+from moody import metrics
+
+app = Flask('moody')
+app.register_blueprint(metrics.metrics)
+app.before_request(metrics.start_request_timer)
+app.after_request(metrics.record_request)
+
+
+@app.route('/things/<int:thing_id>', methods=['POST'])
+def create_thing(thing_id):
+    with metrics.stage('validation'):
+        pass
+    return '', 201
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    for family in metrics.FAMILIES:
+        family.clear()
+
+
+def test_histogram_counts_are_cumulative():
+    histogram = metrics.Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+
+    buckets, total, count = histogram.snapshot()
+
+    assert buckets == [(0.1, 2), (1.0, 3), (float('inf'), 4)]
+    assert total == pytest.approx(2.65)
+    assert count == 4
+
+
+def test_stage_outside_request_is_labelled_background():
+    with metrics.stage('places_lookup'):
+        pass
+    with metrics.stage('commit', route='enrichment'):
+        pass
+
+    assert metrics.stage_duration.labels('background', 'places_lookup').count == 1
+    assert metrics.stage_duration.labels('enrichment', 'commit').count == 1
+
+
+def test_metrics_endpoint_exposes_request_and_stage_durations():
+    client = app.test_client()
+    client.post('/things/1')
+    client.post('/things/2')
+
+    response = client.get('/metrics')
+    body = response.get_data(as_text=True)
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    assert '# TYPE moody_request_duration_seconds histogram' in body
+    assert 'moody_request_duration_seconds_count{route="POST /things/<int:thing_id>",status="201"} 2' in body
+    assert 'moody_stage_duration_seconds_bucket{route="POST /things/<int:thing_id>",stage="validation",le="+Inf"} 2' \
+        in body
+
+
+def test_label_values_are_escaped():
+    assert metrics.escape('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
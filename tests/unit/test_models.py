@@ -0,0 +1,80 @@
+from collections import namedtuple
+from unittest.mock import Mock
+
+import pytest
+
+from moody import models
+
+Row = namedtuple('Row', ['id', 'place_id', 'inserted'])
+TypeRow = namedtuple('TypeRow', ['id', 'name', 'inserted'])
+
+
+def make_place(place_id):
+    return {'place_id': place_id, 'name': place_id, 'latitude': 1.0, 'longitude': 2.0, 'types': ['park']}
+
+
+@pytest.fixture
+def place_type_cache(monkeypatch):
+    """Place type cache knowing the 'park' type"""
+    cache = models.PlaceTypeCache()
+    cache.add(1, 'park')
+    monkeypatch.setattr(models, 'place_type_cache', cache)
+    return cache
+
+
+def test_get_or_create_many_upserts_in_one_round_trip(monkeypatch, place_type_cache):
+    execute = Mock(return_value=[Row(1, 'a', True), Row(2, 'b', False)])
+    monkeypatch.setattr(models.session, 'execute', execute)
+    monkeypatch.setattr(models, 'place_id_cache', models.LRUCache(maxsize=10))
+
+    ids = models.Place.get_or_create_many([make_place('b'), make_place('a'), make_place('a')])
+
+    assert ids == {'a': 1, 'b': 2}
+    assert execute.call_count == 1
+    # Rows are upserted in a stable order, so concurrent upserts can't deadlock
+    assert [row['place_id'] for row in execute.call_args[0][0].parameters] == ['a', 'b']
+    assert execute.call_args[0][0].parameters[0]['type_ids'] == [1]
+    # Only rows that already existed are cached, since new rows may still be rolled back
+    assert models.place_id_cache.get('a') is None
+    assert models.place_id_cache.get('b') == 2
+
+
+def test_get_or_create_many_skips_db_for_cached_places(monkeypatch):
+    execute = Mock()
+    monkeypatch.setattr(models.session, 'execute', execute)
+    monkeypatch.setattr(models, 'place_id_cache', models.LRUCache(maxsize=10))
+    models.place_id_cache.set('a', 1)
+
+    assert models.Place.get_or_create_many([make_place('a')]) == {'a': 1}
+    execute.assert_not_called()
+
+
+def test_sentiment_is_stored_as_a_small_int():
+    sentiment = models.Sentiment()
+
+    assert sentiment.process_bind_param('happy', None) == 1
+    assert sentiment.process_bind_param(None, None) is None
+    assert [sentiment.process_result_value(code, None) for code in (-1, 0, 1)] == ['sad', 'neutral', 'happy']
+
+
+def test_place_type_get_or_create_many_only_caches_existing_types(monkeypatch, place_type_cache):
+    execute = Mock(return_value=[TypeRow(2, 'cafe', True), TypeRow(3, 'food', False)])
+    monkeypatch.setattr(models.session, 'execute', execute)
+
+    ids = models.PlaceType.get_or_create_many(['park', 'cafe', 'food', 'cafe'])
+
+    assert ids == {'park': 1, 'cafe': 2, 'food': 3}
+    assert execute.call_count == 1
+    assert place_type_cache.ids == {'park': 1, 'food': 3}
+    assert place_type_cache.names == {1: 'park', 2: 'cafe', 3: 'food'}
+
+
+def test_place_type_get_names_loads_the_dictionary_on_a_miss(monkeypatch, place_type_cache):
+    query = Mock(return_value=[TypeRow(1, 'park', None), TypeRow(2, 'cafe', None)])
+    monkeypatch.setattr(models.session, 'query', query)
+
+    assert models.PlaceType.get_names([1]) == ['park']
+    query.assert_not_called()
+
+    assert models.PlaceType.get_names([2, 1]) == ['cafe', 'park']
+    assert query.call_count == 1
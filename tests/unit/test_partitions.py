@@ -0,0 +1,64 @@
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import Mock
+
+from moody import partitions
+
+
+def month(year, number):
+    return datetime(year, number, 1, tzinfo=timezone.utc)
+
+
+def test_month_start_uses_utc():
+    pacific = timezone(timedelta(hours=-8))
+
+    assert partitions.month_start(datetime(2018, 1, 31, 20, tzinfo=pacific)) == month(2018, 2)
+    assert partitions.month_start(datetime(2018, 1, 31, 20)) == month(2018, 1)
+
+
+def test_add_months_wraps_years():
+    assert partitions.add_months(month(2018, 11), 3) == month(2019, 2)
+    assert partitions.add_months(month(2018, 1), -1) == month(2017, 12)
+
+
+def test_partition_names_round_trip():
+    assert partitions.partition_name(month(2018, 1)) == 'mood_events_y2018m01'
+    assert partitions.partition_month('mood_events_y2018m01') == month(2018, 1)
+    assert partitions.partition_month('mood_events_default') is None
+
+
+def test_plan_creates_upcoming_partitions_and_archives_old_ones():
+    existing = [month(2017, 11), month(2017, 12), month(2018, 1), month(2018, 2)]
+
+    to_create, to_archive = partitions.plan(existing, datetime(2018, 2, 14, tzinfo=timezone.utc),
+                                            months_ahead=2, hot_months=3)
+
+    assert to_create == [month(2018, 3), month(2018, 4)]
+    assert to_archive == [month(2017, 11)]
+
+
+def test_plan_never_archives_the_current_month():
+    to_create, to_archive = partitions.plan([month(2018, 2)], datetime(2018, 2, 14, tzinfo=timezone.utc),
+                                            months_ahead=0, hot_months=0)
+
+    assert to_create == []
+    assert to_archive == []
+
+
+def test_archive_partition_bumps_data_versions_of_its_users_and_forgets_its_rollups(monkeypatch):
+    session = Mock()
+    session.execute.return_value.fetchall.return_value = [(1,), (2,)]
+    bump_data_version = Mock()
+    forget = Mock(side_effect=lambda *args: session.execute('forget'))
+    monkeypatch.setattr(partitions, 'session', session)
+    monkeypatch.setattr(partitions.User, 'bump_data_version', bump_data_version)
+    monkeypatch.setattr(partitions.rollups, 'forget', forget)
+
+    partitions.archive_partition(month(2017, 1), schema='archive')
+
+    bump_data_version.assert_called_once_with([1, 2])
+    forget.assert_called_once_with('mood_events_y2017m01', date(2017, 1, 1), date(2017, 2, 1))
+    statements = [str(call.args[0]) for call in session.execute.call_args_list]
+    assert statements.index('SELECT DISTINCT user_id FROM mood_events_y2017m01') < \
+        statements.index('ALTER TABLE mood_events DETACH PARTITION mood_events_y2017m01')
+    assert statements.index('forget') < \
+        statements.index('ALTER TABLE mood_events DETACH PARTITION mood_events_y2017m01')
@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+from moody.exceptions import ServiceUnavailableError
+from moody.passwords import PasswordHasher, cost_of
+
+
+def test_hash_and_check():
+    hasher = PasswordHasher(rounds=4)
+    hashed = hasher.hash('correct horse')
+
+    assert cost_of(hashed) == 4
+    assert hasher.check('correct horse', hashed)
+    assert not hasher.check('battery staple', hashed)
+
+
+def test_needs_rehash_when_work_factor_changes():
+    hashed = PasswordHasher(rounds=4).hash('correct horse')
+
+    assert not PasswordHasher(rounds=4).needs_rehash(hashed)
+    assert PasswordHasher(rounds=5).needs_rehash(hashed)
+
+
+def test_rejects_work_when_saturated():
+    hasher = PasswordHasher(rounds=4, workers=1, queue_size=0)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=hasher._run, args=(block,))
+    thread.start()
+    started.wait(5)
+
+    with pytest.raises(ServiceUnavailableError):
+        hasher.hash('correct horse')
+
+    release.set()
+    thread.join(5)
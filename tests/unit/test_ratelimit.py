@@ -0,0 +1,39 @@
+from moody.ratelimit import CircuitBreaker, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker_half_opens_after_reset_timeout():
+    clock = FakeClock()
+    breaker = CircuitBreaker(threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+
+    assert not breaker.allow()
+
+    clock.now = 10
+
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_success()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_token_bucket_limits_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=2, clock=clock)
+
+    assert bucket.acquire()
+    assert bucket.acquire()
+    assert not bucket.acquire()
+
+    clock.now = 1
+
+    assert bucket.acquire()
@@ -0,0 +1,112 @@
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta, timezone
+from unittest.mock import Mock
+
+from sqlalchemy import create_engine, text
+
+from moody import rollups
+from moody.db import session
+from moody.models import MoodEvent, PlaceSentimentRollup, SentimentRollup, User, mood_events_places
+
+Row = namedtuple('Row', ['user_id', 'date_created', 'sentiment'])
+
+
+def test_utc_day_converts_aware_datetimes():
+    pacific = timezone(timedelta(hours=-8))
+
+    assert rollups.utc_day(datetime(2017, 12, 11, 20, tzinfo=pacific)) == date(2017, 12, 12)
+    assert rollups.utc_day(datetime(2017, 12, 11, 20)) == date(2017, 12, 11)
+
+
+def test_record_mood_events_counts_per_user_day_and_sentiment(monkeypatch):
+    increment = Mock()
+    monkeypatch.setattr(rollups, 'increment', increment)
+
+    rollups.record_mood_events([
+        Row(1, datetime(2017, 12, 11, 8), 'happy'),
+        Row(1, datetime(2017, 12, 11, 9), 'happy'),
+        Row(1, datetime(2017, 12, 12, 9), 'happy'),
+        Row(2, datetime(2017, 12, 11, 9), 'sad'),
+    ])
+
+    increment.assert_called_once_with(SentimentRollup, Counter({
+        (1, date(2017, 12, 11), 'happy'): 2,
+        (1, date(2017, 12, 12), 'happy'): 1,
+        (2, date(2017, 12, 11), 'sad'): 1,
+    }))
+
+
+def test_increment_upserts_in_key_order(monkeypatch):
+    execute = Mock()
+    monkeypatch.setattr(rollups.session, 'execute', execute)
+
+    rollups.increment(SentimentRollup, Counter({
+        (2, date(2017, 12, 11), 'sad'): 1,
+        (1, date(2017, 12, 12), 'happy'): 1,
+        (1, date(2017, 12, 11), 'happy'): 2,
+    }))
+
+    rows = execute.call_args[0][0].parameters
+    assert [(row['user_id'], row['day']) for row in rows] == [
+        (1, date(2017, 12, 11)),
+        (1, date(2017, 12, 12)),
+        (2, date(2017, 12, 11)),
+    ]
+
+
+def test_forget_leaves_rollups_as_a_rebuild_after_archiving_computes_them():
+    engine = create_engine('sqlite://')
+    tables = [User.__table__, MoodEvent.__table__, mood_events_places, SentimentRollup.__table__,
+              PlaceSentimentRollup.__table__]
+    MoodEvent.metadata.create_all(engine, tables=tables)
+    events = [
+        # id, user_id, date_created, sentiment, place ids
+        (1, 1, datetime(2017, 11, 30, 23), 'happy', [10, 11]),
+        (2, 1, datetime(2017, 11, 2), 'sad', [10]),
+        (3, 1, datetime(2017, 12, 1), 'happy', [10]),
+        (4, 2, datetime(2017, 11, 5), 'happy', [11]),
+        (5, 2, datetime(2017, 12, 5), 'happy', []),
+    ]
+
+    def rebuilt(events):
+        daily = Counter((user_id, date_created.date(), sentiment) for _, user_id, date_created, sentiment, _ in events)
+        places = Counter(
+            (user_id, place_id, sentiment)
+            for _, user_id, _, sentiment, place_ids in events
+            for place_id in place_ids
+        )
+        return daily, places
+
+    with engine.connect() as connection:
+        for user_id in (1, 2):
+            connection.execute(User.__table__.insert(), id=user_id, email=f'{user_id}@example.com', password='hash')
+        for id, user_id, date_created, sentiment, place_ids in events:
+            connection.execute(MoodEvent.__table__.insert(), id=id, user_id=user_id, date_created=date_created,
+                               sentiment=sentiment, latitude=1.0, longitude=2.0)
+            for place_id in place_ids:
+                connection.execute(mood_events_places.insert(), mood_event_id=id, place_id=place_id)
+        daily, places = rebuilt(events)
+        for (user_id, day, sentiment), count in daily.items():
+            connection.execute(SentimentRollup.__table__.insert(), user_id=user_id, day=day, sentiment=sentiment,
+                               count=count)
+        for (user_id, place_id, sentiment), count in places.items():
+            connection.execute(PlaceSentimentRollup.__table__.insert(), user_id=user_id, place_id=place_id,
+                               sentiment=sentiment, count=count)
+
+        # What archiving the November partition leaves behind: its rows in their own table
+        connection.execute(text(
+            "CREATE TABLE mood_events_y2017m11 AS SELECT * FROM mood_events WHERE date_created < '2017-12-01'"
+        ))
+
+    session.remove()
+    session.configure(bind=engine)
+    try:
+        rollups.forget('mood_events_y2017m11', date(2017, 11, 1), date(2017, 12, 1))
+        session.commit()
+
+        daily = {(row.user_id, row.day, row.sentiment): row.count for row in session.query(SentimentRollup)}
+        places = {(row.user_id, row.place_id, row.sentiment): row.count for row in session.query(PlaceSentimentRollup)}
+    finally:
+        session.remove()
+
+    assert (daily, places) == rebuilt([event for event in events if event[2] >= datetime(2017, 12, 1)])
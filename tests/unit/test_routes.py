@@ -0,0 +1,198 @@
+from datetime import datetime
+from unittest.mock import Mock
+import json
+
+from flask import Flask
+from marshmallow import ValidationError
+from sqlalchemy import create_engine, text
+import pytest
+
+from moody import auth, conditional, db, export, insights, routes
+from moody.cache import LRUCache
+from moody.db import ReplicaSet, assert_max_queries, session
+from moody.models import MoodEvent, User, mood_events_places
+
+app = Flask('moody')
+
+api = Flask('moody')
+api.register_blueprint(routes.main)
+
+
+def test_parse_batch_body_accepts_json_array():
+    with app.test_request_context(data='[{"sentiment": "happy"}]', content_type='application/json'):
+        assert routes.parse_batch_body() == [{'sentiment': 'happy'}]
+
+
+def test_parse_batch_body_accepts_ndjson():
+    body = '{"sentiment": "happy"}\n\n{"sentiment": "sad"}\n'
+    with app.test_request_context(data=body, content_type='application/x-ndjson'):
+        assert routes.parse_batch_body() == [{'sentiment': 'happy'}, {'sentiment': 'sad'}]
+
+
+def test_parse_batch_body_rejects_objects():
+    with app.test_request_context(data='{"sentiment": "happy"}', content_type='application/json'):
+        with pytest.raises(ValidationError):
+            routes.parse_batch_body()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Test client for the main blueprint, authenticated as user 1 without touching the db"""
+    monkeypatch.setattr(auth, 'authenticate', Mock(return_value={'user_id': 1}))
+    monkeypatch.setattr(routes, 'current_user', Mock(return_value=Mock(id=1)))
+    return api.test_client()
+
+
+@pytest.fixture
+def data_version(monkeypatch):
+    """Mocked `User.get_data_version`, with an empty response cache"""
+    get_data_version = Mock(return_value=42)
+    monkeypatch.setattr(conditional.User, 'get_data_version', get_data_version)
+    monkeypatch.setattr(conditional, 'response_cache', LRUCache(maxsize=10))
+    return get_data_version
+
+
+def test_create_mood_events_batch_reports_results_per_index(client, monkeypatch):
+    date_created = datetime(2017, 12, 11)
+    inserted = [Mock(id=10, user_id=1, date_created=date_created, sentiment='happy'),
+                Mock(id=11, user_id=1, date_created=date_created, sentiment='sad')]
+    execute = Mock(return_value=Mock(fetchall=Mock(return_value=inserted)))
+    record_mood_events = Mock()
+    bump_data_version = Mock()
+    enqueue_many = Mock()
+    monkeypatch.setattr(routes.session, 'execute', execute)
+    monkeypatch.setattr(routes.session, 'commit', Mock())
+    monkeypatch.setattr(routes.rollups, 'record_mood_events', record_mood_events)
+    monkeypatch.setattr(routes.User, 'bump_data_version', bump_data_version)
+    monkeypatch.setattr(routes.enrichment_queue, 'enqueue_many', enqueue_many)
+
+    response = client.post('/mood_events/batch', headers={'Authorization': 'Bearer token'}, data=json.dumps([
+        {'sentiment': 'happy', 'latitude': 1.0, 'longitude': 2.0},
+        'happy',
+        {'sentiment': 'angry', 'latitude': 1.0, 'longitude': 2.0},
+        None,
+        {'sentiment': 'sad', 'latitude': 1.0, 'longitude': 2.0},
+        42,
+    ]), content_type='application/json')
+
+    body = json.loads(response.get_data())
+    assert response.status_code == 201
+    assert body['data']['created'] == [{'index': 0, 'id': 10}, {'index': 4, 'id': 11}]
+    assert sorted(body['data']['errors']) == ['1', '2', '3', '5']
+    assert 'sentiment' in body['data']['errors']['2']
+    assert body['data']['errors']['1'] == {'_schema': ['Mood event must be a JSON object.']}
+    assert [row['sentiment'] for row in execute.call_args[0][0].parameters] == ['happy', 'sad']
+    record_mood_events.assert_called_once_with(inserted)
+    bump_data_version.assert_called_once_with([1])
+    enqueue_many.assert_called_once_with([10, 11])
+
+
+def test_get_time_histograms_short_circuits_on_matching_etag(client, monkeypatch, data_version):
+    get_time_histograms = Mock(return_value={'hour': {}, 'weekday': {}})
+    monkeypatch.setattr(insights, 'get_time_histograms', get_time_histograms)
+    headers = {'Authorization': 'Bearer token'}
+
+    response = client.get('/insights/histograms?tz=UTC', headers=headers)
+    etag = response.headers['ETag']
+
+    assert response.status_code == 200
+    assert get_time_histograms.call_count == 1
+
+    response = client.get('/insights/histograms?tz=UTC', headers=dict(headers, **{'If-None-Match': etag}))
+
+    assert response.status_code == 304
+    assert get_time_histograms.call_count == 1
+
+    data_version.return_value = 43
+    response = client.get('/insights/histograms?tz=UTC', headers=dict(headers, **{'If-None-Match': etag}))
+
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert get_time_histograms.call_count == 2
+
+
+def test_get_time_histograms_serves_cached_responses_until_the_version_changes(client, monkeypatch, data_version):
+    get_time_histograms = Mock(return_value={'hour': {'happy': [1] * 24}, 'weekday': {}})
+    monkeypatch.setattr(insights, 'get_time_histograms', get_time_histograms)
+    headers = {'Authorization': 'Bearer token'}
+
+    first = client.get('/insights/histograms?tz=UTC', headers=headers)
+    second = client.get('/insights/histograms?tz=UTC', headers=headers)
+
+    assert second.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert second.headers['Content-Type'] == first.headers['Content-Type']
+    assert get_time_histograms.call_count == 1
+
+    # Other queries are cached separately
+    client.get('/insights/histograms?tz=America/Los_Angeles', headers=headers)
+    assert get_time_histograms.call_count == 2
+
+    data_version.return_value = 43
+    client.get('/insights/histograms?tz=UTC', headers=headers)
+    assert get_time_histograms.call_count == 3
+
+
+def test_get_time_histograms_tags_each_content_encoding_separately(client, monkeypatch, data_version):
+    monkeypatch.setattr(insights, 'get_time_histograms', Mock(return_value={'hour': {}, 'weekday': {}}))
+    headers = {'Authorization': 'Bearer token'}
+
+    identity = client.get('/insights/histograms?tz=UTC', headers=headers)
+    gzip = client.get('/insights/histograms?tz=UTC', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+
+    assert identity.headers['ETag'] != gzip.headers['ETag']
+
+    headers.update({'Accept-Encoding': 'gzip', 'If-None-Match': identity.headers['ETag']})
+    response = client.get('/insights/histograms?tz=UTC', headers=headers)
+
+    assert response.status_code == 200
+
+
+def test_get_token_info_does_not_query_the_db(client):
+    with assert_max_queries(0):
+        response = client.get('/tokeninfo', headers={'Authorization': 'Bearer token'})
+
+    assert response.status_code == 200
+
+
+def test_export_mood_events_streams_chunks(client, monkeypatch):
+    export_mood_events = Mock(return_value=iter([b'{"id": 1}\n', b'{"id": 2}\n']))
+    monkeypatch.setattr(export, 'export_mood_events', export_mood_events)
+
+    response = client.get('/mood_events/export?format=ndjson', headers={'Authorization': 'Bearer token'})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    assert response.headers['Content-Disposition'] == 'attachment; filename=mood_events.ndjson'
+    assert response.get_data() == b'{"id": 1}\n{"id": 2}\n'
+    export_mood_events.assert_called_once_with(1, format='ndjson')
+
+
+def make_mood_events_db(sentiment):
+    """Throwaway sqlite db holding one mood event of user 1 with `sentiment`"""
+    engine = create_engine('sqlite://')
+    MoodEvent.__table__.metadata.create_all(engine, tables=[User.__table__, MoodEvent.__table__])
+    with engine.connect() as connection:
+        connection.execute(text('CREATE TABLE places (id INTEGER PRIMARY KEY, place_id TEXT, name TEXT, type_ids TEXT)'))
+        connection.execute(User.__table__.insert(), id=1, email='user@example.com', password='hash')
+        connection.execute(
+            MoodEvent.__table__.insert(),
+            user_id=1, sentiment=sentiment, latitude=1.0, longitude=2.0, date_created=datetime(2017, 12, 11)
+        )
+    mood_events_places.create(engine)
+    return engine
+
+
+def test_export_mood_events_streams_from_the_replica(client, monkeypatch):
+    monkeypatch.setattr(db, 'replicas', ReplicaSet([make_mood_events_db('happy')]))
+    session.remove()
+    session.configure(bind=make_mood_events_db('sad'))
+
+    try:
+        response = client.get('/mood_events/export?format=ndjson', headers={'Authorization': 'Bearer token'})
+        rows = [json.loads(line) for line in response.get_data().splitlines()]
+    finally:
+        session.remove()
+
+    assert [row['sentiment'] for row in rows] == ['happy']
@@ -0,0 +1,54 @@
+from datetime import datetime, timezone
+
+from marshmallow import ValidationError
+import pytest
+
+from moody.schemas import MoodEventQuerySchema, CreateMoodEventSchema, TimeHistogramsQuerySchema
+
+
+def test_create_mood_event_schema_rejects_unknown_sentiment():
+    with pytest.raises(ValidationError):
+        CreateMoodEventSchema(strict=True).load({'sentiment': 'angry', 'latitude': 0, 'longitude': 0})
+
+
+def test_mood_event_query_schema_parses_filters():
+    kwargs = MoodEventQuerySchema(strict=True).load({
+        'sentiment': 'happy',
+        'created-after': '12-11-17',
+        'created-before': '2017-12-12T10:00:00+00:00',
+    }).data
+
+    assert kwargs['sentiment'] == 'happy'
+    assert kwargs['created_after'] == datetime(2017, 12, 11, tzinfo=timezone.utc)
+    assert kwargs['created_before'] == datetime(2017, 12, 12, 10, tzinfo=timezone.utc)
+    assert kwargs['limit'] == 100
+
+
+def test_mood_event_query_schema_caps_page_size():
+    with pytest.raises(ValidationError):
+        MoodEventQuerySchema(strict=True).load({'limit': '100000'})
+
+
+def test_mood_event_query_schema_round_trips_cursor():
+    cursor = (datetime(2017, 12, 11, 8, tzinfo=timezone.utc), 42)
+    encoded = MoodEventQuerySchema().fields['cursor'].serialize('cursor', {'cursor': cursor})
+
+    kwargs = MoodEventQuerySchema(strict=True).load({'cursor': encoded}).data
+
+    assert kwargs['cursor'] == cursor
+
+
+def test_mood_event_query_schema_rejects_invalid_cursor():
+    with pytest.raises(ValidationError):
+        MoodEventQuerySchema(strict=True).load({'cursor': 'not-a-cursor'})
+
+
+def test_time_histograms_query_schema_only_accepts_iana_timezones():
+    schema = TimeHistogramsQuerySchema(strict=True)
+
+    assert schema.load({'tz': 'America/Los_Angeles'}).data['tz'] == 'America/Los_Angeles'
+    assert schema.load({}).data['tz'] == 'UTC'
+
+    for value in ('', '/etc/localtime', 'localtime', 'UTC+3', 'Mars/Olympus_Mons'):
+        with pytest.raises(ValidationError):
+            schema.load({'tz': value})
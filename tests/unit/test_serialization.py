@@ -0,0 +1,54 @@
+import gzip
+import json
+import zlib
+
+from flask import Flask
+
+from moody import serialization
+from moody.schemas import MoodEventSchema
+
+app = Flask('moody')
+
+
+def test_get_schema_reuses_instances_per_arguments():
+    schema = serialization.get_schema(MoodEventSchema, many=True, exclude=('user',))
+
+    assert serialization.get_schema(MoodEventSchema, many=True, exclude=('user',)) is schema
+    assert serialization.get_schema(MoodEventSchema) is not schema
+    assert 'user' not in schema.fields
+
+
+def test_dumps_accepts_non_string_keys():
+    assert json.loads(serialization.dumps({0: ['error'], 'status': 400})) == {'0': ['error'], 'status': 400}
+
+
+def test_json_response_leaves_small_bodies_uncompressed():
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+        response = serialization.json_response({'status': 200})
+
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.get_data()) == {'status': 200}
+
+
+def test_json_response_negotiates_compression(monkeypatch):
+    monkeypatch.setattr(serialization.config, 'COMPRESSION_MIN_SIZE', 10)
+    body = {'data': ['happy'] * 100, 'status': 200}
+
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip, deflate'}):
+        response = serialization.json_response(body)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert json.loads(gzip.decompress(response.get_data())) == body
+
+    with app.test_request_context(headers={'Accept-Encoding': 'deflate'}):
+        response = serialization.json_response(body, 201)
+    assert response.status_code == 201
+    assert response.headers['Content-Encoding'] == 'deflate'
+    assert json.loads(zlib.decompress(response.get_data())) == body
+
+    with app.test_request_context():
+        response = serialization.json_response(body)
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.get_data()) == body
@@ -0,0 +1,72 @@
+from collections import namedtuple
+from unittest.mock import Mock
+
+import pytest
+
+from moody import spatial
+
+
+def make_place(place_id, latitude, longitude):
+    return {'place_id': place_id, 'name': place_id, 'types': ['park'], 'latitude': latitude, 'longitude': longitude}
+
+
+def test_haversine():
+    # One degree of latitude is ~111km
+    assert spatial.haversine(0, 0, 1, 0) == pytest.approx(111195, rel=1e-3)
+
+
+def test_place_index_nearby_returns_places_within_radius_closest_first():
+    index = spatial.PlaceIndex(cell_size=100)
+    index.add(make_place('far', 37.7800, -122.4194))
+    index.add(make_place('near', 37.7751, -122.4194))
+    index.add(make_place('nearest', 37.7750, -122.4194))
+    index.add(make_place('nearest', 37.7750, -122.4194))
+
+    places = index.nearby(37.7749, -122.4194, radius=100)
+
+    assert [place['place_id'] for place in places] == ['nearest', 'near']
+    assert len(index) == 3
+
+
+def test_places_near_falls_back_to_google_when_coverage_is_thin(monkeypatch):
+    index = spatial.PlaceIndex(cell_size=100)
+    index.add(make_place('known', 37.7750, -122.4194))
+    google = Mock(return_value=[make_place('new', 37.7749, -122.4195)])
+    monkeypatch.setattr(spatial, 'place_index', index)
+    monkeypatch.setattr(spatial.geo, 'nearby_places', google)
+
+    assert [place['place_id'] for place in spatial.places_near(37.7749, -122.4194, min_results=1)] == ['known']
+    google.assert_not_called()
+
+    assert [place['place_id'] for place in spatial.places_near(37.7749, -122.4194, min_results=2)] == ['new']
+    assert len(index) == 2
+
+
+def test_place_index_refresh_rescans_recent_ids_for_late_commits(monkeypatch):
+    Row = namedtuple('Row', ['id', 'place_id', 'name', 'type_ids', 'latitude', 'longitude'])
+    rows = [Row(5000, 'indexed', 'indexed', [], 37.7750, -122.4194)]
+    lower_bounds = []
+
+    def query(*columns):
+        def filter(id_criterion, *criteria):
+            lower_bounds.append(id_criterion.right.value)
+            return Mock(**{'order_by.return_value.limit.return_value.all.return_value': [
+                row for row in rows if row.id > id_criterion.right.value
+            ]})
+        return Mock(filter=filter)
+
+    monkeypatch.setattr(spatial, 'session', Mock(query=query))
+    monkeypatch.setattr(spatial.PlaceType, 'get_names', Mock(return_value=['park']))
+    index = spatial.PlaceIndex(cell_size=100)
+
+    index.refresh()
+    assert index.max_id == 5000
+
+    # Committed after id 5000 was indexed
+    rows.append(Row(4990, 'late', 'late', [], 37.7751, -122.4194))
+    index.refresh(overlap=100)
+
+    assert lower_bounds == [0, 4900]
+    assert index.max_id == 5000
+    assert sorted(place['place_id'] for place in index.nearby(37.7750, -122.4194)) == ['indexed', 'late']
+    assert len(index) == 2